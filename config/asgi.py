@@ -13,4 +13,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from email_test import aiosmtp  # noqa: E402  (needs the apps loaded)
+
+
+async def application(scope, receive, send):
+    """
+    Django's ASGI handler plus the lifespan protocol, which Django doesn't
+    speak: on server shutdown the async SMTP pool QUITs its sessions.
+    """
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aiosmtp.close_async_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
 from pathlib import Path
+import tempfile
 import environ
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -88,10 +89,35 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # WAL lets the web workers enqueue while drain workers read,
+            # and IMMEDIATE transactions make queue leasing race-free.
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/6.0/ref/settings/#caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all workers; the table is created by the email_test migrations.
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'email_idempotency_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': env.int('EMAIL_IDEMPOTENCY_MAX_ENTRIES', default=10000),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -138,7 +164,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 EMAIL_BACKEND = env(
     'EMAIL_BACKEND',
-    default='django.core.mail.backends.smtp.EmailBackend'
+    default='email_test.backends.InstrumentedEmailBackend'
 )
 EMAIL_HOST = env('EMAIL_HOST', default='localhost')
 EMAIL_PORT = env.int('EMAIL_PORT', default=587)
@@ -148,3 +174,140 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL', default='noreply@example.com')
 SERVER_EMAIL = env('SERVER_EMAIL', default='noreply@example.com')
+
+# Relays used by email_test.backends.FailoverEmailBackend, as host:port
+# entries (port defaults to EMAIL_PORT). Empty means EMAIL_HOST only.
+EMAIL_HOSTS = env.list('EMAIL_HOSTS', default=[])
+EMAIL_RELAY_FAILURE_THRESHOLD = env.int('EMAIL_RELAY_FAILURE_THRESHOLD', default=3)
+EMAIL_RELAY_COOLDOWN = env.int('EMAIL_RELAY_COOLDOWN', default=30)
+
+# Retries of transient send failures (4xx replies, dropped connections,
+# timeouts) in email_test/delivery.py: jittered exponential backoff from
+# EMAIL_RETRY_BASE_DELAY up to EMAIL_RETRY_MAX_DELAY seconds, giving up
+# once EMAIL_RETRY_DEADLINE seconds have passed (0 disables retries).
+EMAIL_RETRY_DEADLINE = env.float('EMAIL_RETRY_DEADLINE', default=5)
+EMAIL_RETRY_BASE_DELAY = env.float('EMAIL_RETRY_BASE_DELAY', default=0.25)
+EMAIL_RETRY_MAX_DELAY = env.float('EMAIL_RETRY_MAX_DELAY', default=2)
+
+# Where email_test.backends.SpoolingEmailBackend keeps messages the relay
+# could not take, until replay_spool delivers them. Use a durable disk.
+EMAIL_SPOOL_DIR = env('EMAIL_SPOOL_DIR', default=str(BASE_DIR / 'spool'))
+
+# Connection pool used by email_test.backends.PooledEmailBackend
+EMAIL_POOL_MAX_SIZE = env.int('EMAIL_POOL_MAX_SIZE', default=4)
+EMAIL_POOL_IDLE_TIMEOUT = env.int('EMAIL_POOL_IDLE_TIMEOUT', default=30)
+EMAIL_POOL_MAX_MESSAGES = env.int('EMAIL_POOL_MAX_MESSAGES', default=100)
+EMAIL_POOL_ACQUIRE_TIMEOUT = env.int('EMAIL_POOL_ACQUIRE_TIMEOUT', default=10)
+# Open connections across all pools of a worker (0 = no cap); when reached,
+# the least recently used idle connection is closed to make room.
+EMAIL_POOL_MAX_TOTAL = env.int('EMAIL_POOL_MAX_TOTAL', default=100)
+
+# Named SMTP profiles (email_test/profiles.py) as a JSON object, e.g.
+# {"acme": {"host": "smtp.acme.example", "username": "...", "password": "...",
+#  "from_email": "noreply@acme.example", "max_connections": 2}}.
+# Unset keys fall back to the EMAIL_* settings above.
+EMAIL_PROFILES = env.json('EMAIL_PROFILES', default={})
+
+# Seconds to cache SMTP relay DNS lookups per process (0 disables)
+EMAIL_DNS_CACHE_TTL = env.int('EMAIL_DNS_CACHE_TTL', default=60)
+
+# Send rate limits shared by all workers (email_test/ratelimit.py), in
+# messages per second; 0 disables. EMAIL_DOMAIN_RATE_LIMITS overrides the
+# per-recipient-domain default, e.g. "gmail.com=5;yahoo.com=2". Requests wait
+# up to EMAIL_RATE_LIMIT_MAX_WAIT seconds for a token before returning 429.
+EMAIL_RATE_LIMIT = env.float('EMAIL_RATE_LIMIT', default=0)
+EMAIL_RATE_LIMIT_BURST = env.float('EMAIL_RATE_LIMIT_BURST', default=0)
+EMAIL_DOMAIN_RATE_LIMIT = env.float('EMAIL_DOMAIN_RATE_LIMIT', default=0)
+EMAIL_DOMAIN_RATE_LIMITS = env.dict('EMAIL_DOMAIN_RATE_LIMITS', cast={'value': float}, default={})
+EMAIL_RATE_LIMIT_MAX_WAIT = env.float('EMAIL_RATE_LIMIT_MAX_WAIT', default=1.0)
+EMAIL_RATELIMIT_FILE = env(
+    'EMAIL_RATELIMIT_FILE', default=str(Path(tempfile.gettempdir()) / 'email-test-ratelimit.bin')
+)
+
+# Request size limits for the send endpoints (email_test/schema.py): larger
+# bodies get 413 before they are parsed. send-batch has its own limit; above
+# 2.5 MiB, raise DATA_UPLOAD_MAX_MEMORY_SIZE with it.
+EMAIL_MAX_REQUEST_BYTES = env.int('EMAIL_MAX_REQUEST_BYTES', default=256 * 1024)
+EMAIL_MAX_BATCH_REQUEST_BYTES = env.int('EMAIL_MAX_BATCH_REQUEST_BYTES', default=2560 * 1024)
+
+# Idempotency-Key support for the send endpoints (email_test/idempotency.py),
+# stored in the "idempotency" cache above. Responses are kept for
+# EMAIL_IDEMPOTENCY_TTL seconds; a duplicate waits up to
+# EMAIL_IDEMPOTENCY_WAIT seconds for an in-flight original; a claim left by
+# a crashed worker expires after EMAIL_IDEMPOTENCY_LOCK_TIMEOUT seconds.
+EMAIL_IDEMPOTENCY_TTL = env.int('EMAIL_IDEMPOTENCY_TTL', default=86400)
+EMAIL_IDEMPOTENCY_WAIT = env.float('EMAIL_IDEMPOTENCY_WAIT', default=10)
+EMAIL_IDEMPOTENCY_LOCK_TIMEOUT = env.int('EMAIL_IDEMPOTENCY_LOCK_TIMEOUT', default=60)
+
+# Background relay health checks served by /api/email/status/
+# (email_test/health.py). One worker probes every
+# EMAIL_HEALTH_CHECK_INTERVAL seconds and shares the result through
+# EMAIL_HEALTH_FILE; set EMAIL_HEALTH_CHECK_AUTH to also test the login.
+EMAIL_HEALTH_CHECK_INTERVAL = env.int('EMAIL_HEALTH_CHECK_INTERVAL', default=30)
+EMAIL_HEALTH_CHECK_TIMEOUT = env.float('EMAIL_HEALTH_CHECK_TIMEOUT', default=10)
+EMAIL_HEALTH_CHECK_AUTH = env.bool('EMAIL_HEALTH_CHECK_AUTH', default=False)
+EMAIL_HEALTH_FILE = env(
+    'EMAIL_HEALTH_FILE', default=str(Path(tempfile.gettempdir()) / 'email-test-health.json')
+)
+
+# On-demand certificate/handshake probes served by /api/email/probe/
+# (email_test/probe.py); each worker reuses a probe's result for
+# EMAIL_PROBE_CACHE_TTL seconds.
+EMAIL_PROBE_CACHE_TTL = env.int('EMAIL_PROBE_CACHE_TTL', default=300)
+EMAIL_PROBE_TIMEOUT = env.float('EMAIL_PROBE_TIMEOUT', default=10)
+
+# Delivery log (email_test/deliverylog.py): outcomes are buffered per
+# worker and written with one bulk insert once EMAIL_DELIVERY_LOG_BATCH_SIZE
+# rows are waiting or EMAIL_DELIVERY_LOG_FLUSH_INTERVAL seconds have passed.
+# Past EMAIL_DELIVERY_LOG_MAX_BUFFER unwritten rows (database down), new
+# rows are dropped rather than held in memory.
+EMAIL_DELIVERY_LOG = env.bool('EMAIL_DELIVERY_LOG', default=True)
+EMAIL_DELIVERY_LOG_BATCH_SIZE = env.int('EMAIL_DELIVERY_LOG_BATCH_SIZE', default=500)
+EMAIL_DELIVERY_LOG_FLUSH_INTERVAL = env.float('EMAIL_DELIVERY_LOG_FLUSH_INTERVAL', default=1.0)
+EMAIL_DELIVERY_LOG_MAX_BUFFER = env.int('EMAIL_DELIVERY_LOG_MAX_BUFFER', default=10000)
+
+# Connections per event loop for the async (ASGI) send views
+EMAIL_ASYNC_POOL_MAX_SIZE = env.int('EMAIL_ASYNC_POOL_MAX_SIZE', default=100)
+
+# 'direct' sends inside the request; 'queue' stores the message for the
+# drain_email_queue command and returns 202 with a job id. Clients can also
+# opt in per request with "queue": true in the POST body.
+EMAIL_SEND_MODE = env('EMAIL_SEND_MODE', default='direct')
+
+# A queued job that fails transiently waits before drain_email_queue tries
+# it again: EMAIL_QUEUE_RETRY_BASE_DELAY seconds after the first attempt,
+# doubling per attempt up to EMAIL_QUEUE_RETRY_MAX_DELAY.
+EMAIL_QUEUE_RETRY_BASE_DELAY = env.float('EMAIL_QUEUE_RETRY_BASE_DELAY', default=30)
+EMAIL_QUEUE_RETRY_MAX_DELAY = env.float('EMAIL_QUEUE_RETRY_MAX_DELAY', default=3600)
+
+# Per-worker histogram files for /api/email/metrics/. gunicorn clears the
+# directory when the master starts and removes a worker's file when it exits.
+EMAIL_METRICS_DIR = env('EMAIL_METRICS_DIR', default=str(Path(tempfile.gettempdir()) / 'email-test-metrics'))
+
+# Named HTML templates for send_html_email's "template" mode
+EMAIL_TEMPLATE_DIR = env('EMAIL_TEMPLATE_DIR', default=str(BASE_DIR / 'email_templates'))
+EMAIL_TEMPLATE_CACHE_SIZE = env.int('EMAIL_TEMPLATE_CACHE_SIZE', default=64)
+
+# DKIM signing of outgoing mail (email_test/dkim.py); off unless the domain,
+# selector and PEM private key file (RSA or Ed25519) are all set. The key is
+# loaded once per process. Messages are signed as they are sent. Set
+# EMAIL_DKIM_BATCH_SIZE to have the bulk paths (send-batch, send_test_email
+# --recipients-file) sign that many at a time in the mail merge render
+# processes instead, which each gunicorn worker then starts.
+EMAIL_DKIM_DOMAIN = env('EMAIL_DKIM_DOMAIN', default='')
+EMAIL_DKIM_SELECTOR = env('EMAIL_DKIM_SELECTOR', default='')
+EMAIL_DKIM_PRIVATE_KEY_FILE = env('EMAIL_DKIM_PRIVATE_KEY_FILE', default='')
+EMAIL_DKIM_HEADERS = env.list('EMAIL_DKIM_HEADERS', default=[
+    'From', 'To', 'Cc', 'Subject', 'Date', 'Message-ID', 'Reply-To',
+    'MIME-Version', 'Content-Type', 'Content-Transfer-Encoding',
+])
+EMAIL_DKIM_BATCH_SIZE = env.int('EMAIL_DKIM_BATCH_SIZE', default=0)
+
+# Mail merge (email_test/merge.py): render worker processes per gunicorn
+# worker (0 = one per CPU, which multiplies by GUNICORN_WORKERS), sender
+# threads (each holds one SMTP session), rendered messages buffered
+# between them, and recipients per render task.
+EMAIL_MERGE_PROCESSES = env.int('EMAIL_MERGE_PROCESSES', default=2)
+EMAIL_MERGE_SENDERS = env.int('EMAIL_MERGE_SENDERS', default=4)
+EMAIL_MERGE_QUEUE_SIZE = env.int('EMAIL_MERGE_QUEUE_SIZE', default=1000)
+EMAIL_MERGE_CHUNK_SIZE = env.int('EMAIL_MERGE_CHUNK_SIZE', default=100)
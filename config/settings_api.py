@@ -0,0 +1,26 @@
+"""
+Lean settings for serving only the JSON email API.
+
+Select with DJANGO_SETTINGS_MODULE=config.settings_api. Everything comes
+from config.settings except what the @csrf_exempt JSON views never use:
+the admin, auth, sessions, messages and staticfiles apps, their
+middleware, CSRF and clickjacking middleware, and the template backend.
+The SQLite database stays, since the send queue, the delivery log and the
+Idempotency-Key cache live there. The admin is not served under this profile.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'email_test',
+]
+
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'config.urls_api'
+
+# Templates are compiled by email_test.templating with its own Engine.
+TEMPLATES = []
@@ -0,0 +1,8 @@
+"""
+URL configuration for the lean API-only profile (config.settings_api).
+"""
+from django.urls import path, include
+
+urlpatterns = [
+    path('api/email/', include('email_test.urls')),
+]
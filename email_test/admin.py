@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import DeliveryLog, EmailJob
+
+
+@admin.register(EmailJob)
+class EmailJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    readonly_fields = ('created_at', 'updated_at', 'sent_at')
+
+
+@admin.register(DeliveryLog)
+class DeliveryLogAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'to_email', 'status', 'code', 'duration_ms', 'relay', 'profile')
+    list_filter = ('status', 'profile')
+    search_fields = ('to_email',)
@@ -0,0 +1,397 @@
+"""
+Minimal asyncio SMTP client used by the async send views.
+
+Supports implicit TLS, STARTTLS, AUTH PLAIN/LOGIN, RFC 2920
+pipelining of MAIL/RCPT/DATA, SIZE, and 8BITMIME bodies and SMTPUTF8
+addresses the same way as the sync backend (see wire.py). Failures are
+raised as the standard ``smtplib`` exceptions so callers can treat both
+send paths alike.
+"""
+
+import asyncio
+import base64
+import smtplib
+import ssl
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail.utils import DNS_NAME
+
+from . import dkim, metrics, transport, wire
+from .smtp import after_data
+
+
+class AsyncSMTP:
+    """A single SMTP session over asyncio streams."""
+
+    def __init__(self, host, port, timeout=30, local_hostname=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local_hostname = local_hostname or DNS_NAME.get_fqdn()
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+        self.messages_sent = 0
+        # Switched to UTF-8 for the envelope of an SMTPUTF8 transaction.
+        self.command_encoding = 'ascii'
+
+    async def connect(self, ssl_context=None):
+        """Open the connection (TLS from the start if ``ssl_context`` is given)."""
+        started = time.perf_counter()
+        addrinfo = await asyncio.wait_for(transport.resolve_async(self.host, self.port), self.timeout)
+        resolved = time.perf_counter()
+        metrics.observe('dns', resolved - started)
+        error = None
+        for family, _, _, _, address in addrinfo:
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        address[0], address[1], family=family, ssl=ssl_context,
+                        server_hostname=self.host if ssl_context else None,
+                    ),
+                    self.timeout,
+                )
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+        else:
+            transport.forget(self.host, self.port)
+            raise error or OSError(f'getaddrinfo returned no addresses for {self.host}')
+        connected = time.perf_counter()
+        # Any implicit TLS handshake is included in "connect" here.
+        metrics.observe('connect', connected - resolved)
+        code, message = await self.read_reply()
+        metrics.observe('greeting', time.perf_counter() - connected)
+        if code != 220:
+            await self.close()
+            raise smtplib.SMTPConnectError(code, message)
+        await self.ehlo()
+
+    async def read_reply(self):
+        """Read one (possibly multi-line) reply; return (code, message)."""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].rstrip(b'\r\n'))
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def command(self, cmd):
+        self.writer.write(cmd.encode(self.command_encoding) + b'\r\n')
+        await self.writer.drain()
+        return await self.read_reply()
+
+    async def ehlo(self):
+        with metrics.timed('ehlo'):
+            code, message = await self.command(f'EHLO {self.local_hostname}')
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, message)
+        features = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            features[keyword.lower()] = params
+        self.esmtp_features = features
+
+    def has_extn(self, name):
+        return name.lower() in self.esmtp_features
+
+    async def starttls(self, ssl_context):
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        with metrics.timed('starttls'):
+            code, message = await self.command('STARTTLS')
+            if code != 220:
+                raise smtplib.SMTPResponseException(code, message)
+            await asyncio.wait_for(
+                self.writer.start_tls(ssl_context, server_hostname=self.host),
+                self.timeout,
+            )
+            # RFC 3207: discard everything learned before TLS and EHLO again.
+            await self.ehlo()
+
+    async def login(self, username, password):
+        with metrics.timed('auth'):
+            await self._login(username, password)
+
+    async def _login(self, username, password):
+        mechanisms = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(f'\0{username}\0{password}'.encode()).decode('ascii')
+            code, message = await self.command(f'AUTH PLAIN {token}')
+        elif 'LOGIN' in mechanisms:
+            code, message = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, message = await self.command(base64.b64encode(username.encode()).decode('ascii'))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode()).decode('ascii'))
+        else:
+            raise smtplib.SMTPNotSupportedError('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def send_message(self, email_message):
+        """
+        Send a Django EmailMessage, addressed and serialized for this
+        session's extensions as the sync backend does.
+        """
+        with metrics.timed('encode'):
+            from_addr, to_addrs, mail_options = wire.envelope(
+                email_message, smtputf8=self.has_extn('smtputf8')
+            )
+            msg = wire.serialize(email_message, eightbit=self.has_extn('8bitmime'), sign=False)
+        if dkim.get_signer():
+            # RSA signing takes milliseconds; keep it off the event loop.
+            msg = await sync_to_async(dkim.sign, thread_sensitive=False)(msg)
+        return await self.sendmail(from_addr, to_addrs, msg, mail_options)
+
+    async def sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        """
+        Send ``msg`` (bytes with CRLF line endings), like the sync
+        InstrumentedSMTP.sendmail(): with SIZE when the server takes it,
+        BODY=8BITMIME for 8-bit data (or re-encoded to 7-bit), and
+        UTF-8 addresses if ``mail_options`` asks for SMTPUTF8. With
+        PIPELINING the MAIL, RCPT and DATA commands go out in one write
+        and their replies are read back in order.
+        """
+        self.command_encoding = 'ascii'
+        if not msg.isascii():
+            if self.has_extn('8bitmime'):
+                mail_options = [*mail_options, 'BODY=8BITMIME']
+            else:
+                with metrics.timed('encode'):
+                    msg = wire.to_7bit(msg)
+        options = [f'SIZE={len(msg)}'] if self.has_extn('size') else []
+        options.extend(mail_options)
+        if any(option.lower() == 'smtputf8' for option in options):
+            if not self.has_extn('smtputf8'):
+                raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+            self.command_encoding = 'utf-8'
+        envelope_started = time.perf_counter()
+        # quoteaddr() drops display names, as smtplib does for the sync path.
+        commands = [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}' + ''.join(f' {option}' for option in options)]
+        commands += [f'RCPT TO:{smtplib.quoteaddr(addr)}' for addr in to_addrs]
+        if self.has_extn('pipelining'):
+            self.writer.write(b''.join(
+                c.encode(self.command_encoding) + b'\r\n' for c in commands + ['DATA']
+            ))
+            await self.writer.drain()
+            replies = [await self.read_reply() for _ in range(len(commands) + 1)]
+        else:
+            replies = []
+            for cmd in commands:
+                replies.append(await self.command(cmd))
+                if replies[0][0] != 250:
+                    break
+            else:
+                if any(code in (250, 251) for code, _ in replies[1:]):
+                    replies.append(await self.command('DATA'))
+
+        metrics.observe('mail', time.perf_counter() - envelope_started)
+
+        mail_reply, rcpt_replies = replies[0], replies[1:len(commands)]
+        data_reply = replies[len(commands)] if len(replies) > len(commands) else None
+        if mail_reply[0] != 250:
+            await self._abort(data_reply)
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        refused = {
+            addr: reply for addr, reply in zip(to_addrs, rcpt_replies)
+            if reply[0] not in (250, 251)
+        }
+        if len(refused) == len(to_addrs):
+            await self._abort(data_reply)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply is None or data_reply[0] != 354:
+            await self._abort(data_reply)
+            code, message = data_reply or (-1, b'DATA not sent')
+            raise smtplib.SMTPDataError(code, message)
+
+        with metrics.timed('data'):
+            self.writer.write(_dot_stuff(msg) + b'.\r\n')
+            await self.writer.drain()
+            try:
+                code, message = await self.read_reply()
+            except OSError as e:
+                # As in smtp.end_data(): the relay may have accepted the message.
+                e.after_data = True
+                raise
+        if code != 250:
+            await self.command('RSET')
+            raise smtplib.SMTPDataError(code, message)
+        self.messages_sent += 1
+        return refused
+
+    async def _abort(self, data_reply):
+        if data_reply is not None and data_reply[0] == 354:
+            # The pipelined DATA was accepted; end it with an empty body
+            # before resetting so the session stays usable.
+            self.writer.write(b'.\r\n')
+            await self.writer.drain()
+            await self.read_reply()
+        await self.command('RSET')
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+            self.writer = self.reader = None
+
+
+def _dot_stuff(msg):
+    """Apply RFC 5321 transparency and make sure the body ends in CRLF."""
+    if msg.startswith(b'.'):
+        msg = b'.' + msg
+    msg = msg.replace(b'\r\n.', b'\r\n..')
+    if not msg.endswith(b'\r\n'):
+        msg += b'\r\n'
+    return msg
+
+
+class AsyncSMTPPool:
+    """Per-event-loop pool of warm AsyncSMTP sessions."""
+
+    def __init__(self, host, port, username, password, use_tls, use_ssl, timeout,
+                 max_size, idle_timeout, max_messages):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_size)
+        self._ssl_context = transport.get_ssl_context()
+
+    async def _connect(self):
+        client = AsyncSMTP(self.host, self.port, timeout=self.timeout)
+        await client.connect(self._ssl_context if self.use_ssl else None)
+        try:
+            if self.use_tls and not self.use_ssl:
+                await client.starttls(self._ssl_context)
+            if self.username and self.password:
+                await client.login(self.username, self.password)
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    async def _acquire(self):
+        loop = asyncio.get_running_loop()
+        while self._idle:
+            client, last_used = self._idle.pop()
+            if loop.time() - last_used <= self.idle_timeout and client.messages_sent < self.max_messages:
+                try:
+                    code, _ = await client.noop()
+                    if code == 250:
+                        return client
+                except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+                    pass
+            await client.close()
+        return await self._connect()
+
+    async def send(self, email_message):
+        async with self._slots:
+            client = await self._acquire()
+            try:
+                try:
+                    refused = await client.send_message(email_message)
+                except smtplib.SMTPServerDisconnected as e:
+                    if after_data(e):
+                        # The relay may have accepted it; don't send it twice.
+                        raise
+                    # The pooled session dropped before the relay had the
+                    # whole message. Replace it once and retry.
+                    await client.close()
+                    client = await self._connect()
+                    refused = await client.send_message(email_message)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                self._idle.append((client, asyncio.get_running_loop().time()))
+                raise
+            except BaseException:
+                await client.close()
+                raise
+            if client.messages_sent < self.max_messages:
+                self._idle.append((client, asyncio.get_running_loop().time()))
+            else:
+                await client.quit()
+            return refused
+
+    async def close(self):
+        """Close every idle session; call before the event loop shuts down."""
+        idle, self._idle = self._idle, []
+        for client, _ in idle:
+            try:
+                await client.quit()
+            except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+                await client.close()
+
+
+_pools = {}
+
+
+def get_async_pool():
+    """Return the pool for the running event loop and current EMAIL_* settings."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        # Drop pools belonging to loops that have since been closed.
+        for stale in [l for l in _pools if l.is_closed()]:
+            del _pools[stale]
+        pool = _pools[loop] = AsyncSMTPPool(
+            host=settings.EMAIL_HOST,
+            port=settings.EMAIL_PORT,
+            username=settings.EMAIL_HOST_USER,
+            password=settings.EMAIL_HOST_PASSWORD,
+            use_tls=settings.EMAIL_USE_TLS,
+            use_ssl=settings.EMAIL_USE_SSL,
+            timeout=settings.EMAIL_TIMEOUT or 30,
+            max_size=settings.EMAIL_ASYNC_POOL_MAX_SIZE,
+            idle_timeout=settings.EMAIL_POOL_IDLE_TIMEOUT,
+            max_messages=settings.EMAIL_POOL_MAX_MESSAGES,
+        )
+    return pool
+
+
+async def close_async_pool():
+    """Close and forget the running event loop's pool, if it has one."""
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+async def send_message_async(email_message):
+    """Send a Django EmailMessage over the async pool; return the refused dict."""
+    started = time.perf_counter()
+    success = False
+    try:
+        # The session addresses and serializes the message, once it knows
+        # the relay's extensions.
+        refused = await get_async_pool().send(email_message)
+        success = True
+        return refused
+    finally:
+        metrics.observe('send', time.perf_counter() - started)
+        metrics.count_send(success)
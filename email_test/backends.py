@@ -0,0 +1,328 @@
+"""
+Email backends for the email_test app.
+
+Select one through the EMAIL_BACKEND setting, e.g.
+EMAIL_BACKEND=email_test.backends.PooledEmailBackend
+
+All of them record per-phase SMTP timings for /api/email/metrics/.
+"""
+
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.utils import DNS_NAME
+
+from . import dkim, metrics, relays, spool, streaming, transport, wire
+from .pool import PoolExhausted, get_pool
+from .smtp import InstrumentedSMTP, InstrumentedSMTP_SSL, after_data
+
+
+class InstrumentedEmailBackend(EmailBackend):
+    """
+    Django's SMTP backend with per-phase timings (DNS, connect, TLS, AUTH,
+    MAIL/RCPT/DATA) and send outcomes recorded in email_test.metrics.
+
+    Messages are serialized for the session's EHLO extensions (see
+    wire.py): text parts go out as 8bit to relays with 8BITMIME, and
+    non-ASCII addresses as UTF-8 to relays with SMTPUTF8. They are
+    DKIM-signed when EMAIL_DKIM_* is configured (see dkim.py).
+    """
+
+    # Whether the backend picks relays and handles relay failures itself,
+    # in which case email_test.delivery leaves the circuit breaker and the
+    # connection to it.
+    manages_relays = False
+
+    @property
+    def connection_class(self):
+        return InstrumentedSMTP_SSL if self.use_ssl else InstrumentedSMTP
+
+    @property
+    def ssl_context(self):
+        # One shared context per client certificate instead of one per backend.
+        return transport.get_ssl_context(certfile=self.ssl_certfile, keyfile=self.ssl_keyfile)
+
+    def _send(self, email_message):
+        started = time.perf_counter()
+        success = False
+        try:
+            success = self._deliver(email_message)
+            return success
+        finally:
+            metrics.observe('send', time.perf_counter() - started)
+            metrics.count_send(success)
+
+    def _deliver(self, email_message):
+        """Django's _send(), serializing for what the relay supports."""
+        if not email_message.recipients():
+            return False
+        try:
+            # smtplib only reads the EHLO reply once per session; the
+            # extensions it found are cached on the connection.
+            self.connection.ehlo_or_helo_if_needed()
+            streamed = isinstance(email_message, streaming.StreamingMessage)
+            with metrics.timed('encode'):
+                from_email, recipients, mail_options = wire.envelope(
+                    email_message, smtputf8=self.connection.has_extn('smtputf8')
+                )
+                if not streamed:
+                    message = wire.serialize(
+                        email_message, eightbit=self.connection.has_extn('8bitmime'), sign=False
+                    )
+            if streamed:
+                # Attachments are read into DATA a block at a time, and
+                # signed on the way (see streaming.py).
+                streaming.send_streaming(self.connection, email_message, from_email, recipients, mail_options)
+            else:
+                # Signed separately, so the "sign" phase isn't counted as encode.
+                message = dkim.sign(message)
+                self.connection.sendmail(from_email, recipients, message, mail_options)
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
+
+
+class PooledEmailBackend(InstrumentedEmailBackend):
+    """
+    SMTP backend that borrows warm, authenticated connections from a
+    per-process pool instead of connecting and logging in for every send.
+
+    Pool limits come from EMAIL_POOL_MAX_SIZE, EMAIL_POOL_IDLE_TIMEOUT,
+    EMAIL_POOL_MAX_MESSAGES and EMAIL_POOL_ACQUIRE_TIMEOUT. Backends made
+    for an SMTP profile (see profiles.py) get a pool of their own, capped
+    at ``max_connections``.
+    """
+
+    def __init__(self, *args, profile=None, max_connections=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = profile
+        self.max_connections = max_connections
+        self._pooled = None
+
+    @property
+    def pool(self):
+        key = (self.profile, self.host, self.port, self.username, self.password,
+               self.use_tls, self.use_ssl, self.ssl_keyfile, self.ssl_certfile)
+        return get_pool(
+            key,
+            self._connect,
+            max_size=self.max_connections or settings.EMAIL_POOL_MAX_SIZE,
+            idle_timeout=settings.EMAIL_POOL_IDLE_TIMEOUT,
+            max_messages=settings.EMAIL_POOL_MAX_MESSAGES,
+            acquire_timeout=settings.EMAIL_POOL_ACQUIRE_TIMEOUT,
+        )
+
+    def _connect(self):
+        """Open, secure and authenticate a new connection (same steps as open())."""
+        connection_params = {'local_hostname': DNS_NAME.get_fqdn()}
+        if self.timeout is not None:
+            connection_params['timeout'] = self.timeout
+        if self.use_ssl:
+            connection_params['context'] = self.ssl_context
+        connection = self.connection_class(self.host, self.port, **connection_params)
+        try:
+            if not self.use_ssl and self.use_tls:
+                connection.starttls(context=self.ssl_context)
+            if self.username and self.password:
+                connection.login(self.username, self.password)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def open(self):
+        if self.connection:
+            return False
+        try:
+            self._pooled = self.pool.acquire()
+        except (OSError, smtplib.SMTPException):
+            if not self.fail_silently:
+                raise
+            return None
+        self.connection = self._pooled.connection
+        return True
+
+    def close(self):
+        """Hand the connection back to the pool rather than sending QUIT."""
+        if self._pooled is not None:
+            try:
+                self.pool.release(self._pooled)
+            finally:
+                self._pooled = None
+                self.connection = None
+
+    def _deliver(self, email_message):
+        try:
+            sent = super()._deliver(email_message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+            self._pooled.broken = True
+            if after_data(e):
+                # The relay had the whole message and may have accepted it;
+                # sending it again could deliver it twice.
+                raise
+            # The session broke before the relay had the whole message
+            # (typically an idle connection the server dropped after the
+            # NOOP check), so nothing was delivered. Replace it once and retry.
+            self.close()
+            if not self.open():
+                return False
+            sent = super()._deliver(email_message)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # smtplib sent RSET after the error reply, so the session is
+            # still good for the next message (or a retry of this one).
+            raise
+        except OSError:
+            # Timeouts and the like leave the session in an unknown state.
+            self._pooled.broken = True
+            raise
+        if sent:
+            self._pooled.messages_sent += 1
+        return sent
+
+
+def is_relay_failure(exc):
+    """
+    Whether ``exc`` says the relay, not the message, is at fault: network
+    errors, dropped connections, handshake/auth failures and 4xx replies.
+    Permanent (5xx) rejections of a message would fail on any relay, and
+    PoolExhausted is contention for local connections, not a relay fault.
+    """
+    if isinstance(exc, (smtplib.SMTPRecipientsRefused, PoolExhausted)):
+        return False
+    if isinstance(exc, (smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                        smtplib.SMTPAuthenticationError)):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code < 500
+    return isinstance(exc, OSError)
+
+
+class FailoverEmailBackend(PooledEmailBackend):
+    """
+    Pooled backend that spreads sends across the relays in EMAIL_HOSTS.
+
+    Each message goes to a relay picked in proportion to its recent latency
+    and error rate; on a relay failure it is retried on the next healthiest
+    relay. Failing relays are ejected by a circuit breaker (see relays.py).
+    All relays share EMAIL_HOST_USER/EMAIL_HOST_PASSWORD and the TLS settings.
+    """
+
+    manages_relays = True
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        num_sent = 0
+        with self._lock:
+            for message in email_messages:
+                if self._send_with_failover(message):
+                    num_sent += 1
+        return num_sent
+
+    def _send_with_failover(self, email_message):
+        last_error = None
+        for relay in relays.choose_relays():
+            if not relay.begin_attempt():
+                continue
+            self.host, self.port = relay.host, relay.port
+            started = time.monotonic()
+            try:
+                self._pooled = self.pool.acquire()
+                self.connection = self._pooled.connection
+                sent = self._send(email_message)
+            except PoolExhausted:
+                # The relay was never reached, so it gets neither outcome.
+                relay.cancel_attempt()
+                raise
+            except OSError as e:
+                if not is_relay_failure(e):
+                    relay.record_success(time.monotonic() - started)
+                    raise
+                relay.record_failure()
+                if after_data(e):
+                    # This relay may have delivered it; don't hand it to another.
+                    raise
+                last_error = e
+                continue
+            except BaseException:
+                relay.cancel_attempt()
+                raise
+            finally:
+                self.close()
+            relay.record_success(time.monotonic() - started)
+            return sent
+        if not self.fail_silently:
+            raise last_error or relays.unavailable()
+        return False
+
+
+class SpoolingEmailBackend(PooledEmailBackend):
+    """
+    Pooled backend that spools messages to EMAIL_SPOOL_DIR when the relay
+    can't take them: it is unreachable, drops the connection, gives a 4xx
+    reply or its circuit breaker is open. Spooled messages count as sent
+    and get a ``spool_id`` attribute; replay_spool delivers them later.
+    Permanent (5xx) rejections are raised as usual.
+    """
+
+    manages_relays = True
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        breaker = relays.find_relay(self.host, self.port)
+        was_open = self.connection is not None
+        num_sent = 0
+        with self._lock:
+            try:
+                for message in email_messages:
+                    if not message.recipients():
+                        continue
+                    if breaker is not None and not (breaker.is_available() and breaker.begin_attempt()):
+                        message.spool_id = spool.write(message)
+                        num_sent += 1
+                        continue
+                    started = time.monotonic()
+                    try:
+                        if self.connection is None:
+                            self.open()
+                        sent = self._send(message)
+                    except PoolExhausted:
+                        if breaker is not None:
+                            breaker.cancel_attempt()
+                        raise
+                    except OSError as e:
+                        relay_failure = is_relay_failure(e)
+                        if breaker is not None:
+                            if relay_failure:
+                                breaker.record_failure()
+                            else:
+                                breaker.record_success(time.monotonic() - started)
+                        if not relay_failure:
+                            raise
+                        if self._pooled is not None:
+                            self._pooled.broken = True
+                        self.close()
+                        if after_data(e):
+                            # The relay may have accepted it; a replay from the
+                            # spool could deliver it twice.
+                            raise
+                        message.spool_id = spool.write(message)
+                        num_sent += 1
+                        continue
+                    except BaseException:
+                        if breaker is not None:
+                            breaker.cancel_attempt()
+                        raise
+                    if breaker is not None:
+                        breaker.record_success(time.monotonic() - started)
+                    if sent:
+                        num_sent += 1
+            finally:
+                if not was_open:
+                    self.close()
+        return num_sent
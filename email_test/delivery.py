@@ -0,0 +1,341 @@
+"""
+Retries, circuit breaking and error codes for the send path.
+
+send() and send_async() tell transient failures (4xx replies, dropped or
+refused connections, timeouts) from permanent ones. They retry the
+transient ones with jittered exponential backoff until
+EMAIL_RETRY_DEADLINE seconds have passed. A reply-level failure leaves the
+SMTP session usable, so the retry goes out on the same connection. Only a
+broken session is closed and replaced.
+
+Every attempt that reaches the relay counts towards its circuit breaker
+(relays.py); waiting in vain for a pooled connection does not. While
+the breaker has the relay ejected, sends fail straight away with
+relay_unavailable instead of connecting. Failures come out as
+DeliveryError, which carries a stable ``code`` for API responses in place
+of the raw exception text.
+
+A session that breaks after the relay had the whole message (while
+waiting for the reply to the final dot) is the exception: the relay may
+have accepted it, so it is reported as outcome_unknown and not retried
+(RFC 1047).
+
+The outcome of every message, sent or not, goes to the delivery log
+(deliverylog.py).
+"""
+
+import asyncio
+import random
+import smtplib
+import socket
+import ssl
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import deliverylog, profiles, relays
+from .aiosmtp import send_message_async
+from .backends import is_relay_failure
+from .pool import PoolExhausted
+from .smtp import after_data
+
+# HTTP status for each permanent failure; every transient failure is a 503.
+PERMANENT_STATUS = {
+    'recipient_rejected': 422,
+    'message_rejected': 422,
+    'sender_rejected': 502,
+    'auth_failed': 502,
+    'relay_rejected': 502,
+    'relay_unsupported': 502,
+    'tls_failed': 502,
+    'smtp_error': 502,
+    'outcome_unknown': 502,
+    'internal_error': 500,
+}
+
+# Failures after which the session can't be trusted for the retry.
+RECONNECT_CODES = {'connection_lost', 'connection_failed', 'timeout', 'dns_failed'}
+
+
+class DeliveryError(Exception):
+    def __init__(self, code, message, transient, smtp_code=None, retry_after=None, attempts=1):
+        self.code = code
+        self.message = message
+        self.transient = transient
+        self.smtp_code = smtp_code
+        self.retry_after = retry_after
+        self.attempts = attempts
+        super().__init__(message)
+
+    @property
+    def maybe_sent(self):
+        """Whether the relay may have accepted the message despite the failure."""
+        return self.code == 'outcome_unknown'
+
+    @property
+    def status(self):
+        return 503 if self.transient else PERMANENT_STATUS.get(self.code, 502)
+
+    def as_dict(self):
+        """Fields for an API error response."""
+        result = {
+            'success': False,
+            'error': self.message,
+            'code': self.code,
+            'transient': self.transient,
+            'attempts': self.attempts,
+        }
+        if self.smtp_code is not None:
+            result['smtp_code'] = self.smtp_code
+        if self.retry_after is not None:
+            result['retry_after'] = round(self.retry_after, 3)
+        return result
+
+
+def _reply_text(text):
+    return text.decode(errors='replace') if isinstance(text, bytes) else str(text)
+
+
+def _is_temporary(smtp_code):
+    return 400 <= smtp_code < 500
+
+
+def classify(exc, attempts=1):
+    """Return the DeliveryError describing ``exc``."""
+    if isinstance(exc, DeliveryError):
+        return exc
+    if after_data(exc):
+        return DeliveryError(
+            'outcome_unknown', 'Lost the relay after sending the message; it may have been delivered',
+            False, attempts=attempts,
+        )
+    if isinstance(exc, relays.RelayUnavailable):
+        return DeliveryError('relay_unavailable', str(exc), True, retry_after=exc.retry_after, attempts=attempts)
+    if isinstance(exc, PoolExhausted):
+        return DeliveryError('pool_exhausted', 'No SMTP connection became free in time', True, attempts=attempts)
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = exc.recipients.values()
+        refused = ', '.join(f'{addr} ({code} {_reply_text(text)})' for addr, (code, text) in exc.recipients.items())
+        return DeliveryError(
+            'recipient_rejected',
+            f'Relay refused recipient(s): {refused}',
+            all(_is_temporary(code) for code, _ in replies),
+            smtp_code=max(code for code, _ in replies),
+            attempts=attempts,
+        )
+    if isinstance(exc, smtplib.SMTPResponseException):
+        if isinstance(exc, smtplib.SMTPSenderRefused):
+            code = 'sender_rejected'
+        elif isinstance(exc, smtplib.SMTPDataError):
+            code = 'message_rejected'
+        elif isinstance(exc, smtplib.SMTPAuthenticationError):
+            code = 'auth_failed'
+        else:
+            code = 'relay_rejected'
+        return DeliveryError(
+            code,
+            f'Relay replied {exc.smtp_code} {_reply_text(exc.smtp_error)}',
+            _is_temporary(exc.smtp_code),
+            smtp_code=exc.smtp_code,
+            attempts=attempts,
+        )
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return DeliveryError('connection_lost', 'Relay closed the connection', True, attempts=attempts)
+    if isinstance(exc, smtplib.SMTPNotSupportedError):
+        return DeliveryError('relay_unsupported', str(exc), False, attempts=attempts)
+    if isinstance(exc, smtplib.SMTPException):
+        return DeliveryError('smtp_error', str(exc), False, attempts=attempts)
+    if isinstance(exc, (ssl.SSLError, ssl.CertificateError)):
+        return DeliveryError('tls_failed', f'TLS with the relay failed: {exc}', False, attempts=attempts)
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError)):
+        return DeliveryError('timeout', 'Timed out talking to the relay', True, attempts=attempts)
+    if isinstance(exc, socket.gaierror):
+        return DeliveryError('dns_failed', 'Could not resolve the relay host', True, attempts=attempts)
+    if isinstance(exc, OSError):
+        return DeliveryError('connection_failed', 'Could not connect to the relay', True, attempts=attempts)
+    return DeliveryError('internal_error', 'Internal error while sending email', False, attempts=attempts)
+
+
+def _backoff(attempts):
+    """Full-jitter exponential backoff before retry number ``attempts``."""
+    ceiling = min(settings.EMAIL_RETRY_MAX_DELAY, settings.EMAIL_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(0, ceiling)
+
+
+def _claim(breaker, attempts):
+    """Take a turn on the relay's circuit breaker, or fail fast if it is open."""
+    if breaker is not None and not (breaker.is_available() and breaker.begin_attempt()):
+        raise classify(relays.RelayUnavailable(retry_after=breaker.retry_after()), attempts)
+
+
+def _record(breaker, exc, started):
+    if breaker is None:
+        return
+    if isinstance(exc, PoolExhausted):
+        # No connection was free locally; the relay was never reached.
+        breaker.cancel_attempt()
+    elif exc is not None and is_relay_failure(exc):
+        breaker.record_failure()
+    else:
+        breaker.record_success(time.monotonic() - started)
+
+
+def _cancel(breaker):
+    if breaker is not None:
+        breaker.cancel_attempt()
+
+
+def _retry_delay(error, deadline):
+    """Seconds to wait before retrying ``error``, or None to give up."""
+    if not error.transient or error.code == 'relay_unavailable':
+        return None
+    delay = _backoff(error.attempts)
+    if time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except OSError:
+        # QUIT on a broken session can fail as well; the socket is gone either way.
+        pass
+
+
+def _log(email_messages, started, attempts, relay='', profile='', error=None, reply=None):
+    duration = time.monotonic() - started
+    reply = f'{reply[0]} {_reply_text(reply[1])}' if reply else ''
+    for message in email_messages:
+        if error is not None:
+            status = deliverylog.DeliveryLog.STATUS_FAILED
+        elif hasattr(message, 'spool_id'):
+            status = deliverylog.DeliveryLog.STATUS_SPOOLED
+        else:
+            status = deliverylog.DeliveryLog.STATUS_SENT
+        deliverylog.record(
+            message.recipients(), status, duration,
+            from_email=message.from_email, subject=getattr(message, 'subject', ''),
+            error=error, reply=reply if status == deliverylog.DeliveryLog.STATUS_SENT else '',
+            attempts=attempts, relay=relay, profile=profile,
+        )
+
+
+def _relay(connection):
+    host = getattr(connection, 'host', None)
+    return f'{host}:{connection.port}' if host else ''
+
+
+def send(email_messages, connection=None, profile=None):
+    """
+    Send ``email_messages`` with retries; return the number sent.
+
+    With no ``connection`` a backend for SMTP ``profile`` (or the default
+    backend) is opened and closed here. A caller's connection is left open
+    for further sends. Messages go out one at a time so that a retry
+    resumes at the one that failed instead of repeating those already
+    sent. Raises DeliveryError for SMTP and network failures; anything
+    else (e.g. a bad header) propagates unchanged.
+    """
+    owned = connection is None
+    if owned:
+        connection = profiles.get_connection(profile)
+    profile = getattr(connection, 'profile', None) or ''
+    first_started = time.monotonic()
+    # Backends that manage relays themselves (failover, spooling) get
+    # neither the breaker nor a held session. Non-SMTP backends (console,
+    # locmem) have no session to hold.
+    hold = hasattr(connection, 'connection') and not getattr(connection, 'manages_relays', False)
+    breaker = relays.find_relay(connection.host, connection.port) if hold else None
+    deadline = time.monotonic() + settings.EMAIL_RETRY_DEADLINE
+    pending = list(email_messages)
+    sent = 0
+    attempts = 0
+    try:
+        while True:
+            attempts += 1
+            try:
+                _claim(breaker, attempts)
+            except DeliveryError as e:
+                _log(pending, first_started, attempts, _relay(connection), profile, error=e)
+                raise
+            started = time.monotonic()
+            try:
+                if hold and connection.connection is None:
+                    # Keep the session across retries; send_messages() would
+                    # close a connection it had to open itself.
+                    connection.open()
+                while pending:
+                    sent += connection.send_messages(pending[:1])
+                    reply = getattr(getattr(connection, 'connection', None), 'last_reply', None)
+                    _log(pending[:1], first_started, attempts, _relay(connection), profile, reply=reply)
+                    del pending[0]
+            except (OSError, asyncio.TimeoutError) as e:
+                _record(breaker, e, started)
+                error = classify(e, attempts)
+                delay = _retry_delay(error, deadline)
+                if delay is None:
+                    _log(pending, first_started, attempts, _relay(connection), profile, error=error)
+                    raise error from e
+                if error.code in RECONNECT_CODES:
+                    _close(connection)
+                time.sleep(delay)
+                continue
+            except BaseException as e:
+                # Not the relay's doing; hand back the breaker slot so a
+                # half-open relay isn't left waiting for a probe result.
+                _cancel(breaker)
+                _log(pending, first_started, attempts, _relay(connection), profile, error=classify(e, attempts))
+                raise
+            _record(breaker, None, started)
+            return sent
+    finally:
+        if owned:
+            _close(connection)
+
+
+async def send_async(email_message, profile=None):
+    """
+    send() for the async pool: returns the refused-recipients dict.
+
+    The pool keeps a session whose last reply was an error, so retries
+    reuse it; it replaces dropped sessions itself. The async pool only
+    talks to EMAIL_HOST, so a send for an SMTP ``profile`` runs send() in
+    a thread instead.
+    """
+    if profile:
+        await sync_to_async(send, thread_sensitive=False)([email_message], profile=profile)
+        return {}
+    relay = f'{settings.EMAIL_HOST}:{settings.EMAIL_PORT}'
+    first_started = time.monotonic()
+    breaker = relays.find_relay(settings.EMAIL_HOST, settings.EMAIL_PORT)
+    deadline = time.monotonic() + settings.EMAIL_RETRY_DEADLINE
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            _claim(breaker, attempts)
+        except DeliveryError as e:
+            _log([email_message], first_started, attempts, relay, error=e)
+            raise
+        started = time.monotonic()
+        try:
+            refused = await send_message_async(email_message)
+        except (OSError, asyncio.TimeoutError) as e:
+            _record(breaker, e, started)
+            error = classify(e, attempts)
+            delay = _retry_delay(error, deadline)
+            if delay is None:
+                _log([email_message], first_started, attempts, relay, error=error)
+                raise error from e
+            await asyncio.sleep(delay)
+            continue
+        except BaseException as e:
+            # Includes the request being cancelled mid-send.
+            _cancel(breaker)
+            _log([email_message], first_started, attempts, relay, error=classify(e, attempts))
+            raise
+        _record(breaker, None, started)
+        _log([email_message], first_started, attempts, relay)
+        return refused
@@ -0,0 +1,157 @@
+"""
+Buffered writes of DeliveryLog rows.
+
+record() only appends to this process's buffer, so a send never waits on
+the database. A background thread writes the buffer with one bulk_create
+per flush, in a single transaction, as soon as
+EMAIL_DELIVERY_LOG_BATCH_SIZE rows are waiting or
+EMAIL_DELIVERY_LOG_FLUSH_INTERVAL seconds after the first of them arrived.
+That way many workers sharing SQLite take the write lock once per batch
+rather than once per send. The buffer is flushed at exit as well. Rows
+still unwritten after a crash are lost, which is acceptable for a log.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import DeliveryLog
+
+logger = logging.getLogger(__name__)
+
+_cond = threading.Condition()
+_buffer = []
+_first_at = None
+_dropped = 0
+_flusher = None  # (pid, thread)
+_flush_lock = threading.Lock()
+
+
+def _address(value):
+    """The envelope address in ``value``, without a display name."""
+    value = str(value or '')
+    return (parseaddr(value)[1] or value)[:254]
+
+
+def record(recipients, status, duration, from_email='', subject='', error=None,
+           reply='', attempts=1, relay='', profile=''):
+    """
+    Buffer one row per recipient. ``error`` is the DeliveryError of a
+    failed send; ``duration`` is in seconds, retries included.
+    """
+    if not settings.EMAIL_DELIVERY_LOG:
+        return
+    global _first_at, _dropped
+    now = timezone.now()
+    rows = [
+        DeliveryLog(
+            created_at=now,
+            to_email=_address(to_email),
+            from_email=_address(from_email),
+            subject=str(subject or '')[:255],
+            status=status,
+            code=error.code if error is not None else '',
+            smtp_code=error.smtp_code if error is not None else None,
+            reply=error.message if error is not None else reply,
+            duration_ms=round(duration * 1000, 2),
+            attempts=attempts,
+            relay=relay,
+            profile=profile or '',
+        )
+        for to_email in recipients
+    ]
+    _ensure_flusher()
+    with _cond:
+        room = settings.EMAIL_DELIVERY_LOG_MAX_BUFFER - len(_buffer)
+        if room < len(rows):
+            _dropped += len(rows) - max(room, 0)
+            rows = rows[:max(room, 0)]
+        if rows and not _buffer:
+            # Starts the flusher's EMAIL_DELIVERY_LOG_FLUSH_INTERVAL clock.
+            _first_at = time.monotonic()
+            _cond.notify()
+        _buffer.extend(rows)
+        if len(_buffer) >= settings.EMAIL_DELIVERY_LOG_BATCH_SIZE:
+            _cond.notify()
+
+
+def flush():
+    """Write everything buffered so far; return the number of rows written."""
+    global _first_at, _dropped
+    if _flusher is not None and _flusher[0] != os.getpid():
+        return 0  # Forked before writing; the parent owns those rows.
+    with _flush_lock:
+        with _cond:
+            rows = _buffer[:]
+            _buffer.clear()
+            _first_at = None
+            dropped, _dropped = _dropped, 0
+        if dropped:
+            logger.warning('Delivery log buffer full; dropped %d row(s)', dropped)
+        if not rows:
+            return 0
+        batch_size = settings.EMAIL_DELIVERY_LOG_BATCH_SIZE
+        try:
+            with transaction.atomic():
+                DeliveryLog.objects.bulk_create(rows, batch_size=batch_size)
+        except Exception:
+            logger.exception('Could not write %d delivery log row(s)', len(rows))
+            with _cond:
+                # Keep them for the next flush, within the buffer limit.
+                kept = rows[:max(settings.EMAIL_DELIVERY_LOG_MAX_BUFFER - len(_buffer), 0)]
+                _buffer[:0] = kept
+                _dropped += len(rows) - len(kept)
+                if _buffer and _first_at is None:
+                    _first_at = time.monotonic()
+            return 0
+        return len(rows)
+
+
+def _run_flusher():
+    interval = settings.EMAIL_DELIVERY_LOG_FLUSH_INTERVAL
+    while True:
+        with _cond:
+            while True:
+                if len(_buffer) >= settings.EMAIL_DELIVERY_LOG_BATCH_SIZE:
+                    break
+                if _first_at is not None:
+                    remaining = _first_at + interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    _cond.wait(remaining)
+                else:
+                    _cond.wait()
+        try:
+            flush()
+        finally:
+            # This thread's database connection, like a request's, is
+            # closed or kept according to CONN_MAX_AGE.
+            close_old_connections()
+
+
+def _ensure_flusher():
+    """Start this process's flusher thread (again after a fork)."""
+    global _flusher, _first_at
+    if _flusher is not None and _flusher[0] == os.getpid():
+        return
+    with _flush_lock:
+        if _flusher is not None and _flusher[0] == os.getpid():
+            return
+        if _flusher is not None:
+            # Forked: the parent's rows are the parent's to write.
+            with _cond:
+                _buffer.clear()
+                _first_at = None
+        thread = threading.Thread(target=_run_flusher, name='delivery-log-flusher', daemon=True)
+        thread.start()
+        _flusher = (os.getpid(), thread)
+
+
+atexit.register(flush)
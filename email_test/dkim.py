@@ -0,0 +1,260 @@
+"""
+DKIM signing (RFC 6376) of outgoing messages, relaxed/relaxed.
+
+The private key in EMAIL_DKIM_PRIVATE_KEY_FILE is loaded once per process
+(and again only when the file changes), and a Signer keeps everything
+that is the same for every message: the key, the v=/a=/c=/d=/s= tags and
+the h= list for each set of headers seen. Signing a message is then one
+pass over the body for bh=, canonicalizing the few signed headers, and
+one private-key operation. RSA keys sign with rsa-sha256 and Ed25519 keys
+with ed25519-sha256 (RFC 8463).
+
+The signature covers the bytes that go over the wire, so messages are
+signed after wire.serialize(). A signed 8bit message that has to be
+re-encoded for a relay without 8BITMIME is signed again (see
+wire.to_7bit()). sign_batch() signs many messages at once in a process
+pool, for the bulk send paths.
+"""
+
+import base64
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+HEADER_NAME = b'DKIM-Signature'
+
+# Whitespace that relaxed canonicalization changes: tabs and runs of spaces.
+_WSP_RUN = re.compile(rb'\t[ \t]*| [ \t]+')
+_FOLD = re.compile(rb'\r\n(?=[ \t])')
+
+_lock = threading.Lock()
+_signer = None  # (version, Signer)
+
+
+def _canonical_body(body):
+    """Relaxed body canonicalization (RFC 6376 3.4.4)."""
+    if b'\t' in body or b'  ' in body:
+        # Most bodies have neither; the substring checks are much cheaper.
+        body = _WSP_RUN.sub(b' ', body)
+    body = body.replace(b' \r\n', b'\r\n')
+    # Trailing blank lines and trailing spaces of the last line both go.
+    body = body.rstrip(b' \r\n')
+    return body + b'\r\n' if body else b''
+
+
+def _body_hash(chunks):
+    """
+    SHA-256 of the relaxed canonical body given as CRLF-terminated
+    ``chunks``, without joining them: each chunk is canonicalized on its
+    own, and trailing blank lines are held back until text follows them.
+    """
+    digest = hashlib.sha256()
+    blank = b''
+    empty = True
+    for chunk in chunks:
+        if b'\t' in chunk or b'  ' in chunk:
+            chunk = _WSP_RUN.sub(b' ', chunk)
+        chunk = chunk.replace(b' \r\n', b'\r\n')
+        text = chunk.rstrip(b'\r\n')
+        if text:
+            digest.update(blank + text)
+            blank = chunk[len(text):]
+            empty = False
+        else:
+            blank += chunk
+    if not empty:
+        # The body ends with exactly one CRLF, unless it is empty.
+        digest.update(b'\r\n')
+    return digest.digest()
+
+
+def _canonical_header(name, value):
+    """Relaxed header canonicalization (RFC 6376 3.4.2), CRLF not included."""
+    value = _WSP_RUN.sub(b' ', _FOLD.sub(b'', value)).strip(b' ')
+    return name.lower().strip() + b':' + value
+
+
+def _split_headers(head):
+    """[(name, value)] of the header block ``head``, folding kept."""
+    headers = []
+    for line in head.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t') and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, value + b'\r\n' + line)
+        elif line:
+            name, _, value = line.partition(b':')
+            headers.append((name, value))
+    return headers
+
+
+def _header_end(data):
+    """Offset just past the first header field of ``data``, continuation lines included."""
+    end = data.find(b'\r\n')
+    while end >= 0 and data[end + 2:end + 3] in (b' ', b'\t'):
+        end = data.find(b'\r\n', end + 2)
+    return len(data) if end < 0 else end + 2
+
+
+class Signer:
+    """Signs messages for one domain, selector and private key."""
+
+    def __init__(self, domain, selector, key, headers):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+
+        if isinstance(key, rsa.RSAPrivateKey):
+            algorithm = 'rsa-sha256'
+            self._sign_args = (padding.PKCS1v15(), hashes.SHA256())
+        elif isinstance(key, ed25519.Ed25519PrivateKey):
+            algorithm = 'ed25519-sha256'
+        else:
+            raise ImproperlyConfigured('DKIM keys must be RSA or Ed25519')
+        self.domain = domain
+        self.selector = selector
+        self.algorithm = algorithm
+        self._key = key
+        self._headers = {name.strip().lower().encode('ascii') for name in headers if name.strip()}
+        self._tags = f'v=1; a={algorithm}; c=relaxed/relaxed; d={domain}; s={selector}; '.encode('ascii')
+        # Every signature this signer writes starts with these bytes.
+        self._marker = HEADER_NAME + b': ' + self._tags.replace(b'; ', b';\r\n\t')
+        self._h_tags = {}
+
+    def _sign_bytes(self, data):
+        if self.algorithm == 'rsa-sha256':
+            return self._key.sign(data, *self._sign_args)
+        # RFC 8463: Ed25519 signs the SHA-256 hash of the data.
+        return self._key.sign(hashlib.sha256(data).digest())
+
+    def sign(self, data):
+        """Return ``data`` (a CRLF message) with a DKIM-Signature header prepended."""
+        if not data.endswith(b'\r\n'):
+            # Sign what goes over the wire: DATA always ends with a CRLF.
+            data += b'\r\n'
+        head, sep, body = data.partition(b'\r\n\r\n')
+        if not sep:
+            head, body = data.rstrip(b'\r\n'), b''
+        return self._signature(head, hashlib.sha256(_canonical_body(body)).digest()) + data
+
+    def sign_stream(self, head, chunks):
+        """
+        The DKIM-Signature header (CRLF included) for a message with header
+        block ``head`` and a body given as CRLF-terminated ``chunks``.
+        """
+        return self._signature(head, _body_hash(chunks))
+
+    def _signature(self, head, body_hash):
+        # RFC 6376 5.4.2: repeated headers are signed from the bottom up.
+        selected = [(name, value) for name, value in reversed(_split_headers(head))
+                    if name.strip().lower() in self._headers]
+        names = tuple(name.strip().lower() for name, _ in selected)
+        h_tag = self._h_tags.get(names)
+        if h_tag is None:
+            h_tag = self._h_tags[names] = b'h=' + b':'.join(names) + b'; '
+        value = self._tags + h_tag + b'bh=' + base64.b64encode(body_hash) + b'; b='
+        signed = b''.join(_canonical_header(name, value) + b'\r\n' for name, value in selected)
+        signed += _canonical_header(HEADER_NAME, value)
+        signature = base64.b64encode(self._sign_bytes(signed))
+
+        # Fold after each tag and every 76 characters of b=; relaxed
+        # canonicalization undoes the former, verifiers ignore the latter.
+        lines = [signature[i:i + 76] for i in range(0, len(signature), 76)]
+        return HEADER_NAME + b': ' + value.replace(b'; ', b';\r\n\t') + b'\r\n\t'.join(lines) + b'\r\n'
+
+    def signed(self, data):
+        """Whether ``data`` starts with a signature from this signer."""
+        return data.startswith(self._marker)
+
+    def unsign(self, data):
+        """``data`` without the signature this signer put in front of it."""
+        return data[_header_end(data):] if self.signed(data) else data
+
+
+def _load_signer():
+    # Imported here to keep cryptography off the startup path when DKIM is off.
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    path = settings.EMAIL_DKIM_PRIVATE_KEY_FILE
+    try:
+        with open(path, 'rb') as f:
+            key = load_pem_private_key(f.read(), password=None)
+    except (OSError, ValueError, TypeError) as e:
+        raise ImproperlyConfigured(f'Cannot load the DKIM key {path}: {e}') from e
+    return Signer(settings.EMAIL_DKIM_DOMAIN, settings.EMAIL_DKIM_SELECTOR, key, settings.EMAIL_DKIM_HEADERS)
+
+
+def get_signer():
+    """This process's Signer, or None when DKIM signing is not configured."""
+    global _signer
+    path = settings.EMAIL_DKIM_PRIVATE_KEY_FILE
+    if not (path and settings.EMAIL_DKIM_DOMAIN and settings.EMAIL_DKIM_SELECTOR):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise ImproperlyConfigured(f'Cannot load the DKIM key {path}: {e}') from e
+    version = (path, stat.st_mtime_ns, stat.st_size, settings.EMAIL_DKIM_DOMAIN,
+               settings.EMAIL_DKIM_SELECTOR, tuple(settings.EMAIL_DKIM_HEADERS))
+    entry = _signer
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _lock:
+        if _signer is None or _signer[0] != version:
+            _signer = (version, _load_signer())
+        return _signer[1]
+
+
+def sign(data):
+    """
+    ``data`` signed with this process's Signer; unchanged if DKIM is off
+    or the Signer has signed it already (e.g. in a render worker).
+    """
+    signer = get_signer()
+    if signer is None or signer.signed(data):
+        return data
+    started = time.perf_counter()
+    data = signer.sign(data)
+    metrics.observe('sign', time.perf_counter() - started)
+    return data
+
+
+def signature(head, chunks):
+    """
+    The DKIM-Signature header for a streamed message (see
+    Signer.sign_stream()), or b'' if DKIM is off.
+    """
+    signer = get_signer()
+    if signer is None:
+        return b''
+    started = time.perf_counter()
+    header = signer.sign_stream(head, chunks)
+    metrics.observe('sign', time.perf_counter() - started)
+    return header
+
+
+def sign_chunk(datas):
+    """sign() each of ``datas``; runs in a worker process."""
+    return [sign(data) for data in datas]
+
+
+def sign_batch(datas, executor=None):
+    """
+    sign() each of ``datas``, spread over ``executor``'s worker processes
+    when there is one and the batch has at least two messages per worker.
+    """
+    datas = list(datas)
+    if get_signer() is None:
+        return datas
+    workers = settings.EMAIL_MERGE_PROCESSES or os.cpu_count() or 1
+    if executor is None or len(datas) < 2 * workers:
+        return sign_chunk(datas)
+    size = math.ceil(len(datas) / workers)
+    chunks = [datas[i:i + size] for i in range(0, len(datas), size)]
+    return [data for signed in executor.map(sign_chunk, chunks) for data in signed]
@@ -0,0 +1,216 @@
+"""
+Background SMTP health checks for /api/email/status/.
+
+A daemon thread in each worker keeps a snapshot file (EMAIL_HEALTH_FILE)
+fresh: every EMAIL_HEALTH_CHECK_INTERVAL seconds one worker (whichever
+gets the lock first) connects to each relay, runs EHLO, STARTTLS and
+optionally AUTH, and records latencies, the advertised extensions and the
+certificate expiry. Requests only read the snapshot, which is parsed and
+given an ETag once per change, so polling costs a stat() call.
+
+As in probe.py, the TLS handshake itself doesn't verify the certificate,
+so the expiry is reported for an invalid or expired certificate too; the
+chain is verified before anything else (AUTH in particular) is sent.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import smtplib
+import ssl
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from . import probe, relays, transport
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+DEGRADED = 'degraded'
+DOWN = 'down'
+UNKNOWN = 'unknown'
+
+_lock = threading.Lock()
+_prober_pid = None
+_cached = None
+
+
+def relay_targets():
+    """(host, port) for every relay to check."""
+    if settings.EMAIL_HOSTS:
+        return [relays.parse_relay(value, settings.EMAIL_PORT) for value in settings.EMAIL_HOSTS]
+    return [(settings.EMAIL_HOST, settings.EMAIL_PORT)]
+
+
+def probe_relay(host, port):
+    """
+    Check one relay; never raises. Uses plain smtplib with full TLS
+    handshakes so probes neither show up in the send metrics nor report a
+    certificate remembered from a resumed session. A certificate that
+    fails verification makes the relay not ok, with its expiry still set.
+    """
+    result = {'host': host, 'port': port, 'ok': False, 'latency_ms': {}}
+    timings = result['latency_ms']
+    started = phase_start = time.perf_counter()
+
+    def mark(phase):
+        nonlocal phase_start
+        now = time.perf_counter()
+        timings[phase] = round((now - phase_start) * 1000, 2)
+        phase_start = now
+
+    timeout = settings.EMAIL_HEALTH_CHECK_TIMEOUT
+    context = transport.get_ssl_context(verify=False)
+    smtp = None
+    try:
+        # "connect" covers DNS, TCP, implicit TLS if any, and the greeting.
+        if settings.EMAIL_USE_SSL:
+            smtp = smtplib.SMTP_SSL(host, port, timeout=timeout, context=context)
+        else:
+            smtp = smtplib.SMTP(host, port, timeout=timeout)
+        mark('connect')
+        smtp.ehlo()
+        mark('ehlo')
+        if settings.EMAIL_USE_TLS and not settings.EMAIL_USE_SSL:
+            smtp.starttls(context=context)
+            smtp.ehlo()
+            mark('starttls')
+        result['capabilities'] = sorted(
+            ' '.join([name.upper(), *params.split()]) for name, params in smtp.esmtp_features.items()
+        )
+        if isinstance(smtp.sock, ssl.SSLSocket):
+            result['tls_version'] = smtp.sock.version()
+            chain = probe._peer_chain(smtp.sock)
+            cert = probe.describe_certificate(chain[0], host)
+            if 'not_after' in cert:
+                result['cert_not_after'] = cert['not_after']
+                result['cert_days_remaining'] = cert['days_until_expiry']
+            verify_error = probe.verify_chain(chain, host)
+            if verify_error is not None:
+                raise probe.ProbeError(f'Certificate verification failed: {verify_error}')
+        if settings.EMAIL_HEALTH_CHECK_AUTH and settings.EMAIL_HOST_USER and settings.EMAIL_HOST_PASSWORD:
+            smtp.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
+            mark('auth')
+        smtp.quit()
+        smtp = None
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        if smtp is not None:
+            smtp.close()
+        timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+
+def run_checks():
+    """Probe every relay and return a snapshot dict."""
+    results = [probe_relay(host, port) for host, port in relay_targets()]
+    healthy = sum(r['ok'] for r in results)
+    if healthy == len(results):
+        status = OK
+    elif healthy:
+        status = DEGRADED
+    else:
+        status = DOWN
+    return {
+        'status': status,
+        'checked_at': datetime.now(timezone.utc).isoformat(),
+        'interval': settings.EMAIL_HEALTH_CHECK_INTERVAL,
+        'relays': results,
+    }
+
+
+def _age(path):
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return float('inf')
+
+
+def refresh():
+    """
+    Re-run the checks if the snapshot is due and no other worker is doing
+    so; return the seconds until the next check is due.
+    """
+    path = settings.EMAIL_HEALTH_FILE
+    interval = settings.EMAIL_HEALTH_CHECK_INTERVAL
+    if _age(path) < interval:
+        return interval - _age(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return interval
+        if _age(path) < interval:
+            return interval - _age(path)
+        snapshot = run_checks()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+        return interval
+    finally:
+        os.close(fd)
+
+
+def _run_prober():
+    while True:
+        try:
+            wait = refresh()
+        except Exception:
+            logger.exception('SMTP health check failed')
+            wait = settings.EMAIL_HEALTH_CHECK_INTERVAL
+        # Jitter so workers don't all wake at the same moment.
+        time.sleep(max(1.0, wait) + random.uniform(0, 1))
+
+
+def ensure_prober():
+    """Start this process's prober thread if it isn't running (e.g. after a fork)."""
+    global _prober_pid
+    pid = os.getpid()
+    if _prober_pid != pid:
+        with _lock:
+            if _prober_pid != pid:
+                threading.Thread(target=_run_prober, name='smtp-health-prober', daemon=True).start()
+                _prober_pid = pid
+
+
+class Snapshot:
+    """A parsed snapshot with its response body and ETag, built once per file change."""
+
+    def __init__(self, content, version):
+        self.version = version
+        self.data = json.loads(content)
+        self.status = self.data['status']
+        self.body = json.dumps({'success': True, **self.data}).encode()
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.checked_at = datetime.fromisoformat(self.data['checked_at']).timestamp()
+
+    def max_age(self):
+        """Seconds until the next check is due, for Cache-Control."""
+        return max(0, int(self.checked_at + self.data['interval'] - time.time()))
+
+
+def get_snapshot():
+    """The latest snapshot, or None before the first check has finished."""
+    global _cached
+    path = settings.EMAIL_HEALTH_FILE
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _cached
+    if cached is None or cached.version != version:
+        with open(path) as f:
+            cached = _cached = Snapshot(f.read(), version)
+    return cached
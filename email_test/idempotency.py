@@ -0,0 +1,193 @@
+"""
+Idempotency-Key support for the send endpoints.
+
+The first request with a given key claims it in the shared "idempotency"
+cache (a database cache by default, so every worker sees it), runs the
+view and stores the response for EMAIL_IDEMPOTENCY_TTL seconds. Retries
+with the same key get the stored response back without sending again. A
+retry that arrives while the first request is still sending waits for its
+result, for up to EMAIL_IDEMPOTENCY_WAIT seconds, and gets 409 if it is
+still running after that.
+
+Reusing a key with a different request body returns 422. Responses that
+mean nothing was sent (429 and 5xx) are not stored, so the client can
+retry with the same key. A failure that may have sent the message anyway
+(the view sets ``maybe_sent`` on the response, see delivery.py) is
+stored like a success, so a retry can't send it a second time.
+"""
+
+import asyncio
+import functools
+import hashlib
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+def _cache():
+    return caches['idempotency']
+
+
+def _cache_key(request, key):
+    return 'idem:' + hashlib.sha256(f'{request.path}\n{key}'.encode()).hexdigest()
+
+
+def _fingerprint(request):
+    return hashlib.sha256(request.body).hexdigest()
+
+
+def _should_store(response):
+    if getattr(response, 'maybe_sent', False):
+        return True
+    return response.status_code < 500 and response.status_code != 429
+
+
+def _stored(response, fingerprint):
+    return {
+        'state': DONE,
+        'fingerprint': fingerprint,
+        'status': response.status_code,
+        'content_type': response['Content-Type'],
+        'headers': {name: response[name] for name in ('Retry-After',) if response.has_header(name)},
+        'content': response.content,
+    }
+
+
+def _existing(entry, fingerprint):
+    """Response for a key another request has claimed, or None to keep waiting."""
+    if entry is None:
+        return None
+    if entry['fingerprint'] != fingerprint:
+        return JsonResponse({
+            'success': False,
+            'error': f'{HEADER} was already used with a different request body'
+        }, status=422)
+    if entry['state'] != DONE:
+        return None
+    response = HttpResponse(entry['content'], status=entry['status'], content_type=entry['content_type'])
+    for name, value in entry['headers'].items():
+        response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _bad_key():
+    return JsonResponse({
+        'success': False,
+        'error': f'{HEADER} must be 1-{MAX_KEY_LENGTH} characters'
+    }, status=400)
+
+
+def _in_progress():
+    return JsonResponse({
+        'success': False,
+        'error': f'A request with this {HEADER} is still in progress'
+    }, status=409)
+
+
+def _poll_delays():
+    """Sleep intervals while waiting on an in-flight duplicate: 10ms doubling to 200ms."""
+    deadline = time.monotonic() + settings.EMAIL_IDEMPOTENCY_WAIT
+    delay = 0.01
+    while time.monotonic() < deadline:
+        yield min(delay, max(0.0, deadline - time.monotonic()))
+        delay = min(delay * 2, 0.2)
+
+
+class _Claim:
+    """
+    One keyed request's claim on its cache entry. The sync and async
+    wrappers differ only in how they call the cache and sleep.
+    """
+
+    def __init__(self, request, key):
+        self.cache = _cache()
+        self.key = _cache_key(request, key)
+        self.fingerprint = _fingerprint(request)
+        # add() is atomic, so exactly one request claims the key; the claim
+        # expires after EMAIL_IDEMPOTENCY_LOCK_TIMEOUT in case its worker
+        # dies mid-send.
+        self.pending = {'state': PENDING, 'fingerprint': self.fingerprint}
+        self.timeout = settings.EMAIL_IDEMPOTENCY_LOCK_TIMEOUT
+        self._delays = _poll_delays()
+
+    def taken(self, entry):
+        """
+        (response, None) to answer with, or (None, seconds to sleep) before
+        trying to claim the key again.
+        """
+        existing = _existing(entry, self.fingerprint)
+        if existing is not None:
+            return existing, None
+        delay = next(self._delays, None)
+        if delay is None:
+            return _in_progress(), None
+        return None, delay
+
+    def result(self, response):
+        """The entry to store for ``response``, or None to release the key."""
+        return _stored(response, self.fingerprint) if _should_store(response) else None
+
+
+def idempotent(view):
+    """Make a POST view honour the Idempotency-Key header (sync or async views)."""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return await view(request, *args, **kwargs)
+            if not 0 < len(key) <= MAX_KEY_LENGTH:
+                return _bad_key()
+            claim = _Claim(request, key)
+            while not await claim.cache.aadd(claim.key, claim.pending, claim.timeout):
+                response, delay = claim.taken(await claim.cache.aget(claim.key))
+                if response is not None:
+                    return response
+                await asyncio.sleep(delay)
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                await claim.cache.adelete(claim.key)
+                raise
+            entry = claim.result(response)
+            if entry is None:
+                await claim.cache.adelete(claim.key)
+            else:
+                await claim.cache.aset(claim.key, entry, settings.EMAIL_IDEMPOTENCY_TTL)
+            return response
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return view(request, *args, **kwargs)
+            if not 0 < len(key) <= MAX_KEY_LENGTH:
+                return _bad_key()
+            claim = _Claim(request, key)
+            while not claim.cache.add(claim.key, claim.pending, claim.timeout):
+                response, delay = claim.taken(claim.cache.get(claim.key))
+                if response is not None:
+                    return response
+                time.sleep(delay)
+            try:
+                response = view(request, *args, **kwargs)
+            except BaseException:
+                claim.cache.delete(claim.key)
+                raise
+            entry = claim.result(response)
+            if entry is None:
+                claim.cache.delete(claim.key)
+            else:
+                claim.cache.set(claim.key, entry, settings.EMAIL_IDEMPOTENCY_TTL)
+            return response
+    return wrapper
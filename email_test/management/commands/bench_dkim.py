@@ -0,0 +1,141 @@
+import json
+import os
+import platform
+import tempfile
+import time
+
+import cryptography
+import django
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from email_test import dkim, merge, wire
+
+# Mixed Latin/Cyrillic/CJK text for --body-text utf8.
+UTF8_SAMPLE = 'Grüße aus Zürich, привет из Москвы, 東京からこんにちは. '
+
+
+def make_key(key_type, key_size):
+    """PEM bytes of a throwaway private key."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if key_type == 'rsa':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+
+
+class Command(BaseCommand):
+    help = 'Benchmark DKIM signing (signatures per second, per core) and print JSON results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Messages to sign per run')
+        parser.add_argument('--key-type', choices=['rsa', 'ed25519'], default='rsa', help='Throwaway key type')
+        parser.add_argument('--key-size', type=int, default=2048, help='RSA key size in bits')
+        parser.add_argument('--body-size', type=int, default=2048, help='Message body size in characters')
+        parser.add_argument(
+            '--body-text',
+            choices=['ascii', 'utf8'],
+            default='ascii',
+            help='Fill the body with ASCII or with non-ASCII (Latin, Cyrillic, CJK) text'
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=0,
+            help='Render processes for the batch run (0 = EMAIL_MERGE_PROCESSES, or one per CPU)'
+        )
+
+    def handle(self, *args, **options):
+        key_file = tempfile.NamedTemporaryFile(suffix='.pem', delete=False)
+        with key_file:
+            key_file.write(make_key(options['key_type'], options['key_size']))
+        processes = options['processes'] or settings.EMAIL_MERGE_PROCESSES or os.cpu_count()
+        overrides = {
+            'EMAIL_DKIM_DOMAIN': 'example.com',
+            'EMAIL_DKIM_SELECTOR': 'bench',
+            'EMAIL_DKIM_PRIVATE_KEY_FILE': key_file.name,
+            'EMAIL_MERGE_PROCESSES': processes,
+        }
+        # The render processes read their settings from the environment.
+        os.environ.update({name: str(value) for name, value in overrides.items()})
+
+        fill = 'x' * 75 if options['body_text'] == 'ascii' else (UTF8_SAMPLE * 2)[:75]
+        body = (fill + '\n') * (options['body_size'] // 76) + fill[:options['body_size'] % 76]
+        count = options['messages']
+        try:
+            with override_settings(**overrides):
+                datas = [
+                    wire.serialize(
+                        EmailMessage(f'Bench {i}', body, 'bench@example.com', [f'bench{i}@example.com']),
+                        eightbit=True, sign=False,
+                    )
+                    for i in range(count)
+                ]
+                runs = {
+                    'key_per_message': self.run_key_per_message(datas[:max(1, count // 10)]),
+                    'cached_signer': self.run_cached(datas),
+                    'process_pool': self.run_pool(datas, processes),
+                }
+                signed = dkim.sign(datas[0])
+        finally:
+            os.unlink(key_file.name)
+
+        result = {
+            'key_type': options['key_type'],
+            'key_size': options['key_size'] if options['key_type'] == 'rsa' else None,
+            'messages': count,
+            'body_size': options['body_size'],
+            'body_text': options['body_text'],
+            'message_bytes': len(datas[0]),
+            'signature_header_bytes': len(signed) - len(datas[0]),
+            'processes': processes,
+            'cpu_count': os.cpu_count(),
+            'runs': runs,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'cryptography': cryptography.__version__,
+        }
+        self.stdout.write(json.dumps(result, indent=2))
+
+    def rate(self, signed, elapsed, cores=1):
+        per_second = signed / elapsed if elapsed else None
+        return {
+            'signed': signed,
+            'elapsed_s': round(elapsed, 3),
+            'per_second': round(per_second, 1) if per_second else None,
+            'per_second_per_core': round(per_second / cores, 1) if per_second else None,
+            'us_per_signature': round(elapsed / signed * 1e6, 1) if signed else None,
+        }
+
+    def run_key_per_message(self, datas):
+        """The naive way: parse the key and set up a signer for every message."""
+        started = time.perf_counter()
+        for data in datas:
+            dkim._load_signer().sign(data)
+        return self.rate(len(datas), time.perf_counter() - started)
+
+    def run_cached(self, datas):
+        """dkim.sign() in this process, with the per-process Signer."""
+        dkim.sign(datas[0])
+        started = time.perf_counter()
+        for data in datas:
+            dkim.sign(data)
+        return self.rate(len(datas), time.perf_counter() - started)
+
+    def run_pool(self, datas, processes):
+        """dkim.sign_batch() across the render processes, in EMAIL_DKIM_BATCH_SIZE batches."""
+        pool = merge.get_render_pool()
+        # Start the workers (and load their keys) before timing.
+        dkim.sign_batch(datas[:2 * processes] * 2, pool)
+        batch_size = max(settings.EMAIL_DKIM_BATCH_SIZE, 2 * processes)
+        started = time.perf_counter()
+        for i in range(0, len(datas), batch_size):
+            dkim.sign_batch(datas[i:i + batch_size], pool)
+        return self.rate(len(datas), time.perf_counter() - started, processes)
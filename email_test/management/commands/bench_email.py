@@ -0,0 +1,358 @@
+import asyncio
+import http.client
+import io
+import itertools
+import json
+import os
+import platform
+import resource
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.mail import EmailMessage, send_mail
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from email_test import aiosmtp, metrics
+from email_test.sink import SMTPSink
+
+MODES = ['send_mail', 'message', 'view', 'html-view', 'async-view', 'url', 'attachment']
+
+# Mixed Latin/Cyrillic/CJK text for --body-text utf8.
+UTF8_SAMPLE = 'Grüße aus Zürich, привет из Москвы, 東京からこんにちは. '
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the send path against a local SMTP sink and print JSON results'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode',
+            choices=MODES,
+            default='send_mail',
+            help='send_mail(), EmailMessage.send(), the send/ view through the test '
+                 'client, the send-html/ view, the async/send/ view, a running server at '
+                 '--url, or the send-attachments/ view (through the test client, or '
+                 'streamed to --url)'
+        )
+        parser.add_argument('--messages', type=int, default=1000, help='Messages to send')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent senders')
+        parser.add_argument(
+            '--backend',
+            type=str,
+            default=None,
+            help='EMAIL_BACKEND to benchmark (defaults to the EMAIL_BACKEND setting)'
+        )
+        parser.add_argument('--body-size', type=int, default=1024, help='Message body size in characters')
+        parser.add_argument(
+            '--body-text',
+            choices=['ascii', 'utf8'],
+            default='ascii',
+            help='Fill the body with ASCII or with non-ASCII (Latin, Cyrillic, CJK) text'
+        )
+        parser.add_argument(
+            '--recipients',
+            type=int,
+            default=1,
+            help='Recipients per message for --mode send_mail/message'
+        )
+        parser.add_argument(
+            '--attachment-size',
+            type=int,
+            default=10 * 1024 * 1024,
+            help='Attachment size in bytes for --mode attachment'
+        )
+        parser.add_argument('--latency-ms', type=float, default=0.0, help='Sink round-trip delay before each reply the client waits for')
+        parser.add_argument('--starttls', action='store_true', help='Require STARTTLS with a certificate from a throwaway CA')
+        parser.add_argument('--temp-fail-rate', type=float, default=0.0, help='Fraction of RCPTs answered 451')
+        parser.add_argument('--perm-fail-rate', type=float, default=0.0, help='Fraction of RCPTs answered 550')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for injected failures')
+        parser.add_argument(
+            '--sink-disable',
+            type=str,
+            default='',
+            help='Comma-separated EHLO extensions the sink should not offer, e.g. '
+                 'PIPELINING,8BITMIME to compare with a plain relay'
+        )
+        parser.add_argument(
+            '--url',
+            type=str,
+            default=None,
+            help='Base URL of a running server for --mode url; start it with EMAIL_HOST/'
+                 'EMAIL_PORT pointing at the sink (see --sink-port)'
+        )
+        parser.add_argument('--sink-port', type=int, default=0, help='Port for the sink (0 = any free port)')
+
+    def handle(self, *args, **options):
+        mode = options['mode']
+        if mode == 'url' and not options['url']:
+            raise CommandError('--mode url requires --url')
+
+        sink = SMTPSink(
+            port=options['sink_port'],
+            latency=options['latency_ms'] / 1000,
+            starttls=options['starttls'],
+            temp_fail_rate=options['temp_fail_rate'],
+            perm_fail_rate=options['perm_fail_rate'],
+            seed=options['seed'],
+            disable=[name.strip() for name in options['sink_disable'].split(',') if name.strip()],
+        )
+        host, port = sink.start()
+        self.stderr.write(f'SMTP sink listening on {host}:{port}')
+        if sink.cert_path:
+            # Make the default TLS context trust the sink's certificate.
+            os.environ['SSL_CERT_FILE'] = sink.cert_path
+
+        backend = options['backend'] or settings.EMAIL_BACKEND
+        overrides = {
+            'EMAIL_BACKEND': backend,
+            'EMAIL_HOST': 'localhost' if options['starttls'] else host,
+            'EMAIL_PORT': port,
+            'EMAIL_USE_TLS': options['starttls'],
+            'EMAIL_USE_SSL': False,
+            'EMAIL_HOST_USER': 'bench',
+            'EMAIL_HOST_PASSWORD': 'bench',
+            'EMAIL_HOSTS': [],
+            'EMAIL_SEND_MODE': 'direct',
+            'ALLOWED_HOSTS': ['*'],
+        }
+        fill = 'x' * 75 if options['body_text'] == 'ascii' else (UTF8_SAMPLE * 2)[:75]
+        body = (fill + '\n') * (options['body_size'] // 76) + fill[:options['body_size'] % 76]
+        phases_before = metrics.phase_totals()
+        try:
+            with override_settings(**overrides):
+                if mode == 'async-view':
+                    latencies, errors, elapsed = asyncio.run(
+                        self.run_async(options['messages'], options['concurrency'], body)
+                    )
+                else:
+                    send_one = self.make_sender(
+                        mode, body, options['url'], options['attachment_size'], options['recipients']
+                    )
+                    latencies, errors, elapsed = self.run_threads(
+                        send_one, options['messages'], options['concurrency']
+                    )
+        finally:
+            sink.stop()
+
+        latencies.sort()
+        # Mean milliseconds per message spent in each phase in this process
+        # (nothing for --mode url, where the server does the sending).
+        phases_ms = {}
+        for phase, (count, seconds) in metrics.phase_totals().items():
+            count -= phases_before[phase][0]
+            seconds -= phases_before[phase][1]
+            if count and phase in ('encode', 'sign', 'mail', 'rcpt', 'data', 'send'):
+                phases_ms[phase] = round(seconds * 1000 / options['messages'], 4)
+
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        result = {
+            'mode': mode,
+            'backend': backend if mode != 'url' else None,
+            'messages': options['messages'],
+            'concurrency': options['concurrency'],
+            'body_size': options['body_size'],
+            'body_text': options['body_text'],
+            'recipients': options['recipients'] if mode in ('send_mail', 'message') else 1,
+            'attachment_size': options['attachment_size'] if mode == 'attachment' else None,
+            'sink': {
+                'latency_ms': options['latency_ms'],
+                'starttls': options['starttls'],
+                'temp_fail_rate': options['temp_fail_rate'],
+                'perm_fail_rate': options['perm_fail_rate'],
+                'disabled_extensions': sorted(sink.disable),
+                **sink.stats,
+                'bytes_per_message': round(sink.stats['bytes'] / sink.stats['messages'], 1)
+                if sink.stats['messages'] else None,
+            },
+            'phases_ms_per_message': phases_ms,
+            'sent': len(latencies),
+            'failed': sum(errors.values()),
+            'errors': dict(errors),
+            'elapsed_s': round(elapsed, 3),
+            'msgs_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': ms(percentile(latencies, 50)),
+                'p95': ms(percentile(latencies, 95)),
+                'p99': ms(percentile(latencies, 99)),
+                'max': ms(latencies[-1] if latencies else None),
+                'mean': ms(sum(latencies) / len(latencies) if latencies else None),
+            },
+            # ru_maxrss is in KiB on Linux. With --url this is the client only;
+            # watch the server workers' RSS separately.
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        }
+        self.stdout.write(json.dumps(result, indent=2))
+
+    def make_sender(self, mode, body, url, attachment_size, recipients=1):
+        """Return a callable(i) that sends message ``i`` and raises on failure."""
+
+        def to(i):
+            return [f'bench{i}-{n}@example.com' if n else f'bench{i}@example.com' for n in range(recipients)]
+
+        if mode == 'attachment' and url:
+            def send_one(i):
+                post_streamed_attachment(
+                    url.rstrip('/') + '/api/email/send-attachments/',
+                    {'to_email': f'bench{i}@example.com', 'subject': f'Bench {i}', 'message': body},
+                    attachment_size,
+                )
+        elif mode == 'attachment':
+            local = threading.local()
+            payload = os.urandom(attachment_size)
+
+            def send_one(i):
+                if not hasattr(local, 'client'):
+                    local.client = Client()
+                attachment = io.BytesIO(payload)
+                attachment.name = 'bench.bin'
+                response = local.client.post('/api/email/send-attachments/', {
+                    'to_email': f'bench{i}@example.com', 'subject': f'Bench {i}', 'message': body,
+                    'attachment': attachment,
+                })
+                if response.status_code != 200:
+                    raise RuntimeError(f'HTTP {response.status_code}')
+        elif mode == 'send_mail':
+            def send_one(i):
+                send_mail(f'Bench {i}', body, settings.DEFAULT_FROM_EMAIL, to(i))
+        elif mode == 'message':
+            def send_one(i):
+                email = EmailMessage(f'Bench {i}', f'<p>{body}</p>', settings.DEFAULT_FROM_EMAIL, to(i))
+                email.content_subtype = 'html'
+                email.send()
+        elif mode in ('view', 'html-view'):
+            local = threading.local()
+            if mode == 'view':
+                path, field, content = '/api/email/send/', 'message', body
+            else:
+                path, field, content = '/api/email/send-html/', 'html_content', f'<p>{body}</p>'
+
+            def send_one(i):
+                if not hasattr(local, 'client'):
+                    local.client = Client()
+                response = local.client.post(
+                    path,
+                    json.dumps({'to_email': f'bench{i}@example.com', 'subject': f'Bench {i}', field: content}),
+                    content_type='application/json',
+                )
+                if response.status_code != 200:
+                    raise RuntimeError(f'HTTP {response.status_code}')
+        else:
+            endpoint = url.rstrip('/') + '/api/email/send/'
+
+            def send_one(i):
+                request = urllib.request.Request(
+                    endpoint,
+                    data=json.dumps({'to_email': f'bench{i}@example.com', 'subject': f'Bench {i}',
+                                     'message': body}).encode(),
+                    headers={'Content-Type': 'application/json'},
+                )
+                try:
+                    with urllib.request.urlopen(request, timeout=60) as response:
+                        response.read()
+                except urllib.error.HTTPError as e:
+                    raise RuntimeError(f'HTTP {e.code}') from None
+        return send_one
+
+    def run_threads(self, send_one, messages, concurrency):
+        latencies = []
+        errors = Counter()
+        counter = itertools.count()
+
+        def worker():
+            while (i := next(counter)) < messages:
+                started = time.perf_counter()
+                try:
+                    send_one(i)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        return latencies, errors, time.perf_counter() - started
+
+    async def run_async(self, messages, concurrency, body):
+        latencies = []
+        errors = Counter()
+        client = AsyncClient()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def send_one(i):
+            async with slots:
+                started = time.perf_counter()
+                response = await client.post(
+                    '/api/email/async/send/',
+                    json.dumps({'to_email': f'bench{i}@example.com', 'subject': f'Bench {i}', 'message': body}),
+                    content_type='application/json',
+                )
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[f'HTTP {response.status_code}'] += 1
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(send_one(i) for i in range(messages)))
+        finally:
+            # Quit the pooled sessions while their loop is still running.
+            await aiosmtp.close_async_pool()
+        return latencies, errors, time.perf_counter() - started
+
+
+def post_streamed_attachment(url, fields, size, block_size=1024 * 1024):
+    """POST a multipart form with a ``size``-byte random attachment without buffering it."""
+    boundary = uuid.uuid4().hex
+    head = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    ) + (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="attachment"; filename="bench.bin"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    )
+    head = head.encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    block = os.urandom(block_size)
+
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=300)
+    try:
+        connection.putrequest('POST', parsed.path)
+        connection.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+        connection.putheader('Content-Length', str(len(head) + size + len(tail)))
+        connection.endheaders()
+        connection.send(head)
+        remaining = size
+        while remaining > 0:
+            connection.send(block[:remaining])
+            remaining -= block_size
+        connection.send(tail)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f'HTTP {response.status}')
+    finally:
+        connection.close()
@@ -0,0 +1,109 @@
+import json
+import os
+import platform
+import random
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from email_test import schema
+
+# Non-ASCII domains for --idn-share.
+IDN_DOMAINS = ['bücher.de', '例え.jp', 'пример.рф', 'münchen.example']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark request validation (body size check, JSON parsing, address normalization) and print JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20000, help='Requests per run')
+        parser.add_argument(
+            '--addresses',
+            type=int,
+            default=1000,
+            help='Distinct recipient addresses the requests are drawn from'
+        )
+        parser.add_argument('--idn-share', type=float, default=0.1, help='Fraction of addresses with an IDN domain')
+        parser.add_argument('--body-size', type=int, default=512, help='Message text size in characters')
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=10000,
+            help='Requests per second to express the overhead at, as a share of one core'
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        addresses = []
+        for i in range(options['addresses']):
+            domain = rng.choice(IDN_DOMAINS) if rng.random() < options['idn_share'] else f'Example{i % 50}.COM'
+            addresses.append(f'User.{i}@{domain}')
+        text = 'x' * options['body_size']
+        count = options['requests']
+        bodies = [
+            json.dumps({'to_email': rng.choice(addresses), 'subject': 'Bench', 'message': text}).encode()
+            for _ in range(count)
+        ]
+        # Every address once, so each lookup misses the cache.
+        cold_bodies = [
+            json.dumps({'to_email': f'cold{i}.{addresses[i % len(addresses)]}', 'subject': 'Bench',
+                        'message': text}).encode()
+            for i in range(count)
+        ]
+        limit = settings.EMAIL_MAX_REQUEST_BYTES
+
+        def validate(request):
+            return schema._check_size(request, limit) or schema.parse(request.body)
+
+        schema._normalize.cache_clear()
+        schema._domain.cache_clear()
+        runs = {
+            'json_only': self.run(bodies, lambda request: json.loads(request.body)),
+            'schema_cold': self.run(cold_bodies, validate),
+            'schema_warm': self.run(bodies, validate),
+            'oversized_rejected': self.run(
+                bodies, lambda request: schema._check_size(request, limit), content_length=limit + 1
+            ),
+        }
+        baseline = runs['json_only']['us_per_request']
+        for name, run in runs.items():
+            overhead = run['us_per_request'] - baseline if name.startswith('schema') else run['us_per_request']
+            run['overhead_us'] = round(overhead, 2)
+            run['core_share_at_rate'] = round(overhead * options['rate'] / 1e6, 4)
+
+        result = {
+            'requests': count,
+            'addresses': options['addresses'],
+            'idn_share': options['idn_share'],
+            'body_bytes': len(bodies[0]),
+            'rate': options['rate'],
+            'runs': runs,
+            'caches': schema.cache_info(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        }
+        self.stdout.write(json.dumps(result, indent=2))
+
+    def run(self, bodies, check, content_length=None):
+        """Time ``check`` on a fresh request per body; building the requests is not timed."""
+        factory = RequestFactory()
+        requests = [factory.post('/api/email/send/', body, content_type='application/json') for body in bodies]
+        for request in requests:
+            if content_length is None:
+                # Reading the body costs the same with or without validation.
+                request.body
+            else:
+                request.META['CONTENT_LENGTH'] = str(content_length)
+        started = time.perf_counter()
+        for request in requests:
+            check(request)
+        elapsed = time.perf_counter() - started
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'per_second': round(len(requests) / elapsed, 1),
+            'us_per_request': round(elapsed / len(requests) * 1e6, 2),
+        }
@@ -1,15 +1,13 @@
-import ssl
-import socket
-from datetime import datetime
-from django.core.management.base import BaseCommand
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
 from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
-try:
-    from cryptography import x509
-    from cryptography.hazmat.backends import default_backend
-    HAS_CRYPTOGRAPHY = True
-except ImportError:
-    HAS_CRYPTOGRAPHY = False
+from email_test import probe
 
 
 class Command(BaseCommand):
@@ -28,172 +26,278 @@ class Command(BaseCommand):
             default=None,
             help='SMTP port to check (defaults to EMAIL_PORT setting)'
         )
+        parser.add_argument(
+            '--targets-file',
+            type=str,
+            default=None,
+            help='Check every "host[:port]" line in this file ("-" for stdin) concurrently'
+        )
+        parser.add_argument(
+            '--ports',
+            type=str,
+            default=None,
+            help='Comma-separated ports for targets without one (defaults to EMAIL_PORT)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Endpoints checked at once in --targets-file mode'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=10,
+            help='Per-endpoint socket timeout in seconds'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['ndjson', 'json'],
+            default='ndjson',
+            help='Output for --targets-file mode: NDJSON as results arrive, or one JSON array'
+        )
+        parser.add_argument(
+            '--resume-sessions',
+            action='store_true',
+            help='Resume the TLS session of an earlier scan of the same endpoint in this process. '
+                 'Faster, but a resumed handshake reports the certificate from the original session'
+        )
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='Keep re-checking the targets (--targets-file, --host, or every configured relay) '
+                 'and print an NDJSON event only when something changes'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=300,
+            help='Seconds between checks in --watch mode'
+        )
+        parser.add_argument(
+            '--expiry-days',
+            type=str,
+            default='30,14,7',
+            help='Comma-separated days-left thresholds that raise an "expiring" event in --watch mode'
+        )
 
     def handle(self, *args, **options):
+        if probe.load_x509() is None:
+            raise CommandError('check_smtp_cert requires the cryptography package')
+        if options['watch']:
+            return self.watch(options)
+        if options['targets_file']:
+            return self.scan_targets(options)
+
         host = options['host'] or settings.EMAIL_HOST
         port = options['port'] or settings.EMAIL_PORT
 
         self.stdout.write(self.style.WARNING(f'\n=== Checking SSL Certificate for {host}:{port} ===\n'))
 
+        # One connection: the certificate is captured and then verified, so
+        # a failed verification no longer needs a second handshake.
+        result = probe.probe(host, port, timeout=options['timeout'], resume=options['resume_sessions'])
+        if 'greeting' in result:
+            self.stdout.write(f'Server greeting: {result["greeting"]}')
+        if 'extensions' in result:
+            self.stdout.write(f'EHLO extensions: {", ".join(result["extensions"]) or "(none)"}')
+        if 'tls_version' in result:
+            how = 'Implicit TLS' if result['tls'] == 'implicit' else 'STARTTLS'
+            self.stdout.write(f'{how}: {result["tls_version"]}, {result["cipher"]}\n')
+        if 'not_after' not in result:
+            self.stdout.write(self.style.ERROR(f'\nError: {result.get("error", "no certificate received")}'))
+            return
+
+        self.stdout.write(self.style.SUCCESS('Certificate Details:'))
+        self.stdout.write('-' * 50)
+        self.stdout.write(f'Common Name (CN): {result["common_name"] or "N/A"}')
+        self.stdout.write(f'Issuer: {result["issuer"] or "N/A"}')
+        self.stdout.write(f'Not Before: {result["not_before"]}')
+        self.stdout.write(f'Not After: {result["not_after"]}')
+        self.stdout.write(f'SHA-256 Fingerprint: {result["fingerprint_sha256"]}')
+        self.stdout.write('\nSubject Alternative Names (SANs):')
+        for san in result['sans']:
+            self.stdout.write(f'  - {san}')
+        if not result['sans']:
+            self.stdout.write('  (none)')
+
+        if result['verified']:
+            self.stdout.write(self.style.SUCCESS('\nChain verification: OK'))
+        else:
+            self.stdout.write(self.style.ERROR(f'\nChain verification failed: {result["verify_error"]}'))
+        if 'error' in result:
+            self.stdout.write(self.style.ERROR(f'Error: {result["error"]}'))
+
+        self.stdout.write('\n' + '=' * 50)
+        self.stdout.write(self.style.WARNING('\nRecommendation:'))
+        if not result['hostname_match']:
+            self.stdout.write(self.style.ERROR(
+                f'\nThe hostname you are using ({host}) does NOT match the certificate!'
+            ))
+            self.stdout.write(self.style.SUCCESS('\nTry using one of these hostnames instead:'))
+            for hostname in result['sans'] or [result['common_name']]:
+                self.stdout.write(f'  EMAIL_HOST={hostname}')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'\nThe hostname {host} matches the certificate!'))
+
+    def scan_targets(self, options):
+        targets = self.load_targets(options)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, options['concurrency'])) as executor:
+            futures = [
+                executor.submit(probe.probe, host, port, options['timeout'], resume=options['resume_sessions'])
+                for host, port in targets
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if options['format'] == 'ndjson':
+                    self.stdout.write(json.dumps(result))
+                    self.stdout.flush()
+                else:
+                    results.append(result)
+
+        if options['format'] == 'json':
+            results.sort(key=lambda r: (r['host'], r['port']))
+            self.stdout.write(json.dumps(results, indent=2))
+
+    def load_targets(self, options):
+        ports = [int(p) for p in (options['ports'] or str(settings.EMAIL_PORT)).split(',')]
+        if options['targets_file'] == '-':
+            return list(read_targets(sys.stdin, ports))
+        with open(options['targets_file']) as f:
+            return list(read_targets(f, ports))
+
+    def watch_targets(self, options):
+        """{(host, port): implicit_tls} to check this round."""
+        if options['targets_file']:
+            return dict.fromkeys(self.load_targets(options))
+        if options['host'] or options['port']:
+            return {(options['host'] or settings.EMAIL_HOST, options['port'] or settings.EMAIL_PORT): None}
+        return probe.relay_endpoints()
+
+    def watch(self, options):
+        if options['resume_sessions']:
+            raise CommandError('--resume-sessions would hide rotated certificates; leave it off with --watch')
+        if options['targets_file'] == '-':
+            raise CommandError('--watch re-reads --targets-file every round, so it cannot be stdin')
+        thresholds = sorted({int(days) for days in options['expiry_days'].split(',') if days.strip()})
+        interval = max(1.0, options['interval'])
+        states = {}
+        self.stderr.write(f'Watching certificates every {interval:g}s; events go to stdout')
+
+        executor = ThreadPoolExecutor(max_workers=max(1, options['concurrency']))
         try:
-            # Create a socket connection
-            sock = socket.create_connection((host, port), timeout=10)
-
-            # Create SSL context
-            context = ssl.create_default_context()
-
-            # For STARTTLS (port 587), we need to do SMTP handshake first
-            if port == 587:
-                self.stdout.write('Port 587 detected - attempting STARTTLS...')
-
-                # Read server greeting (220)
-                greeting = sock.recv(4096)
-                self.stdout.write(f'Server greeting: {greeting.decode("utf-8", errors="ignore").strip()}')
-
-                # Send EHLO command
-                sock.sendall(b'EHLO localhost\r\n')
-                # Read EHLO response (may be multi-line with 250-)
-                ehlo_response = b''
-                while True:
-                    chunk = sock.recv(4096)
-                    ehlo_response += chunk
-                    # Check if we got the final line (250 without dash)
-                    if b'\n250 ' in chunk or (chunk.endswith(b'\n') and not b'250-' in chunk.split(b'\n')[-2]):
-                        break
-                self.stdout.write(f'EHLO response: {ehlo_response.decode("utf-8", errors="ignore").strip()}')
-
-                # Send STARTTLS command
-                sock.sendall(b'STARTTLS\r\n')
-                starttls_response = sock.recv(4096)
-                self.stdout.write(f'STARTTLS response: {starttls_response.decode("utf-8", errors="ignore").strip()}\n')
-
-            # Wrap socket with SSL
-            try:
-                ssl_sock = context.wrap_socket(sock, server_hostname=host)
-            except ssl.SSLError as e:
-                self.stdout.write(self.style.ERROR(f'\nSSL Error: {e}\n'))
-                # Try to get cert anyway without hostname verification
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                sock.close()
-                sock = socket.create_connection((host, port), timeout=10)
-
-                if port == 587:
-                    # Read greeting
-                    sock.recv(4096)
-                    # Send EHLO
-                    sock.sendall(b'EHLO localhost\r\n')
-                    # Read EHLO response
-                    while True:
-                        chunk = sock.recv(4096)
-                        if b'\n250 ' in chunk or (chunk.endswith(b'\n') and not b'250-' in chunk.split(b'\n')[-2]):
-                            break
-                    # Send STARTTLS
-                    sock.sendall(b'STARTTLS\r\n')
-                    # Read STARTTLS response
-                    sock.recv(4096)
-
-                ssl_sock = context.wrap_socket(sock, server_hostname=host)
-                self.stdout.write(self.style.WARNING('Certificate retrieved without verification\n'))
-
-            # Get certificate in binary form
-            cert_der = ssl_sock.getpeercert(binary_form=True)
-
-            # Display certificate information
-            self.stdout.write(self.style.SUCCESS('Certificate Details:'))
-            self.stdout.write('-' * 50)
-
-            # Parse certificate
-            if HAS_CRYPTOGRAPHY and cert_der:
-                cert_obj = x509.load_der_x509_certificate(cert_der, default_backend())
-
-                # Common Name
-                try:
-                    common_name = cert_obj.subject.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)[0].value
-                except (IndexError, AttributeError):
-                    common_name = 'N/A'
-                self.stdout.write(f'Common Name (CN): {common_name}')
-
-                # Issuer
-                try:
-                    issuer_cn = cert_obj.issuer.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)[0].value
-                except (IndexError, AttributeError):
-                    issuer_cn = 'N/A'
-                self.stdout.write(f'Issuer: {issuer_cn}')
-
-                # Validity period
-                self.stdout.write(f'Not Before: {cert_obj.not_valid_before_utc}')
-                self.stdout.write(f'Not After: {cert_obj.not_valid_after_utc}')
-
-                # Subject Alternative Names (SANs)
-                self.stdout.write('\nSubject Alternative Names (SANs):')
-                san_list = []
-                try:
-                    san_ext = cert_obj.extensions.get_extension_for_oid(x509.oid.ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
-                    for san in san_ext.value:
-                        if isinstance(san, x509.DNSName):
-                            san_list.append(san.value)
-                            self.stdout.write(f'  - {san.value}')
-                except x509.ExtensionNotFound:
-                    pass
-
-                if not san_list:
-                    self.stdout.write('  (none)')
-            else:
-                # Fallback to getpeercert() dict form
-                cert = ssl_sock.getpeercert()
-
-                # Subject (Common Name)
-                subject = dict(x[0] for x in cert.get('subject', []))
-                common_name = subject.get('commonName', 'N/A')
-                self.stdout.write(f'Common Name (CN): {common_name}')
-
-                # Issuer
-                issuer = dict(x[0] for x in cert.get('issuer', []))
-                issuer_cn = issuer.get('commonName', 'N/A')
-                self.stdout.write(f'Issuer: {issuer_cn}')
-
-                # Validity period
-                self.stdout.write(f'Not Before: {cert.get("notBefore", "N/A")}')
-                self.stdout.write(f'Not After: {cert.get("notAfter", "N/A")}')
-
-                # Subject Alternative Names (SANs)
-                self.stdout.write('\nSubject Alternative Names (SANs):')
-                san_list = []
-                for san_type, san_value in cert.get('subjectAltName', []):
-                    san_list.append(san_value)
-                    self.stdout.write(f'  - {san_value}')
-
-                if not san_list:
-                    self.stdout.write('  (none)')
-
-            # Provide recommendations
-            self.stdout.write('\n' + '=' * 50)
-            self.stdout.write(self.style.WARNING('\nRecommendation:'))
-
-            valid_hostnames = san_list if san_list else [common_name]
-            if host not in valid_hostnames:
-                self.stdout.write(self.style.ERROR(
-                    f'\nThe hostname you are using ({host}) does NOT match the certificate!'
-                ))
-                self.stdout.write(self.style.SUCCESS(
-                    f'\nTry using one of these hostnames instead:'
-                ))
-                for hostname in valid_hostnames:
-                    self.stdout.write(f'  EMAIL_HOST={hostname}')
-            else:
-                self.stdout.write(self.style.SUCCESS(
-                    f'\nThe hostname {host} matches the certificate!'
-                ))
-
-            # Close connection
-            ssl_sock.close()
-
-        except socket.timeout:
-            self.stdout.write(self.style.ERROR(f'\nConnection timeout to {host}:{port}'))
-        except socket.gaierror as e:
-            self.stdout.write(self.style.ERROR(f'\nDNS resolution failed: {e}'))
-        except ConnectionRefusedError:
-            self.stdout.write(self.style.ERROR(f'\nConnection refused by {host}:{port}'))
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f'\nError: {type(e).__name__}: {e}'))
+            while True:
+                started = time.monotonic()
+                # Re-read every round, so targets can be added without a restart.
+                targets = self.watch_targets(options)
+                futures = [
+                    executor.submit(probe.probe, host, port, options['timeout'], implicit_tls)
+                    for (host, port), implicit_tls in targets.items()
+                ]
+                events = 0
+                for future in as_completed(futures):
+                    result = future.result()
+                    key = result['host'], result['port']
+                    for event in watch_events(states.get(key), result, thresholds):
+                        self.stdout.write(json.dumps(event))
+                        self.stdout.flush()
+                        events += 1
+                    states[key] = next_state(states.get(key), result, thresholds)
+                for key in set(states) - set(targets):
+                    del states[key]
+
+                elapsed = time.monotonic() - started
+                if options['verbosity'] >= 2:
+                    cache = probe.snapshot()
+                    self.stderr.write(
+                        f'Checked {len(targets)} endpoints in {elapsed:.1f}s, {events} events; '
+                        f'certificates parsed {cache["certificates_parsed"]}, '
+                        f'cache hits {cache["certificate_cache_hits"]}'
+                    )
+                time.sleep(max(0.0, interval - elapsed))
+        except KeyboardInterrupt:
+            self.stderr.write('Interrupted')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def read_targets(lines, default_ports):
+    """
+    Yield (host, port) from "host[:port]" lines, skipping blanks and #
+    comments. IPv6 addresses take a port only in brackets: "[::1]:465".
+    """
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        host, sep, port = line.rpartition(':')
+        if sep and port.isdigit() and (':' not in host or host.startswith('[')):
+            yield host.strip('[]'), int(port)
+        else:
+            for default_port in default_ports:
+                yield line.strip('[]'), default_port
+
+
+def expiry_level(days, thresholds):
+    """How many of ``thresholds`` (plus 0, expired) the certificate is below."""
+    return sum(days < threshold for threshold in (0, *thresholds))
+
+
+def next_state(state, result, thresholds):
+    """What --watch remembers about an endpoint after ``result``."""
+    if 'fingerprint_sha256' not in result:
+        # No certificate this round: keep what was known, mark it failing.
+        return {**(state or {}), 'failing': True}
+    return {
+        'failing': 'error' in result,
+        'fingerprint': result['fingerprint_sha256'],
+        'hostname_match': result.get('hostname_match'),
+        'expiry_level': expiry_level(result.get('days_until_expiry', 0), thresholds),
+    }
+
+
+def watch_events(state, result, thresholds):
+    """
+    Events for ``result`` compared with the endpoint's previous ``state``
+    (None on the first check): rotated, hostname_mismatch, expiring,
+    expired, probe_failed and probe_recovered.
+    """
+    state = state or {}
+    base = {
+        'host': result['host'],
+        'port': result['port'],
+        'checked_at': datetime.now(timezone.utc).isoformat(),
+    }
+    events = []
+    failing = 'error' in result
+    if failing and not state.get('failing'):
+        events.append({'event': 'probe_failed', **base, 'error': result['error']})
+    elif not failing and state.get('failing'):
+        events.append({'event': 'probe_recovered', **base})
+    if 'fingerprint_sha256' not in result:
+        return events
+
+    details = {
+        'fingerprint_sha256': result['fingerprint_sha256'],
+        'common_name': result.get('common_name'),
+        'not_after': result.get('not_after'),
+        'days_until_expiry': result.get('days_until_expiry'),
+        'hostname_match': result.get('hostname_match'),
+        'verified': result.get('verified'),
+    }
+    rotated = state.get('fingerprint') not in (None, result['fingerprint_sha256'])
+    if rotated:
+        events.append({
+            'event': 'rotated', **base, **details,
+            'previous_fingerprint_sha256': state['fingerprint'],
+        })
+    if result.get('hostname_match') is False and (rotated or state.get('hostname_match') is not False):
+        events.append({'event': 'hostname_mismatch', **base, **details})
+    level = expiry_level(result.get('days_until_expiry', 0), thresholds)
+    previous_level = 0 if rotated else state.get('expiry_level', 0)
+    if level > previous_level:
+        event = 'expired' if result.get('days_until_expiry', 0) < 0 else 'expiring'
+        events.append({'event': event, **base, **details})
+    return events
@@ -0,0 +1,133 @@
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from email_test import delivery, outbox, profiles, ratelimit
+from email_test.messages import build_message
+
+# Failures that mean the relay can't be reached at all; the rest of the
+# batch's jobs for that profile are deferred for DEFER_SECONDS untried.
+UNREACHABLE_CODES = {'connection_failed', 'dns_failed', 'timeout', 'relay_unavailable', 'tls_failed'}
+DEFER_SECONDS = 30
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued emails in batches (safe to run several at once)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Jobs leased and sent per batch'
+        )
+        parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=120,
+            help='How long a leased batch is reserved before other workers may retake it'
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=5,
+            help='Attempts before a job is marked failed'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to sleep when the queue is empty'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty instead of polling'
+        )
+
+    def handle(self, *args, **options):
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.stdout.write(self.style.WARNING(f'Draining email queue as {owner}'))
+        self.stdout.write(f'Backend: {settings.EMAIL_BACKEND}')
+
+        total_sent = total_failed = 0
+        try:
+            while True:
+                jobs = outbox.claim_batch(owner, options['batch_size'], options['lease_seconds'])
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                sent, failed, deferred = self.send_batch(
+                    jobs, owner, options['lease_seconds'], options['max_attempts']
+                )
+                total_sent += sent
+                total_failed += failed
+                self.stdout.write(f'Batch of {len(jobs)}: {sent} sent, {failed} failed, {deferred} deferred')
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\nInterrupted; unfinished leases will expire'))
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {total_sent} sent, {total_failed} failed'))
+
+    def send_batch(self, jobs, owner, lease_seconds, max_attempts):
+        """
+        Send ``jobs`` over one connection per SMTP profile, each opened
+        when its first job is sent; return (sent, failed, deferred) counts.
+
+        Each job's lease is renewed before it is sent, and its outcome is
+        recorded as soon as it is known, so a job finished early in a slow
+        batch is not retaken and sent twice when the batch's lease runs
+        out. A job whose lease was lost in the meantime is left alone.
+        """
+        connections = profiles.Connections()
+        # Profiles whose relay could not be reached in this batch, with the error.
+        down = {}
+        sent = failed = deferred = 0
+        try:
+            for job in jobs:
+                profile = job.payload.get('profile')
+                if profile in down:
+                    outbox.defer(job, owner, DEFER_SECONDS, down[profile])
+                    deferred += 1
+                    continue
+                if not outbox.renew(job, owner, lease_seconds):
+                    self.stdout.write(self.style.WARNING(f'Lost the lease on job {job.id}; skipping it'))
+                    continue
+                try:
+                    email = build_message(job.payload)
+                except ValueError as e:
+                    # A payload that doesn't build never will; don't retry it.
+                    outbox.mark_failed(job, owner, e, max_attempts, permanent=True)
+                    failed += 1
+                    continue
+                try:
+                    # Half the lease for the rate limit, half for the send.
+                    ratelimit.acquire(
+                        email.recipients(), max_wait=lease_seconds / 2, relay=ratelimit.relay_key(profile)
+                    )
+                    delivery.send([email], connection=connections.get(profile))
+                except ratelimit.RateLimited as e:
+                    outbox.defer(job, owner, e.retry_after, e)
+                    deferred += 1
+                except delivery.DeliveryError as e:
+                    if e.code in UNREACHABLE_CODES:
+                        # Don't spend a retry deadline per job on a dead relay.
+                        down[profile] = f'{e.code}: {e}'
+                    # Transient failures were already retried; a rejection
+                    # would only be rejected again, so don't requeue it.
+                    outbox.mark_failed(job, owner, f'{e.code}: {e}', max_attempts, permanent=not e.transient)
+                    failed += 1
+                except Exception as e:
+                    outbox.mark_failed(job, owner, e, max_attempts)
+                    failed += 1
+                else:
+                    if not outbox.mark_sent([job], owner):
+                        self.stdout.write(self.style.WARNING(f'Job {job.id} was sent after its lease was lost'))
+                    sent += 1
+        finally:
+            connections.close()
+        return sent, failed, deferred
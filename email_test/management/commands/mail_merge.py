@@ -0,0 +1,62 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from email_test import merge, templating
+
+
+class Command(BaseCommand):
+    help = 'Send a named template to every recipient in a CSV or NDJSON file (mail merge)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('template', type=str, help='Template name in EMAIL_TEMPLATE_DIR')
+        parser.add_argument(
+            '--recipients',
+            type=str,
+            default='-',
+            help='CSV (header row with a to_email or email column) or NDJSON file; - for stdin'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'ndjson'],
+            default=None,
+            help='Recipient file format (default: from the file extension, else ndjson)'
+        )
+        parser.add_argument('--subject', type=str, default=None, help="Override the template's subject")
+        parser.add_argument(
+            '--progress-interval',
+            type=float,
+            default=5.0,
+            help='Seconds between progress lines'
+        )
+
+    def handle(self, *args, **options):
+        path = options['recipients']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        try:
+            templating.get_cache().get(options['template'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        source = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            events = merge.run(
+                options['template'],
+                merge.read_rows(source, fmt),
+                subject=options['subject'],
+                progress_interval=options['progress_interval'],
+            )
+            # Failures and progress as NDJSON on stdout, a readable summary on stderr.
+            for event in events:
+                self.stdout.write(json.dumps(event))
+                if 'summary' in event:
+                    summary = event['summary']
+                    self.stderr.write(self.style.SUCCESS(
+                        f'Done: {summary["sent"]} sent ({summary["spooled"]} spooled), '
+                        f'{summary["failed"]} failed in {summary["elapsed_s"]}s '
+                        f'({summary["per_second"]} msg/s)'
+                    ))
+        finally:
+            if source is not sys.stdin:
+                source.close()
@@ -0,0 +1,158 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from email_test import delivery, spool, wire
+
+
+class RelayDown(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Deliver messages spooled by SpoolingEmailBackend, in batches over one SMTP session'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Messages claimed from the spool at a time'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Stop after this many messages (default: drain the spool)'
+        )
+        parser.add_argument(
+            '--recover',
+            action='store_true',
+            help='First return messages left claimed by a replayer that died '
+                 '(only when no other replay_spool is running)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING(f'Replaying {settings.EMAIL_SPOOL_DIR}'))
+        if options['recover']:
+            self.stdout.write(f'Recovered {spool.recover()} claimed message(s)')
+        self.stdout.write(f'Spool depth: {spool.snapshot()["depth"]}')
+
+        # Never a spooling backend here, or failures would be spooled again.
+        connection = get_connection('email_test.backends.InstrumentedEmailBackend')
+        self.totals = {'sent': 0, 'rejected': 0, 'deferred': 0}
+        # Deferred messages go back to the spool at the end, so this run
+        # doesn't claim them again.
+        self.deferred = []
+        remaining = options['limit']
+        started = time.monotonic()
+        try:
+            while remaining is None or remaining > 0:
+                batch_size = options['batch_size'] if remaining is None else min(options['batch_size'], remaining)
+                names = spool.claim(batch_size)
+                if not names:
+                    break
+                self.replay_batch(connection, names)
+                if remaining is not None:
+                    remaining -= len(names)
+        except RelayDown as e:
+            self.stdout.write(self.style.ERROR(f'Relay unavailable, stopping: {e}'))
+        finally:
+            self.close(connection)
+            spool.release(self.deferred)
+
+        elapsed = time.monotonic() - started
+        rate = self.totals['sent'] / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {self.totals["sent"]} sent, {self.totals["rejected"]} rejected, '
+            f'{self.totals["deferred"]} deferred in {elapsed:.1f}s ({rate:.0f} msg/s); '
+            f'{spool.snapshot()["depth"]} left in the spool'
+        ))
+
+    def replay_batch(self, connection, names):
+        """
+        Send the claimed ``names``; on a relay failure raise RelayDown.
+        However the batch ends, messages not yet dealt with go back to new/.
+        """
+        pending = list(names)
+        try:
+            while pending:
+                self.replay(connection, pending[0])
+                del pending[0]
+        finally:
+            spool.release(pending)
+
+    def replay(self, connection, name):
+        try:
+            from_email, recipients, encoding, data = spool.read(name)
+        except ValueError as e:
+            self.reject(name, f'unreadable spool file: {e}')
+            return
+        for attempt in range(2):
+            try:
+                if connection.connection is None:
+                    connection.open()
+                session = connection.connection
+                session.ehlo_or_helo_if_needed()
+                try:
+                    from_addr, to_addrs, mail_options = wire.encode_envelope(
+                        from_email, recipients, encoding, smtputf8=session.has_extn('smtputf8'),
+                    )
+                except ValueError as e:
+                    self.reject(name, f'invalid address: {e}')
+                    return
+                refused = session.sendmail(from_addr, to_addrs, data, mail_options)
+            except OSError as e:
+                error = delivery.classify(e)
+                if error.code == 'connection_lost' and attempt == 0:
+                    # An idle session timed out; reconnect once.
+                    self.close(connection)
+                    continue
+                if not error.transient:
+                    self.reject(name, f'{error.code}: {error}')
+                elif error.code == 'recipient_rejected':
+                    # Greylisted or over quota: only this message waits.
+                    self.defer(name)
+                else:
+                    self.close(connection)
+                    raise RelayDown(f'{error.code}: {error}')
+            else:
+                self.delivered(name, dict(zip(to_addrs, recipients)), refused)
+            return
+
+    def delivered(self, name, recipients, refused):
+        """
+        Finish a message the relay took for at least one recipient.
+        ``recipients`` maps envelope addresses back to the spooled ones;
+        those ``refused`` with a 4xx reply stay in the spool for a retry.
+        """
+        retry = []
+        for addr, (code, text) in refused.items():
+            reply = text.decode(errors='replace') if isinstance(text, bytes) else text
+            self.stderr.write(f'{name}: {addr} refused: {code} {reply}')
+            if 400 <= code < 500:
+                retry.append(recipients[addr])
+        self.totals['sent'] += 1
+        if retry:
+            spool.readdress(name, retry)
+            self.defer(name)
+        else:
+            spool.delivered(name)
+
+    def defer(self, name):
+        self.deferred.append(name)
+        self.totals['deferred'] += 1
+
+    def reject(self, name, reason):
+        spool.reject(name)
+        self.totals['rejected'] += 1
+        self.stderr.write(f'{name}: {reason}')
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.close()
+        except OSError:
+            pass
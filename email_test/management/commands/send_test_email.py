@@ -1,15 +1,72 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, send_mail
 from django.conf import settings
 
+from email_test import delivery, dkim, merge, metrics, profiles, ratelimit, schema
+from email_test.messages import prepare_batch
+
+
+class Checkpoint:
+    """
+    Which recipient-file lines are done, for --resume.
+
+    Stored as the first line not yet done plus the done lines after it.
+    Sends finish out of order, but at most a window's worth of them, so
+    the set of lines stays small however long the file is. Without a
+    ``path`` (stdin and no --checkpoint) progress is only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.next_line = 1
+        self.done = set()
+
+    def load(self):
+        if self.path is None:
+            return False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.next_line = data['next_line']
+        self.done = set(data['done'])
+        return True
+
+    def is_done(self, line_no):
+        return line_no < self.next_line or line_no in self.done
+
+    def mark(self, line_no):
+        self.done.add(line_no)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'next_line': self.next_line, 'done': sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
 
 class Command(BaseCommand):
-    help = 'Send a test email to verify email configuration'
+    help = 'Send a test email to verify email configuration, or one to each address in a file'
 
     def add_arguments(self, parser):
         parser.add_argument(
             'to_email',
             type=str,
+            nargs='?',
             help='Email address to send the test email to'
         )
         parser.add_argument(
@@ -24,33 +81,267 @@ class Command(BaseCommand):
             default='This is a test email sent from the Django email test application.',
             help='Message body for the test email'
         )
+        parser.add_argument(
+            '--profile',
+            type=str,
+            help='Send through this SMTP profile from EMAIL_PROFILES'
+        )
+        parser.add_argument(
+            '--recipients-file',
+            type=str,
+            help='Send to every address in this file, one per line (- for stdin); '
+                 'results are written as NDJSON'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=4,
+            help='Parallel senders in --recipients-file mode, each reusing one SMTP connection'
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            default='-',
+            help='Where to write the NDJSON results (default: stdout)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            type=str,
+            help='Progress file for --resume (default: <recipients-file>.checkpoint)'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Skip the lines the checkpoint says are done and append to --output'
+        )
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            help="Don't print the configuration banner"
+        )
 
     def handle(self, *args, **options):
-        to_email = options['to_email']
+        try:
+            options['from_email'] = profiles.from_email(options['profile'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['recipients_file']:
+            return self.handle_bulk(options)
+        if not options['to_email']:
+            raise CommandError('Give a to_email or --recipients-file')
+        try:
+            to_email = schema.normalize_address(options['to_email'])
+        except ValueError as e:
+            raise CommandError(str(e))
         subject = options['subject']
         message = options['message']
 
         self.stdout.write(self.style.WARNING(f'Sending test email to: {to_email}'))
         self.stdout.write(f'Subject: {subject}')
-        self.stdout.write(self.style.NOTICE('\n=== Email Configuration ==='))
-        self.stdout.write(f'Backend: {settings.EMAIL_BACKEND}')
-        self.stdout.write(f'Host: {settings.EMAIL_HOST}')
-        self.stdout.write(f'Port: {settings.EMAIL_PORT}')
-        self.stdout.write(f'Use TLS: {settings.EMAIL_USE_TLS}')
-        self.stdout.write(f'Use SSL: {settings.EMAIL_USE_SSL}')
-        self.stdout.write(f'User: {settings.EMAIL_HOST_USER if settings.EMAIL_HOST_USER else "(not set)"}')
-        self.stdout.write(f'Password: {"(set)" if settings.EMAIL_HOST_PASSWORD else "(not set)"}')
-        self.stdout.write(f'From: {settings.DEFAULT_FROM_EMAIL}')
-        self.stdout.write('=' * 27 + '\n')
+        if not options['quiet']:
+            self.write_banner(self.stdout, options)
 
         try:
-            send_mail(
-                subject=subject,
-                message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[to_email],
-                fail_silently=False,
-            )
+            with metrics.capture() as timings:
+                send_mail(
+                    subject=subject,
+                    message=message,
+                    from_email=options['from_email'],
+                    recipient_list=[to_email],
+                    fail_silently=False,
+                    connection=profiles.get_connection(options['profile']),
+                )
             self.stdout.write(self.style.SUCCESS(f'Successfully sent test email to {to_email}'))
         except Exception as e:
             raise CommandError(f'Failed to send email: {str(e)}')
+        finally:
+            if timings:
+                self.stdout.write('Timings: ' + ', '.join(f'{phase} {ms}ms' for phase, ms in timings.items()))
+
+    def write_banner(self, out, options):
+        if options['profile']:
+            self.write_profile_banner(out, options)
+            return
+        out.write(self.style.NOTICE('\n=== Email Configuration ==='))
+        out.write(f'Backend: {settings.EMAIL_BACKEND}')
+        out.write(f'Host: {settings.EMAIL_HOST}')
+        out.write(f'Port: {settings.EMAIL_PORT}')
+        out.write(f'Use TLS: {settings.EMAIL_USE_TLS}')
+        out.write(f'Use SSL: {settings.EMAIL_USE_SSL}')
+        out.write(f'User: {settings.EMAIL_HOST_USER if settings.EMAIL_HOST_USER else "(not set)"}')
+        out.write(f'Password: {"(set)" if settings.EMAIL_HOST_PASSWORD else "(not set)"}')
+        out.write(f'From: {settings.DEFAULT_FROM_EMAIL}')
+        out.write('=' * 27 + '\n')
+
+    def write_profile_banner(self, out, options):
+        profile = profiles.snapshot()[options['profile']]
+        out.write(self.style.NOTICE(f'\n=== SMTP Profile: {options["profile"]} ==='))
+        out.write(f'Host: {profile["host"]}')
+        out.write(f'Port: {profile["port"]}')
+        out.write(f'Use TLS: {profile["use_tls"]}')
+        out.write(f'Use SSL: {profile["use_ssl"]}')
+        out.write(f'Credentials: {"(set)" if profile["has_credentials"] else "(not set)"}')
+        out.write(f'From: {profile["from_email"]}')
+        out.write('=' * 27 + '\n')
+
+    def handle_bulk(self, options):
+        path = options['recipients_file']
+        concurrency = max(1, options['concurrency'])
+        checkpoint_path = options['checkpoint'] or (None if path == '-' else f'{path}.checkpoint')
+        if options['resume'] and not checkpoint_path:
+            raise CommandError('--resume with stdin needs --checkpoint')
+        checkpoint = Checkpoint(checkpoint_path)
+        if options['resume'] and not checkpoint.load():
+            raise CommandError(f'No checkpoint at {checkpoint_path}')
+        try:
+            signing = dkim.get_signer() is not None
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        # With DKIM on and EMAIL_DKIM_BATCH_SIZE set, lines are signed this
+        # many at a time in the render processes before they go to the
+        # senders; otherwise each sender signs as it sends.
+        batch_size = settings.EMAIL_DKIM_BATCH_SIZE if signing else 0
+
+        # Results go to stdout, so the banner and summary go to stderr.
+        if not options['quiet']:
+            self.write_banner(self.stderr, options)
+
+        source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'a' if options['resume'] else 'w', encoding='utf-8')
+
+        # Lines may be read at most this far ahead of the oldest unfinished one.
+        window = max(concurrency * 4, batch_size * 2)
+        jobs = queue.Queue(maxsize=window)
+        results = queue.SimpleQueue()
+        senders = [
+            threading.Thread(target=self.sender, args=(jobs, results, options), daemon=True)
+            for _ in range(concurrency)
+        ]
+        for thread in senders:
+            thread.start()
+
+        counts = {'sent': 0, 'failed': 0}
+        started = last_save = time.monotonic()
+
+        def record(result):
+            nonlocal last_save
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            counts['sent' if result['success'] else 'failed'] += 1
+            checkpoint.mark(result['line'])
+            if time.monotonic() - last_save >= 1:
+                checkpoint.save()
+                last_save = time.monotonic()
+
+        batch = []
+
+        def flush():
+            emails = [self.build_email(to_email, options) for _, to_email in batch]
+            for (line_no, to_email), email in zip(batch, prepare_batch(emails, merge.get_render_pool())):
+                jobs.put((line_no, to_email, email))
+            batch.clear()
+
+        interrupted = False
+        try:
+            for line_no, line in enumerate(source, 1):
+                to_email = line.strip()
+                if checkpoint.is_done(line_no):
+                    continue
+                if not to_email or to_email.startswith('#'):
+                    checkpoint.mark(line_no)
+                    continue
+                try:
+                    to_email = schema.normalize_address(to_email)
+                except ValueError as e:
+                    record({'line': line_no, 'to_email': to_email, 'success': False,
+                            'error': str(e), 'code': 'invalid_request'})
+                    continue
+                while line_no - checkpoint.next_line >= window:
+                    if batch:
+                        flush()
+                    record(results.get())
+                if batch_size:
+                    batch.append((line_no, to_email))
+                    if len(batch) >= batch_size:
+                        flush()
+                else:
+                    jobs.put((line_no, to_email, None))
+                while True:
+                    try:
+                        record(results.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch:
+                flush()
+        except KeyboardInterrupt:
+            interrupted = True
+            # Drop what hasn't started; in-flight sends still finish.
+            while True:
+                try:
+                    jobs.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            for _ in senders:
+                jobs.put(None)
+            for thread in senders:
+                while thread.is_alive():
+                    thread.join(0.1)
+                    while True:
+                        try:
+                            record(results.get_nowait())
+                        except queue.Empty:
+                            break
+            checkpoint.save()
+            if source is not sys.stdin:
+                source.close()
+            if output is not sys.stdout:
+                output.close()
+
+        elapsed = time.monotonic() - started
+        rate = counts['sent'] / elapsed if elapsed else 0
+        summary = (f'{counts["sent"]} sent, {counts["failed"]} failed in {elapsed:.1f}s '
+                   f'({rate:.0f} msg/s)')
+        if interrupted:
+            self.stderr.write(self.style.WARNING(f'Interrupted: {summary}; rerun with --resume to continue'))
+        else:
+            self.stderr.write(self.style.SUCCESS(f'Done: {summary}'))
+
+    def build_email(self, to_email, options):
+        return EmailMessage(
+            subject=options['subject'],
+            body=options['message'],
+            from_email=options['from_email'],
+            to=[to_email],
+        )
+
+    def sender(self, jobs, results, options):
+        connection = profiles.get_connection(options['profile'])
+        relay = ratelimit.relay_key(options['profile'])
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                line_no, to_email, email = job
+                result = {'line': line_no, 'to_email': to_email}
+                try:
+                    if email is None:
+                        email = self.build_email(to_email, options)
+                    ratelimit.acquire([to_email], max_wait=float('inf'), relay=relay)
+                    with metrics.capture() as timings:
+                        delivery.send([email], connection=connection)
+                    result.update(success=True, timings_ms=timings)
+                    if hasattr(email, 'spool_id'):
+                        result['spooled'] = True
+                except Exception as e:
+                    result.update(delivery.classify(e).as_dict())
+                results.put(result)
+        finally:
+            try:
+                connection.close()
+            except OSError:
+                pass
@@ -0,0 +1,163 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter for each settings module: boots Django the
+# way a gunicorn worker does, serves one request, then forks a "worker"
+# (as preload_app does) that serves more requests and reports how much of
+# its memory is private to it.
+PROBE = r'''
+import gc, io, json, os, sys, time
+
+started = time.perf_counter()
+marks = {}
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+
+def mark(phase):
+    marks[phase] = {'ms': round((time.perf_counter() - started) * 1000, 1), 'rss_mb': rss_mb()}
+
+def request(app, path):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    status = []
+    body = b''.join(app(environ, lambda s, h, exc_info=None: status.append(s)))
+    return int(status[0].split()[0]), len(body)
+
+import django
+mark('import_django')
+django.setup()
+mark('setup')
+from django.core.wsgi import get_wsgi_application
+app = get_wsgi_application()
+mark('wsgi_app')
+from django.urls import get_resolver
+get_resolver().url_patterns
+mark('urlconf')
+status, _ = request(app, __PATH__)
+mark('first_request')
+
+from django.conf import settings
+result = {
+    'phases': marks,
+    'first_request_status': status,
+    'installed_apps': len(settings.INSTALLED_APPS),
+    'middleware': len(settings.MIDDLEWARE),
+    'modules_loaded': len(sys.modules),
+}
+
+gc.freeze()
+read_fd, write_fd = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(read_fd)
+    for _ in range(__REQUESTS__):
+        request(app, __PATH__)
+    memory = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty', 'Shared_Clean', 'Shared_Dirty'):
+                memory[name] = int(value.split()[0]) / 1024
+    os.write(write_fd, json.dumps({
+        'rss_mb': round(memory['Rss'], 1),
+        'pss_mb': round(memory['Pss'], 1),
+        'private_mb': round(memory['Private_Clean'] + memory['Private_Dirty'], 1),
+        'shared_mb': round(memory['Shared_Clean'] + memory['Shared_Dirty'], 1),
+    }).encode())
+    os._exit(0)
+os.close(write_fd)
+with os.fdopen(read_fd) as f:
+    result['forked_worker'] = json.loads(f.read() or 'null')
+os.waitpid(pid, 0)
+print(json.dumps(result))
+'''
+
+
+def parse_importtime(stderr, top):
+    """Return the ``top`` slowest imports from ``-X importtime`` output, by cumulative time."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append({
+            'module': name.strip(),
+            'depth': depth,
+            'self_ms': round(int(self_us) / 1000, 1),
+            'cumulative_ms': round(int(cumulative_us) / 1000, 1),
+        })
+    total_ms = round(sum(i['self_ms'] for i in imports), 1)
+    # Only outermost imports, so cumulative times don't overlap.
+    packages = sorted((i for i in imports if i['depth'] == 0), key=lambda i: -i['cumulative_ms'])
+    return total_ms, packages[:top]
+
+
+class Command(BaseCommand):
+    help = 'Measure cold-start time, import cost and per-worker memory for settings profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--settings-module',
+            action='append',
+            dest='settings_modules',
+            default=None,
+            help='Settings module to measure; repeat to compare '
+                 '(default: config.settings and config.settings_api)'
+        )
+        parser.add_argument('--path', type=str, default='/api/email/config/', help='GET path to request')
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=20,
+            help='Requests the forked worker serves before its memory is measured'
+        )
+        parser.add_argument('--top', type=int, default=15, help='Slowest top-level imports to list')
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise CommandError('startup_report needs Linux (/proc/self/smaps_rollup)')
+
+        modules = options['settings_modules'] or ['config.settings', 'config.settings_api']
+        probe = PROBE.replace('__PATH__', repr(options['path'])).replace('__REQUESTS__', str(options['requests']))
+        profiles = []
+        for module in modules:
+            self.stderr.write(f'Measuring {module}...')
+            env = {**os.environ, 'DJANGO_SETTINGS_MODULE': module}
+            # Timings come from a plain run; -X importtime slows imports down,
+            # so the import breakdown comes from a second run.
+            proc = subprocess.run([sys.executable, '-c', probe], env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise CommandError(f'{module} failed to start:\n{proc.stderr[-2000:]}')
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            traced = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', probe], env=env, capture_output=True, text=True,
+            )
+            import_ms, slowest = parse_importtime(traced.stderr, options['top'])
+            profiles.append({
+                'settings': module,
+                'cold_start_ms': result['phases']['first_request']['ms'],
+                **result,
+                'import_ms': import_ms,
+                'slowest_imports': slowest,
+            })
+
+        self.stdout.write(json.dumps({
+            'path': options['path'],
+            'profiles': profiles,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        }, indent=2))
@@ -0,0 +1,275 @@
+"""
+Mail merge: one named template sent to a stream of recipients.
+
+run() reads recipient rows lazily and passes them in chunks to a
+per-process pool of render workers (EMAIL_MERGE_PROCESSES). The workers
+render the template and serialize each message to wire format, DKIM-signed
+when signing is configured (see dkim.py), so the sending process never
+builds MIME or signs. Rendered messages go through a bounded queue
+(EMAIL_MERGE_QUEUE_SIZE) to EMAIL_MERGE_SENDERS threads. Each sender holds
+one SMTP session and sends through delivery.send(), so rate limits,
+retries and spooling apply as they do for the send endpoints.
+
+Backpressure keeps memory bounded: only a few chunks are ever being
+rendered, and the queue blocks when the senders fall behind. Memory use
+therefore does not grow with the size of the recipient list.
+"""
+
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.mail import get_connection
+
+from . import delivery, ratelimit, templating
+from .messages import PreparedMessage, build_message
+
+# Recipient columns/keys; every other column is template context.
+ADDRESS_FIELDS = ('to_email', 'email')
+
+_lock = threading.Lock()
+_pool = None  # (pid, executor)
+
+
+def get_render_pool():
+    """This process's render workers, started on first use (and again after a fork)."""
+    global _pool
+    with _lock:
+        if _pool is None or _pool[0] != os.getpid():
+            # forkserver children start from a clean process, not a copy of
+            # a worker that may have sender threads holding locks. The
+            # initializer must not be in this app: unpickling it would
+            # import our models before django.setup() has run.
+            executor = ProcessPoolExecutor(
+                max_workers=settings.EMAIL_MERGE_PROCESSES or os.cpu_count(),
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=django.setup,
+            )
+            _pool = (os.getpid(), executor)
+        return _pool[1]
+
+
+def _discard_pool(executor):
+    """Forget a pool whose worker died so the next run starts a fresh one."""
+    global _pool
+    with _lock:
+        if _pool is not None and _pool[1] is executor:
+            _pool = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _row(fields):
+    """Split a row into (to_email, context)."""
+    context = dict(fields)
+    to_email = None
+    for name in ADDRESS_FIELDS:
+        to_email = to_email or context.pop(name, None)
+    if isinstance(context.get('context'), dict):
+        context = context['context']
+    return to_email, context
+
+
+def read_rows(lines, fmt):
+    """
+    Yield (to_email, context) for each recipient in ``lines`` (an iterable
+    of str). CSV needs a header row with a to_email or email column.
+    NDJSON lines are objects with to_email and either a context object or
+    the context fields inline. Bad NDJSON lines yield ValueError.
+    """
+    if fmt == 'csv':
+        for fields in csv.DictReader(lines):
+            yield _row(fields)
+    elif fmt == 'ndjson':
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                fields = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield ValueError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(fields, dict):
+                yield ValueError('Each line must be a JSON object')
+                continue
+            yield _row(fields)
+    else:
+        raise ValueError(f'Unknown recipient format: {fmt}')
+
+
+def render_chunk(template, subject, rows):
+    """
+    Render ``rows`` [(index, to_email, context)] in a worker process.
+    Returns [(index, to_email, PreparedMessage or error text)].
+    """
+    results = []
+    for index, to_email, context in rows:
+        payload = {'to_email': to_email, 'template': template, 'context': context}
+        if subject:
+            payload['subject'] = subject
+        try:
+            results.append((index, to_email, PreparedMessage.from_email_message(build_message(payload))))
+        except ValueError as e:
+            results.append((index, to_email, str(e)))
+    return results
+
+
+def _sender(messages, results):
+    connection = get_connection()
+    try:
+        while True:
+            item = messages.get()
+            if item is None:
+                return
+            index, message = item
+            try:
+                ratelimit.acquire(message.recipients(), max_wait=float('inf'))
+                delivery.send([message], connection=connection)
+                results.put((index, message.to[0], getattr(message, 'spool_id', None), None))
+            except Exception as e:
+                results.put((index, message.to[0], None, delivery.classify(e)))
+    finally:
+        try:
+            connection.close()
+        except OSError:
+            pass
+
+
+class Progress:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = self.rendered = self.sent = self.spooled = self.failed = 0
+
+    def as_dict(self, queued):
+        elapsed = time.monotonic() - self.started
+        return {
+            'read': self.read,
+            'rendered': self.rendered,
+            'queued': queued,
+            'sent': self.sent,
+            'spooled': self.spooled,
+            'failed': self.failed,
+            'elapsed_s': round(elapsed, 2),
+            'per_second': round(self.sent / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def run(template, rows, subject=None, progress_interval=1.0):
+    """
+    Send ``template`` to every (to_email, context) in ``rows``.
+
+    Yields event dicts: {'index', 'to_email', 'success': False, 'code',
+    'error'} for each failed recipient, {'progress': {...}} about every
+    ``progress_interval`` seconds, and finally {'summary': {...}}. Raises
+    ValueError for an unknown template before anything is sent.
+    """
+    templating.get_cache().get(template)
+
+    pool = get_render_pool()
+    chunk_size = settings.EMAIL_MERGE_CHUNK_SIZE
+    max_chunks = 2 * (settings.EMAIL_MERGE_PROCESSES or os.cpu_count())
+    messages = queue.Queue(maxsize=settings.EMAIL_MERGE_QUEUE_SIZE)
+    results = queue.SimpleQueue()
+    senders = [
+        threading.Thread(target=_sender, args=(messages, results), name=f'merge-sender-{i}', daemon=True)
+        for i in range(settings.EMAIL_MERGE_SENDERS)
+    ]
+    for thread in senders:
+        thread.start()
+
+    progress = Progress()
+
+    def numbered():
+        for index, row in enumerate(rows):
+            progress.read = index + 1
+            yield index, row
+
+    rows_iter = numbered()
+    chunks = iter(lambda: list(itertools.islice(rows_iter, chunk_size)), [])
+
+    def collect():
+        while True:
+            try:
+                index, to_email, spool_id, error = results.get_nowait()
+            except queue.Empty:
+                return
+            if error is None:
+                progress.sent += 1
+                progress.spooled += spool_id is not None
+            else:
+                progress.failed += 1
+                yield {'index': index, 'to_email': to_email, **error.as_dict()}
+
+    def report():
+        return {'progress': progress.as_dict(messages.qsize())}
+
+    pending = set()
+    last_report = time.monotonic()
+    done_reading = False
+    try:
+        while True:
+            while len(pending) < max_chunks:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                batch = []
+                for index, row in chunk:
+                    if isinstance(row, Exception):
+                        progress.failed += 1
+                        yield {'index': index, 'success': False, 'error': str(row), 'code': 'invalid_request'}
+                    else:
+                        batch.append((index, *row))
+                pending.add(pool.submit(render_chunk, template, subject, batch))
+            if not pending:
+                break
+            done, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                for index, to_email, message in future.result():
+                    if isinstance(message, str):
+                        progress.failed += 1
+                        yield {'index': index, 'to_email': to_email, 'success': False,
+                               'error': message, 'code': 'invalid_request'}
+                        continue
+                    progress.rendered += 1
+                    # Blocks while the senders are behind.
+                    messages.put((index, message))
+                    yield from collect()
+            if time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                yield report()
+
+        done_reading = True
+        for _ in senders:
+            messages.put(None)
+        for thread in senders:
+            while thread.is_alive():
+                thread.join(progress_interval)
+                yield from collect()
+                if thread.is_alive():
+                    yield report()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        if not done_reading:
+            # Stopped early (e.g. the client went away): drop what hasn't
+            # been sent and let the senders finish their current message.
+            for future in pending:
+                future.cancel()
+            while True:
+                try:
+                    messages.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in senders:
+                messages.put(None)
+    yield from collect()
+    yield {'summary': progress.as_dict(0)}
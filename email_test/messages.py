@@ -0,0 +1,98 @@
+"""
+Build EmailMessage objects from the JSON payloads the send endpoints accept.
+"""
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+
+from . import dkim, profiles, schema, templating, wire
+
+
+def build_message(data):
+    """
+    Build an EmailMessage from a send payload.
+
+    Payloads with ``template`` (plus optional ``context``) render that
+    named template into an HTML message with a plain-text alternative;
+    payloads with ``html_content`` produce an HTML message (as in
+    send_html_email); otherwise ``message`` is sent as plain text (as in
+    send_test_email). A ``profile`` names the SMTP profile whose sender
+    address is used. Raises ValueError if the payload does not pass
+    schema.clean() or the template or profile does not exist.
+    """
+    data = schema.clean(data)
+    to_email = data['to_email']
+    from_email = profiles.from_email(data.get('profile'))
+
+    if data.get('template'):
+        subject, html, text = templating.render(data['template'], data.get('context'))
+        email = EmailMultiAlternatives(
+            subject=data.get('subject') or subject or 'Test HTML Email',
+            body=text,
+            from_email=from_email,
+            to=[to_email],
+        )
+        email.attach_alternative(html, 'text/html')
+    elif 'html_content' in data:
+        email = EmailMessage(
+            subject=data.get('subject', 'Test HTML Email'),
+            body=data['html_content'],
+            from_email=from_email,
+            to=[to_email],
+        )
+        email.content_subtype = 'html'
+    else:
+        email = EmailMessage(
+            subject=data.get('subject', 'Test Email'),
+            body=data.get('message', 'This is a test email from Django.'),
+            from_email=from_email,
+            to=[to_email],
+        )
+    return email
+
+
+class PreparedMessage:
+    """
+    A message already serialized for SMTP, e.g. rendered in a worker
+    process. Small and picklable, and it provides what the SMTP backends,
+    delivery and the spool use from an EmailMessage: ``from_email``,
+    ``to``, ``encoding``, ``recipients()`` and ``message().as_bytes()``.
+    Text parts are kept 8bit; the connection re-encodes them if the relay
+    turns out not to support 8BITMIME. The bytes are DKIM-signed if
+    signing is configured.
+    """
+
+    encoding = None
+
+    def __init__(self, from_email, to, data, subject=''):
+        self.from_email = from_email
+        self.to = to
+        self.data = data
+        # For the delivery log only.
+        self.subject = subject
+
+    @classmethod
+    def from_email_message(cls, email):
+        return cls(email.from_email, email.recipients(), wire.serialize(email, eightbit=True), email.subject)
+
+    def recipients(self):
+        return list(self.to)
+
+    def message(self):
+        # Stands in for the MIME object; only as_bytes() is ever called.
+        return self
+
+    def as_bytes(self, linesep='\r\n'):
+        return self.data
+
+
+def prepare_batch(emails, executor=None):
+    """
+    PreparedMessages for ``emails``, DKIM-signed together: in the worker
+    processes of ``executor`` when the batch is big enough (see
+    dkim.sign_batch()). Serializing stays in this process.
+    """
+    datas = dkim.sign_batch([wire.serialize(email, eightbit=True, sign=False) for email in emails], executor)
+    return [
+        PreparedMessage(email.from_email, email.recipients(), data, email.subject)
+        for email, data in zip(emails, datas)
+    ]
@@ -0,0 +1,216 @@
+"""
+Low-overhead SMTP latency histograms shared across gunicorn workers.
+
+Each gunicorn worker writes into its own memory-mapped file in
+EMAIL_METRICS_DIR (one fixed-size array of float64 per process), so
+recording an observation is a bisect plus a few in-place float updates
+with no syscalls. The metrics endpoint sums every file in the directory and
+renders the Prometheus text exposition format. Other processes (management
+commands, the dev server, tests) keep their array in memory, and the
+gunicorn master folds an exited worker's file into metrics-retired.bin.
+
+capture() additionally collects the phases observed in the current context,
+so a caller can report the breakdown of its own send.
+"""
+
+import bisect
+import contextvars
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Upper bounds in seconds; an implicit +Inf bucket follows.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# dns/connect/tls_handshake/greeting: opening the connection (tls_handshake
+# only for implicit TLS); starttls includes the EHLO repeated after it;
+# encode: serializing a message to bytes (see wire.py); sign: DKIM-signing
+# it (see dkim.py; recorded where the signing runs); mail/rcpt/data: the
+# envelope and body of each message (with PIPELINING, MAIL/RCPT/DATA go out
+# together and are recorded as "mail"); send: one message end to end as
+# seen by the backend once a connection is open, including any
+# reconnect-and-retry.
+PHASES = (
+    'dns', 'connect', 'tls_handshake', 'greeting', 'ehlo', 'starttls',
+    'auth', 'encode', 'sign', 'mail', 'rcpt', 'data', 'send',
+)
+OUTCOMES = ('success', 'failure')
+
+_SLOTS_PER_PHASE = len(BUCKETS) + 1 + 2  # buckets, +Inf, sum, count
+_PHASE_INDEX = {phase: i * _SLOTS_PER_PHASE for i, phase in enumerate(PHASES)}
+_OUTCOME_INDEX = {
+    outcome: len(PHASES) * _SLOTS_PER_PHASE + i for i, outcome in enumerate(OUTCOMES)
+}
+_NUM_SLOTS = len(PHASES) * _SLOTS_PER_PHASE + len(OUTCOMES)
+_SIZE = _NUM_SLOTS * 8
+
+_lock = threading.Lock()
+_trace = contextvars.ContextVar('email_metrics_trace', default=None)
+_values = None
+_values_pid = None
+_shared = False
+
+
+def share():
+    """
+    Keep this process's metrics in a file in EMAIL_METRICS_DIR from now
+    on, where every worker's metrics endpoint sums them. gunicorn calls
+    this in each worker it forks (see gunicorn_config.post_fork).
+    """
+    global _shared, _values_pid
+    with _lock:
+        _shared = True
+        _values_pid = None
+
+
+def _get_values():
+    """Return this process's float64 view, mapping it on first use."""
+    global _values, _values_pid
+    pid = os.getpid()
+    if _values_pid != pid:
+        with _lock:
+            if _values_pid != pid:
+                if _shared:
+                    os.makedirs(settings.EMAIL_METRICS_DIR, exist_ok=True)
+                    path = os.path.join(settings.EMAIL_METRICS_DIR, f'metrics-{pid}.bin')
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        if os.fstat(fd).st_size != _SIZE:
+                            os.ftruncate(fd, _SIZE)
+                        buf = mmap.mmap(fd, _SIZE)
+                    finally:
+                        os.close(fd)
+                else:
+                    buf = mmap.mmap(-1, _SIZE)
+                _values = memoryview(buf).cast('d')
+                _values_pid = pid
+    return _values
+
+
+def observe(phase, seconds):
+    """Record ``seconds`` spent in ``phase``."""
+    trace = _trace.get()
+    if trace is not None:
+        trace[phase] = trace.get(phase, 0.0) + seconds * 1000
+    values = _get_values()
+    base = _PHASE_INDEX[phase]
+    with _lock:
+        values[base + bisect.bisect_left(BUCKETS, seconds)] += 1
+        values[base + len(BUCKETS) + 1] += seconds
+        values[base + len(BUCKETS) + 2] += 1
+
+
+def count_send(success):
+    values = _get_values()
+    with _lock:
+        values[_OUTCOME_INDEX['success' if success else 'failure']] += 1
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - started)
+
+
+@contextmanager
+def capture():
+    """Yield a dict filled with milliseconds per phase observed in the block."""
+    trace = {}
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+        for phase in trace:
+            trace[phase] = round(trace[phase], 2)
+
+
+def _read(path):
+    """The array in the file at ``path``, or None if it's missing or short."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(_SIZE)
+    except FileNotFoundError:
+        return None
+    return struct.unpack(f'{_NUM_SLOTS}d', data) if len(data) == _SIZE else None
+
+
+def collect():
+    """Sum the arrays of every worker (live or retired), or this process's own."""
+    if not _shared:
+        values = _get_values()
+        with _lock:
+            return list(values)
+    totals = [0.0] * _NUM_SLOTS
+    for path in glob.glob(os.path.join(settings.EMAIL_METRICS_DIR, 'metrics-*.bin')):
+        for i, value in enumerate(_read(path) or ()):
+            totals[i] += value
+    return totals
+
+
+def retire(directory, pid):
+    """
+    Add exited worker ``pid``'s file in ``directory`` to
+    metrics-retired.bin and remove it, so the totals don't drop. Called
+    by the gunicorn master (see gunicorn_config.child_exit).
+    """
+    path = os.path.join(directory, f'metrics-{pid}.bin')
+    values = _read(path)
+    if values is not None:
+        retired_path = os.path.join(directory, 'metrics-retired.bin')
+        retired = _read(retired_path) or [0.0] * _NUM_SLOTS
+        totals = [a + b for a, b in zip(retired, values)]
+        with open(f'{retired_path}.tmp', 'wb') as f:
+            f.write(struct.pack(f'{_NUM_SLOTS}d', *totals))
+        os.replace(f'{retired_path}.tmp', retired_path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def phase_totals():
+    """{phase: (count, seconds)} recorded by this process so far."""
+    values = _get_values()
+    with _lock:
+        return {
+            phase: (values[base + len(BUCKETS) + 2], values[base + len(BUCKETS) + 1])
+            for phase, base in _PHASE_INDEX.items()
+        }
+
+
+def _format_value(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def render_prometheus():
+    totals = collect()
+    lines = [
+        '# HELP email_smtp_phase_seconds Time spent in each phase of sending through SMTP.',
+        '# TYPE email_smtp_phase_seconds histogram',
+    ]
+    for phase in PHASES:
+        base = _PHASE_INDEX[phase]
+        cumulative = 0.0
+        for i, bound in enumerate(BUCKETS + (float('inf'),)):
+            cumulative += totals[base + i]
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'email_smtp_phase_seconds_bucket{{phase="{phase}",le="{le}"}} {_format_value(cumulative)}')
+        lines.append(f'email_smtp_phase_seconds_sum{{phase="{phase}"}} {_format_value(totals[base + len(BUCKETS) + 1])}')
+        lines.append(f'email_smtp_phase_seconds_count{{phase="{phase}"}} {_format_value(totals[base + len(BUCKETS) + 2])}')
+    lines += [
+        '# HELP email_sends_total Messages sent over an open SMTP connection, by outcome.',
+        '# TYPE email_sends_total counter',
+    ]
+    for outcome in OUTCOMES:
+        lines.append(f'email_sends_total{{outcome="{outcome}"}} {_format_value(totals[_OUTCOME_INDEX[outcome]])}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,36 @@
+# Generated by Django 6.0.1 on 2026-10-17 03:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_test', '0002_idempotency_cache_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('to_email', models.CharField(max_length=254)),
+                ('from_email', models.CharField(blank=True, default='', max_length=254)),
+                ('subject', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('spooled', 'Spooled'), ('failed', 'Failed')], max_length=16)),
+                ('code', models.CharField(blank=True, default='', max_length=32)),
+                ('smtp_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('reply', models.TextField(blank=True, default='')),
+                ('duration_ms', models.FloatField()),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('relay', models.CharField(blank=True, default='', max_length=255)),
+                ('profile', models.CharField(blank=True, default='', max_length=64)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['to_email', 'id'], name='delivery_log_to_email_id'), models.Index(fields=['status', 'id'], name='delivery_log_status_id'), models.Index(fields=['created_at'], name='delivery_log_created_at')],
+            },
+        ),
+    ]
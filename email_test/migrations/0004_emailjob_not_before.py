@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_test', '0003_delivery_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailjob',
+            name='not_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
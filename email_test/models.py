@@ -1,3 +1,84 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class EmailJob(models.Model):
+    """A message accepted by a send endpoint and waiting to be delivered."""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    payload = models.JSONField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    lease_owner = models.CharField(max_length=64, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # Not claimed before this time: retry backoff, or a deferred job's turn.
+    not_before = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='email_job_status_created'),
+            models.Index(fields=['lease_owner'], name='email_job_lease_owner'),
+        ]
+
+    def __str__(self):
+        return f'{self.payload.get("to_email", "?")} ({self.status})'
+
+
+class DeliveryLog(models.Model):
+    """
+    The outcome of sending one message to one recipient. Written in
+    batches by email_test.deliverylog, so rows appear a moment after the send.
+    """
+
+    STATUS_SENT = 'sent'
+    STATUS_SPOOLED = 'spooled'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_SENT, 'Sent'),
+        (STATUS_SPOOLED, 'Spooled'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    created_at = models.DateTimeField(default=timezone.now)
+    to_email = models.CharField(max_length=254)
+    from_email = models.CharField(max_length=254, blank=True, default='')
+    subject = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES)
+    code = models.CharField(max_length=32, blank=True, default='')
+    smtp_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    # The relay's reply to DATA, or the error for a failed send
+    reply = models.TextField(blank=True, default='')
+    duration_ms = models.FloatField()
+    attempts = models.PositiveIntegerField(default=1)
+    relay = models.CharField(max_length=255, blank=True, default='')
+    profile = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        ordering = ['-id']
+        # Queries page by id (keyset), so the filters lead and id follows.
+        indexes = [
+            models.Index(fields=['to_email', 'id'], name='delivery_log_to_email_id'),
+            models.Index(fields=['status', 'id'], name='delivery_log_status_id'),
+            models.Index(fields=['created_at'], name='delivery_log_created_at'),
+        ]
 
-# Create your models here.
+    def __str__(self):
+        return f'{self.to_email} ({self.status})'
@@ -0,0 +1,127 @@
+"""
+Durable outbound queue backed by the EmailJob table.
+
+Web workers call enqueue(); one or more drain_email_queue processes lease
+batches with claim_batch(), send them and record the outcome. A lease that
+expires (because its drain process died) makes the job claimable again.
+A job put back for another try waits until its ``not_before`` time.
+"""
+
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import EmailJob
+
+
+def enqueue(payload):
+    """Store a send payload and return the new EmailJob."""
+    return EmailJob.objects.create(payload=payload)
+
+
+def claim_batch(owner, batch_size=100, lease_seconds=60):
+    """
+    Lease up to ``batch_size`` deliverable jobs to ``owner`` and return them.
+
+    The UPDATE re-checks the claimable condition, so two drain processes
+    racing for the same rows can never both win one.
+    """
+    now = timezone.now()
+    due = Q(not_before__isnull=True) | Q(not_before__lte=now)
+    claimable = (Q(status=EmailJob.STATUS_QUEUED) & due) | Q(
+        status=EmailJob.STATUS_SENDING, lease_expires_at__lt=now
+    )
+    with transaction.atomic():
+        ids = list(
+            EmailJob.objects.filter(claimable)
+            .order_by('created_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        EmailJob.objects.filter(claimable, id__in=ids).update(
+            status=EmailJob.STATUS_SENDING,
+            lease_owner=owner,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+    return list(
+        EmailJob.objects.filter(
+            id__in=ids, lease_owner=owner, status=EmailJob.STATUS_SENDING
+        ).order_by('created_at')
+    )
+
+
+def _leased(owner, ids):
+    """The jobs in ``ids`` that ``owner`` still holds the lease on."""
+    return EmailJob.objects.filter(id__in=ids, lease_owner=owner, status=EmailJob.STATUS_SENDING)
+
+
+def renew(job, owner, lease_seconds):
+    """
+    Extend ``owner``'s lease on ``job`` to ``lease_seconds`` from now.
+    False if the lease was lost (it expired and another process took the
+    job), in which case ``owner`` must not send it.
+    """
+    now = timezone.now()
+    return bool(_leased(owner, [job.id]).update(
+        lease_expires_at=now + timedelta(seconds=lease_seconds), updated_at=now,
+    ))
+
+
+def mark_sent(jobs, owner):
+    """Mark the ``jobs`` that ``owner`` still holds as sent; return how many were."""
+    now = timezone.now()
+    return _leased(owner, [job.id for job in jobs]).update(
+        status=EmailJob.STATUS_SENT, sent_at=now, updated_at=now,
+        lease_owner='', lease_expires_at=None, not_before=None, last_error='',
+    )
+
+
+def retry_delay(attempts):
+    """
+    Seconds before attempt ``attempts + 1`` of a job: exponential from
+    EMAIL_QUEUE_RETRY_BASE_DELAY, with jitter so jobs that failed together
+    don't all come back at once.
+    """
+    ceiling = min(
+        settings.EMAIL_QUEUE_RETRY_MAX_DELAY,
+        settings.EMAIL_QUEUE_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0),
+    )
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def mark_failed(job, owner, error, max_attempts, permanent=False):
+    """
+    Requeue ``job`` for another attempt after retry_delay(), or fail it
+    once attempts run out (or straight away if the error is
+    ``permanent``). False if ``owner`` no longer holds the lease, so the
+    job's current holder decides.
+    """
+    now = timezone.now()
+    if permanent or job.attempts >= max_attempts:
+        status, not_before = EmailJob.STATUS_FAILED, None
+    else:
+        status, not_before = EmailJob.STATUS_QUEUED, now + timedelta(seconds=retry_delay(job.attempts))
+    return bool(_leased(owner, [job.id]).update(
+        status=status, last_error=str(error), updated_at=now,
+        lease_owner='', lease_expires_at=None, not_before=not_before,
+    ))
+
+
+def defer(job, owner, seconds, error=''):
+    """
+    Requeue ``job`` without counting the attempt, claimable again in
+    ``seconds``. For jobs that were never tried: rate limited, or their
+    relay is down this batch.
+    """
+    now = timezone.now()
+    return bool(_leased(owner, [job.id]).update(
+        status=EmailJob.STATUS_QUEUED, attempts=F('attempts') - 1, last_error=str(error), updated_at=now,
+        lease_owner='', lease_expires_at=None, not_before=now + timedelta(seconds=seconds),
+    ))
@@ -0,0 +1,276 @@
+"""
+Per-process pool of authenticated SMTP connections.
+
+Each gunicorn worker keeps its own pools; connections are never shared
+across processes. A pool created before a fork is discarded (without
+sending QUIT on the inherited socket) the first time the child uses it.
+
+There is one pool per key (relay settings, or SMTP profile), each with its
+own size cap. With many profiles the pools together could hold more
+sockets than the process should, so every pool also draws on one
+ConnectionBudget of EMAIL_POOL_MAX_TOTAL connections. When the budget is
+spent, the least recently used idle connection of any pool is closed to
+make room.
+"""
+
+import os
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class PoolExhausted(smtplib.SMTPException):
+    """Raised when no connection becomes available within the acquire timeout."""
+
+
+class PooledConnection:
+    """An open SMTP connection plus the bookkeeping the pool needs."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+        self.broken = False
+
+
+class ConnectionBudget:
+    """
+    Caps the open connections of all pools together (0 means no cap) and
+    tracks idle ones across pools, least recently used first.
+
+    Pools call in while holding their own lock, so the budget never takes
+    a pool's lock while holding its own.
+    """
+
+    def __init__(self, max_total=0):
+        self.max_total = max_total
+        self.open = 0
+        self.evictions = 0
+        self._idle = OrderedDict()  # PooledConnection -> pool
+        self._cond = threading.Condition()
+
+    def reserve(self, deadline):
+        """Claim a slot for a new connection, evicting idle ones if needed."""
+        while True:
+            with self._cond:
+                if not self.max_total or self.open < self.max_total:
+                    self.open += 1
+                    return True
+                victim = self._idle.popitem(last=False) if self._idle else None
+                if victim is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                    continue
+            pooled, pool = victim
+            # False if the pool handed it out since; then try the next one.
+            if pool.evict(pooled):
+                with self._cond:
+                    self.evictions += 1
+
+    def idle(self, pooled, pool):
+        with self._cond:
+            self._idle[pooled] = pool
+            self._idle.move_to_end(pooled)
+            # A waiting reserve() can evict this one.
+            self._cond.notify()
+
+    def busy(self, pooled):
+        with self._cond:
+            self._idle.pop(pooled, None)
+
+    def closed(self, pooled=None):
+        with self._cond:
+            self.open -= 1
+            if pooled is not None:
+                self._idle.pop(pooled, None)
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'open': self.open,
+                'idle': len(self._idle),
+                'max_total': self.max_total,
+                'evictions': self.evictions,
+            }
+
+
+class SMTPConnectionPool:
+    """
+    Keep up to ``max_size`` authenticated connections warm for reuse.
+
+    ``connect`` is a zero-argument callable returning a fully configured
+    (connected, STARTTLS'd, authenticated) ``smtplib.SMTP`` instance.
+    """
+
+    def __init__(self, connect, max_size=4, idle_timeout=30, max_messages=100,
+                 acquire_timeout=10, budget=None):
+        self.connect = connect
+        self.budget = budget or ConnectionBudget()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self._idle) + self._in_use
+
+    def acquire(self):
+        """Return a healthy PooledConnection, reusing an idle one if possible."""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            pooled = self._take(deadline)
+            if pooled is None:
+                break
+            # NOOP and QUIT go out without the lock, so a slow relay
+            # doesn't hold up every other acquire() and release().
+            if self._is_reusable(pooled):
+                return pooled
+            self._discard(pooled)
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+        # Connect outside the lock so a slow handshake doesn't block releases.
+        reserved = False
+        try:
+            reserved = self.budget.reserve(deadline)
+            if not reserved:
+                raise PoolExhausted(
+                    f'No SMTP connection available after {self.acquire_timeout}s '
+                    f'(EMAIL_POOL_MAX_TOTAL {self.budget.max_total} in use)'
+                )
+            return PooledConnection(self.connect())
+        except BaseException:
+            if reserved:
+                self.budget.closed()
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _take(self, deadline):
+        """
+        Claim a slot: an idle connection (not yet checked), or None when
+        there is room for a new one. Raises PoolExhausted at ``deadline``.
+        """
+        with self._cond:
+            while True:
+                if self._idle:
+                    pooled = self._idle.pop()
+                    self._in_use += 1
+                    self.budget.busy(pooled)
+                    return pooled
+                if self.size < self.max_size:
+                    self._in_use += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise PoolExhausted(
+                        f'No SMTP connection available after {self.acquire_timeout}s '
+                        f'(pool size {self.max_size})'
+                    )
+
+    def release(self, pooled):
+        """Return a connection to the pool, closing it if it shouldn't be reused."""
+        pooled.last_used = time.monotonic()
+        discard = pooled.broken or pooled.messages_sent >= self.max_messages
+        if discard:
+            self._discard(pooled)
+        with self._cond:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append(pooled)
+                self.budget.idle(pooled, self)
+            self._cond.notify()
+
+    def evict(self, pooled):
+        """Close ``pooled`` if it is still idle here; return whether it was."""
+        with self._cond:
+            if pooled not in self._idle:
+                return False
+            self._idle.remove(pooled)
+            self._cond.notify()
+        self._discard(pooled)
+        return True
+
+    def close_all(self):
+        """Close every idle connection. In-use connections close on release."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._discard(pooled)
+
+    def _is_reusable(self, pooled):
+        if time.monotonic() - pooled.last_used > self.idle_timeout:
+            return False
+        if pooled.messages_sent >= self.max_messages:
+            return False
+        try:
+            code, _ = pooled.connection.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def _discard(self, pooled):
+        try:
+            pooled.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pooled.connection.close()
+        finally:
+            self.budget.closed(pooled)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+_budget = None
+
+
+def get_budget():
+    """The process-wide ConnectionBudget, sized from EMAIL_POOL_MAX_TOTAL."""
+    global _budget
+    if _budget is None:
+        _budget = ConnectionBudget(settings.EMAIL_POOL_MAX_TOTAL)
+    return _budget
+
+
+def get_pool(key, connect, **options):
+    """Return the process-wide pool for ``key``, creating it on first use."""
+    global _pools_pid, _budget
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Forked: the parent's sockets belong to the parent.
+            _pools.clear()
+            _budget = None
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPConnectionPool(connect, budget=get_budget(), **options)
+        return pool
+
+
+def snapshot():
+    """Connection counts across this process's pools, for /api/email/config/."""
+    with _pools_lock:
+        pools = len(_pools)
+        budget = get_budget()
+    result = budget.snapshot()
+    result['pools'] = pools
+    return result
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
@@ -0,0 +1,430 @@
+"""
+Single-connection SMTP/TLS probe shared by check_smtp_cert and
+/api/email/probe/.
+
+probe() reads the greeting, runs EHLO and STARTTLS (or implicit TLS on
+port 465) and makes one TLS handshake without verification, so the peer
+certificate chain is captured even when it is invalid. The chain is then
+verified against the same trust store the send path uses, with
+cryptography, in the same pass; a bad certificate no longer needs a second
+connection to be described. Replies are read with ReplyParser, an
+incremental parser fed straight from recv(), and every socket operation
+counts against one overall deadline.
+
+Parsed certificates are kept per process by SHA-256 fingerprint, so a
+certificate that has not changed since the last probe is not parsed
+again. cached_probe() keeps results per process for
+EMAIL_PROBE_CACHE_TTL seconds, and concurrent callers for the same relay
+share one probe.
+"""
+
+import hashlib
+import ipaddress
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from . import health, profiles, transport
+
+# RFC 5321 4.5.3.1.5 caps reply lines at 512 octets; allow for sloppy servers.
+MAX_LINE_LENGTH = 8192
+
+CERTIFICATE_CACHE_SIZE = 1024
+
+_lock = threading.Lock()
+_results = {}
+_inflight = {}
+_stores = {}
+_certificates = OrderedDict()
+_stats = {'certificates_parsed': 0, 'certificate_cache_hits': 0}
+
+
+def load_x509():
+    """
+    Import cryptography's x509 module on first use, or return None if the
+    package is missing. Importing it costs ~60ms, so it is kept off the
+    startup path of everything that merely imports this module.
+    """
+    try:
+        from cryptography import x509
+    except ImportError:
+        return None
+    return x509
+
+
+class ProbeError(Exception):
+    pass
+
+
+class ReplyParser:
+    """Incremental SMTP reply parser: feed() it bytes as they arrive."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._lines = []
+
+    def feed(self, data):
+        """Return the (code, lines) replies completed by ``data``."""
+        self._buffer += data
+        replies = []
+        start = 0
+        while (end := self._buffer.find(b'\n', start)) >= 0:
+            line = bytes(self._buffer[start:end]).rstrip(b'\r')
+            start = end + 1
+            if not line[:3].isdigit() or line[3:4] not in (b'', b' ', b'-'):
+                raise ProbeError(f'Malformed SMTP reply line: {line[:80]!r}')
+            self._lines.append(line[4:].decode('utf-8', errors='replace'))
+            if line[3:4] != b'-':
+                replies.append((int(line[:3]), self._lines))
+                self._lines = []
+        del self._buffer[:start]
+        if len(self._buffer) > MAX_LINE_LENGTH:
+            raise ProbeError('SMTP reply line too long')
+        return replies
+
+    @property
+    def idle(self):
+        """Whether no part of a reply is waiting to be completed."""
+        return not self._buffer and not self._lines
+
+
+class _Session:
+    """Send commands and read replies on ``sock`` until ``deadline``."""
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.deadline = deadline
+        self.parser = ReplyParser()
+        self.replies = []
+
+    def settimeout(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('Probe timed out')
+        self.sock.settimeout(remaining)
+
+    def reply(self):
+        while not self.replies:
+            self.settimeout()
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError('Connection closed during SMTP handshake')
+            self.replies.extend(self.parser.feed(data))
+        return self.replies.pop(0)
+
+    def command(self, line, expect):
+        self.settimeout()
+        self.sock.sendall(line.encode('ascii') + b'\r\n')
+        code, lines = self.reply()
+        if code != expect:
+            raise ProbeError(f'{line.split()[0]} refused: {code} {" ".join(lines)}')
+        return lines
+
+    def starttls(self, context, host, port, resume):
+        self.command('STARTTLS', 220)
+        if self.replies or not self.parser.idle:
+            # Anything sent before the handshake could be injected
+            # plaintext (CVE-2011-0411 style); a sane server sends nothing.
+            raise ProbeError('Server sent data after its STARTTLS reply')
+        self.settimeout()
+        self.sock = transport.wrap_socket(context, self.sock, host, port, resume=resume)
+
+
+def _connect(addrinfo, deadline):
+    error = None
+    for family, socktype, proto, _, address in addrinfo:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError('getaddrinfo returned no addresses')
+
+
+def _peer_chain(sock):
+    """The DER certificates the peer sent, leaf first (just the leaf if unavailable)."""
+    try:
+        chain = sock.get_unverified_chain()
+    except AttributeError:
+        # Before Python 3.13 the method is only on the C-level object, which
+        # is private; if that changes as well, make do with the leaf.
+        try:
+            chain = sock._sslobj.get_unverified_chain()
+            chain = [cert.public_bytes(ssl._ssl.ENCODING_DER) for cert in chain or ()]
+        except AttributeError:
+            chain = None
+    # A resumed session may not carry the chain; the leaf is always there.
+    return list(chain or ()) or [sock.getpeercert(binary_form=True)]
+
+
+def _trust_store(x509):
+    """cryptography Store of the CAs the shared SSL context trusts, built once per context."""
+    from cryptography.x509.verification import Store
+
+    context = transport.get_ssl_context()
+    with _lock:
+        entry = _stores.get(id(context))
+        if entry is not None and entry[0] is context:
+            return entry[1]
+    certs = [x509.load_der_x509_certificate(der) for der in context.get_ca_certs(binary_form=True)]
+    store = Store(certs) if certs else None
+    with _lock:
+        _stores[id(context)] = (context, store)
+    return store
+
+
+def _certificate(x509, der):
+    """(fingerprint, certificate, fields) for ``der``, parsed once per fingerprint."""
+    fingerprint = hashlib.sha256(der).hexdigest()
+    with _lock:
+        entry = _certificates.get(fingerprint)
+        if entry is not None:
+            _certificates.move_to_end(fingerprint)
+            _stats['certificate_cache_hits'] += 1
+            return entry
+
+    cert = x509.load_der_x509_certificate(der)
+    try:
+        common_name = cert.subject.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)[0].value
+    except IndexError:
+        common_name = None
+    try:
+        issuer_cn = cert.issuer.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)[0].value
+    except IndexError:
+        issuer_cn = None
+    try:
+        san_ext = cert.extensions.get_extension_for_oid(x509.oid.ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        sans = san_ext.value.get_values_for_type(x509.DNSName)
+        sans += [str(ip) for ip in san_ext.value.get_values_for_type(x509.IPAddress)]
+    except x509.ExtensionNotFound:
+        sans = []
+    fields = {
+        'common_name': common_name,
+        'issuer': issuer_cn,
+        'sans': tuple(sans),
+        'not_before': cert.not_valid_before_utc,
+        'not_after': cert.not_valid_after_utc,
+    }
+    entry = fingerprint, cert, fields
+    with _lock:
+        _stats['certificates_parsed'] += 1
+        _certificates[fingerprint] = entry
+        while len(_certificates) > CERTIFICATE_CACHE_SIZE:
+            _certificates.popitem(last=False)
+    return entry
+
+
+def verify_chain(chain, host):
+    """Return None if ``chain`` (DER, leaf first) is valid for ``host``, else why not."""
+    x509 = load_x509()
+    if x509 is None:
+        return 'cryptography is not installed'
+    from cryptography.x509 import verification
+
+    store = _trust_store(x509)
+    if store is None:
+        return 'No trusted CA certificates are loaded'
+    leaf, *intermediates = [_certificate(x509, der)[1] for der in chain]
+    try:
+        try:
+            subject = verification.IPAddress(ipaddress.ip_address(host))
+        except ValueError:
+            subject = verification.DNSName(host)
+        verifier = verification.PolicyBuilder().store(store).build_server_verifier(subject)
+        verifier.verify(leaf, intermediates)
+    except (verification.VerificationError, ValueError) as e:
+        return str(e)
+    return None
+
+
+def hostname_matches(host, names):
+    """RFC 6125 style match: exact, or a single leftmost-label wildcard."""
+    host = host.lower().rstrip('.')
+    for name in names:
+        name = name.lower().rstrip('.')
+        if name == host:
+            return True
+        if name.startswith('*.') and '.' in host and host.split('.', 1)[1] == name[2:]:
+            return True
+    return False
+
+
+def describe_certificate(cert_der, host):
+    """Subject, issuer, SANs, validity and hostname match of a DER certificate."""
+    x509 = load_x509()
+    if x509 is None:
+        return {'fingerprint_sha256': hashlib.sha256(cert_der).hexdigest()}
+    fingerprint, _, fields = _certificate(x509, cert_der)
+    sans = list(fields['sans'])
+    return {
+        'common_name': fields['common_name'],
+        'issuer': fields['issuer'],
+        'sans': sans,
+        'not_before': fields['not_before'].isoformat(),
+        'not_after': fields['not_after'].isoformat(),
+        'days_until_expiry': (fields['not_after'] - datetime.now(timezone.utc)).days,
+        'hostname_match': hostname_matches(host, sans or [fields['common_name'] or '']),
+        'fingerprint_sha256': fingerprint,
+    }
+
+
+def probe(host, port, timeout=10, implicit_tls=None, resume=False, ehlo_name='localhost'):
+    """
+    Check the SMTP/TLS endpoint host:port over one connection; never
+    raises, failures are reported in the ``error`` field.
+
+    ``implicit_tls`` defaults to port 465. With ``resume`` the last TLS
+    session for the endpoint is resumed; the certificate is then the one
+    from the original session. ``ok`` means the chain verified, the
+    hostname matches and the certificate has not expired.
+    """
+    if implicit_tls is None:
+        implicit_tls = port == 465
+    result = {
+        'host': host, 'port': port, 'ok': False,
+        'tls': 'implicit' if implicit_tls else 'starttls', 'timings_ms': {},
+    }
+    timings = result['timings_ms']
+    started = phase_start = time.perf_counter()
+    deadline = time.monotonic() + timeout
+
+    def mark(phase):
+        nonlocal phase_start
+        now = time.perf_counter()
+        timings[phase] = round((now - phase_start) * 1000, 2)
+        phase_start = now
+
+    context = transport.get_ssl_context(verify=False)
+    session = None
+    try:
+        addrinfo = transport.resolve(host, port)
+        mark('dns')
+        session = _Session(_connect(addrinfo, deadline), deadline)
+        mark('connect')
+        if implicit_tls:
+            session.settimeout()
+            session.sock = transport.wrap_socket(context, session.sock, host, port, resume=resume)
+            mark('tls_handshake')
+
+        code, lines = session.reply()
+        result['greeting'] = ' '.join(lines)
+        if code != 220:
+            raise ProbeError(f'Greeting refused: {code} {result["greeting"]}')
+        mark('greeting')
+        result['extensions'] = session.command(f'EHLO {ehlo_name}', 250)[1:]
+        mark('ehlo')
+        if not implicit_tls:
+            if not any(line.upper().split()[:1] == ['STARTTLS'] for line in result['extensions']):
+                raise ProbeError('STARTTLS is not offered')
+            session.starttls(context, host, port, resume)
+            mark('tls_handshake')
+            # RFC 3207: the extensions may differ once TLS is up (e.g. AUTH).
+            result['extensions'] = session.command(f'EHLO {ehlo_name}', 250)[1:]
+            mark('ehlo_tls')
+        if resume:
+            # A TLS 1.3 ticket has arrived with the EHLO reply by now.
+            transport.save_session(session.sock, host, port)
+
+        result['tls_version'] = session.sock.version()
+        result['cipher'] = session.sock.cipher()[0]
+        result['tls_resumed'] = session.sock.session_reused
+        chain = _peer_chain(session.sock)
+        result.update(describe_certificate(chain[0], host))
+        mark('parse')
+        result['chain_length'] = len(chain)
+        result['verify_error'] = verify_chain(chain, host)
+        result['verified'] = result['verify_error'] is None
+        mark('verify')
+        result['ok'] = (
+            result['verified'] and result.get('hostname_match', False)
+            and result.get('days_until_expiry', -1) >= 0
+        )
+        try:
+            session.sock.sendall(b'QUIT\r\n')
+        except OSError:
+            pass
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        if session is not None:
+            session.sock.close()
+        timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
+
+def relay_endpoints():
+    """
+    {(host, port): implicit_tls} for every relay the app sends through:
+    EMAIL_HOSTS (or EMAIL_HOST) and the SMTP profiles. implicit_tls is
+    None where the port decides.
+    """
+    endpoints = {target: settings.EMAIL_USE_SSL or None for target in health.relay_targets()}
+    for name in profiles.names():
+        profile = profiles.get_profile(name)
+        target = (profile.get('host', settings.EMAIL_HOST), int(profile.get('port', settings.EMAIL_PORT)))
+        endpoints[target] = profile.get('use_ssl', settings.EMAIL_USE_SSL) or None
+    return endpoints
+
+
+def cached_probe(host, port, implicit_tls=None, refresh=False):
+    """
+    Return (result, cached) for host:port, probing at most once per
+    EMAIL_PROBE_CACHE_TTL seconds in this process. A caller that finds a
+    probe of the same endpoint in flight waits for its result instead of
+    connecting as well; ``refresh`` skips the cached result, not the wait.
+    """
+    key = (host, port, implicit_tls)
+    while True:
+        with _lock:
+            entry = _results.get(key)
+            if entry is not None and not refresh and time.monotonic() < entry[0]:
+                return entry[1], True
+            event = _inflight.get(key)
+            if event is None:
+                event = _inflight[key] = threading.Event()
+                break
+        event.wait()
+        # The probe that just finished is as fresh as a new one.
+        refresh = False
+
+    try:
+        result = probe(host, port, timeout=settings.EMAIL_PROBE_TIMEOUT, implicit_tls=implicit_tls)
+        result['checked_at'] = datetime.now(timezone.utc).isoformat()
+        with _lock:
+            _results[key] = (time.monotonic() + settings.EMAIL_PROBE_CACHE_TTL, result)
+    finally:
+        with _lock:
+            del _inflight[key]
+        event.set()
+    return result, False
+
+
+def cache_age(result):
+    """Seconds since ``result`` (from cached_probe) was taken."""
+    checked_at = datetime.fromisoformat(result['checked_at'])
+    return max(0, int((datetime.now(timezone.utc) - checked_at).total_seconds()))
+
+
+def snapshot():
+    """Certificate cache counters for this process."""
+    with _lock:
+        return {**_stats, 'cached_certificates': len(_certificates)}
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    _results.clear()
+    _inflight.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
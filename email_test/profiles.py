@@ -0,0 +1,119 @@
+"""
+Named SMTP profiles, for tenants that each have their own relay and login.
+
+EMAIL_PROFILES maps a profile name to the settings that differ from the
+EMAIL_* defaults, e.g.
+    {"acme": {"host": "smtp.acme.example", "port": 587,
+              "username": "mailer", "password": "...",
+              "from_email": "noreply@acme.example", "max_connections": 2}}
+
+Sends name a profile with "profile" in their payload. Each profile gets a
+pooled backend with its own pool of warm connections, capped at its
+``max_connections``. Idle connections from all profiles share the
+EMAIL_POOL_MAX_TOTAL budget, and the least recently used ones are closed
+first (see pool.py).
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection as django_get_connection
+from django.utils.module_loading import import_string
+
+# Profile keys that become backend arguments; the rest is handled here.
+CONNECTION_FIELDS = ('host', 'port', 'username', 'password', 'use_tls', 'use_ssl', 'timeout')
+FIELDS = CONNECTION_FIELDS + ('from_email', 'max_connections', 'backend')
+
+DEFAULT_BACKEND = 'email_test.backends.PooledEmailBackend'
+
+
+def names():
+    return sorted(settings.EMAIL_PROFILES)
+
+
+def get_profile(name):
+    """Return the settings for profile ``name``; ValueError if there is none."""
+    if not isinstance(name, str):
+        raise ValueError('profile must be a string')
+    try:
+        profile = settings.EMAIL_PROFILES[name]
+    except KeyError:
+        raise ValueError(f'Unknown SMTP profile: {name}')
+    unknown = set(profile) - set(FIELDS)
+    if unknown:
+        raise ImproperlyConfigured(f'EMAIL_PROFILES[{name!r}] has unknown keys: {", ".join(sorted(unknown))}')
+    return profile
+
+
+def from_email(name=None):
+    """The sender address for profile ``name`` (DEFAULT_FROM_EMAIL without one)."""
+    if not name:
+        return settings.DEFAULT_FROM_EMAIL
+    return get_profile(name).get('from_email') or settings.DEFAULT_FROM_EMAIL
+
+
+def _backend_path(profile):
+    if profile.get('backend'):
+        return profile['backend']
+    # Use the configured backend if it pools per relay; the failover
+    # backend picks its own relays from EMAIL_HOSTS, so it can't be used.
+    from .backends import FailoverEmailBackend, PooledEmailBackend
+    backend = import_string(settings.EMAIL_BACKEND)
+    if issubclass(backend, PooledEmailBackend) and not issubclass(backend, FailoverEmailBackend):
+        return settings.EMAIL_BACKEND
+    return DEFAULT_BACKEND
+
+
+def get_connection(name=None, **kwargs):
+    """A backend for profile ``name``, or the default backend without one."""
+    if not name:
+        return django_get_connection(**kwargs)
+    profile = get_profile(name)
+    options = {key: profile[key] for key in CONNECTION_FIELDS if key in profile}
+    options.update(kwargs)
+    return django_get_connection(
+        _backend_path(profile),
+        profile=name,
+        max_connections=profile.get('max_connections'),
+        **options,
+    )
+
+
+class Connections:
+    """
+    One connection per profile for a run of sends (a batch, a queue
+    drain), opened on first use. close() closes or releases them all.
+    """
+
+    def __init__(self):
+        self._connections = {}
+
+    def get(self, name=None):
+        connection = self._connections.get(name)
+        if connection is None:
+            connection = self._connections[name] = get_connection(name)
+        return connection
+
+    def close(self):
+        for connection in self._connections.values():
+            try:
+                connection.close()
+            except OSError:
+                pass
+        self._connections.clear()
+
+
+def snapshot():
+    """Profiles without their passwords, for /api/email/config/."""
+    result = {}
+    for name in names():
+        profile = get_profile(name)
+        result[name] = {
+            'host': profile.get('host', settings.EMAIL_HOST),
+            'port': profile.get('port', settings.EMAIL_PORT),
+            'use_tls': profile.get('use_tls', settings.EMAIL_USE_TLS),
+            'use_ssl': profile.get('use_ssl', settings.EMAIL_USE_SSL),
+            'from_email': from_email(name),
+            'has_credentials': bool(profile.get('username') and profile.get('password')),
+            'max_connections': profile.get('max_connections') or settings.EMAIL_POOL_MAX_SIZE,
+        }
+    return result
@@ -0,0 +1,178 @@
+"""
+Token-bucket send rate limits shared by every worker process.
+
+Buckets live in one memory-mapped file (EMAIL_RATELIMIT_FILE): a small
+open-addressing table of (key hash, tokens, last update) slots, updated
+under an flock so all gunicorn workers draw from the same buckets. The
+update times are wall-clock time, since the file outlives the processes
+(and the boot) that wrote it. There
+is one bucket per relay (EMAIL_RATE_LIMIT messages/second; an SMTP
+profile's relay has its own, see relay_key()) and one per
+recipient domain (EMAIL_DOMAIN_RATE_LIMITS, falling back to
+EMAIL_DOMAIN_RATE_LIMIT).
+
+reserve() takes the tokens a message needs and returns how long to wait
+before sending it; tokens may go negative, which queues later callers
+behind it. A wait longer than the caller allows raises RateLimited
+without taking anything.
+"""
+
+import fcntl
+import functools
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import profiles
+
+NUM_SLOTS = 4096
+MAX_PROBES = 16
+
+_SLOT = struct.Struct('<Qdd')  # key hash, tokens, last update (time.time())
+_SIZE = NUM_SLOTS * _SLOT.size
+
+_lock = threading.Lock()
+_state = None  # (pid, path, fd, mmap)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f'Send rate limit exceeded; retry after {retry_after:.2f}s')
+
+
+def _mapped():
+    """
+    Return (fd, mmap) for this process, reopening after a fork (flock is
+    per open file) or when EMAIL_RATELIMIT_FILE changes.
+    """
+    global _state
+    pid = os.getpid()
+    path = settings.EMAIL_RATELIMIT_FILE
+    if _state is None or _state[:2] != (pid, path):
+        if _state is not None and _state[0] == pid:
+            _state[3].close()
+            os.close(_state[2])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size != _SIZE:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != _SIZE:
+                    os.ftruncate(fd, _SIZE)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        _state = (pid, path, fd, mmap.mmap(fd, _SIZE))
+    return _state[2], _state[3]
+
+
+@contextmanager
+def _locked():
+    with _lock:
+        fd, buf = _mapped()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield buf
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@functools.lru_cache(maxsize=4096)
+def _key_hash(key):
+    # Never 0, which marks an empty slot.
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') | 1
+
+
+def _find_slot(buf, key_hash, rate, burst, now):
+    """Return (offset, tokens) for the key's bucket, refilled to ``now``."""
+    start = key_hash % NUM_SLOTS
+    lru = None
+    for i in range(MAX_PROBES):
+        offset = (start + i) % NUM_SLOTS * _SLOT.size
+        slot_hash, tokens, updated = _SLOT.unpack_from(buf, offset)
+        if slot_hash == key_hash:
+            # No refill while the clock is behind the last update (it was set back).
+            return offset, min(burst, tokens + max(0.0, now - updated) * rate)
+        if slot_hash == 0:
+            break
+        if lru is None or updated < lru[1]:
+            lru = (offset, updated)
+    else:
+        # Probe window full: evict the least recently used bucket in it.
+        offset = lru[0]
+    _SLOT.pack_into(buf, offset, key_hash, burst, now)
+    return offset, burst
+
+
+def relay_key(profile=None):
+    """
+    Bucket name for SMTP ``profile``'s relay, or for the configured
+    relay(s) without one. ValueError for an unknown profile.
+    """
+    if profile:
+        options = profiles.get_profile(profile)
+        return f'relay:{options.get("host", settings.EMAIL_HOST)}:{options.get("port", settings.EMAIL_PORT)}'
+    if settings.EMAIL_HOSTS:
+        return 'relays:' + ','.join(settings.EMAIL_HOSTS)
+    return f'relay:{settings.EMAIL_HOST}:{settings.EMAIL_PORT}'
+
+
+def buckets_for(recipients, relay=None):
+    """Return [(key, rate, burst, tokens needed)] for a message to ``recipients``."""
+    buckets = []
+    if settings.EMAIL_RATE_LIMIT > 0:
+        rate = settings.EMAIL_RATE_LIMIT
+        buckets.append((relay or relay_key(), rate, settings.EMAIL_RATE_LIMIT_BURST or max(1.0, rate), 1))
+    domains = Counter(addr.rpartition('@')[2].strip().rstrip('>').lower() for addr in recipients)
+    for domain, count in domains.items():
+        rate = settings.EMAIL_DOMAIN_RATE_LIMITS.get(domain, settings.EMAIL_DOMAIN_RATE_LIMIT)
+        if rate > 0:
+            buckets.append((f'domain:{domain}', rate, max(1.0, rate, count), count))
+    return buckets
+
+
+def reserve(recipients, max_wait=None, relay=None):
+    """
+    Reserve a send to ``recipients``; return the seconds to wait before
+    sending (0.0 if it may go now). Raises RateLimited if that would be
+    more than ``max_wait`` (default EMAIL_RATE_LIMIT_MAX_WAIT).
+    """
+    buckets = buckets_for(recipients, relay)
+    if not buckets:
+        return 0.0
+    if max_wait is None:
+        max_wait = settings.EMAIL_RATE_LIMIT_MAX_WAIT
+    with _locked() as buf:
+        now = time.time()
+        slots = []
+        wait = 0.0
+        for key, rate, burst, needed in buckets:
+            offset, tokens = _find_slot(buf, _key_hash(key), rate, burst, now)
+            slots.append((offset, tokens - needed))
+            if tokens < needed:
+                wait = max(wait, (needed - tokens) / rate)
+        if wait > max_wait:
+            raise RateLimited(wait)
+        for offset, tokens in slots:
+            struct.pack_into('<dd', buf, offset + 8, tokens, now)
+    return wait
+
+
+def acquire(recipients, max_wait=None, relay=None):
+    """reserve(), then sleep until the send may go."""
+    wait = reserve(recipients, max_wait, relay)
+    if wait:
+        time.sleep(wait)
+
+
+def retry_after_header(exc):
+    """Retry-After value (whole seconds) for a RateLimited error."""
+    return str(max(1, math.ceil(exc.retry_after)))
@@ -0,0 +1,179 @@
+"""
+Per-process health tracking for the SMTP relays listed in EMAIL_HOSTS (or
+EMAIL_HOST alone).
+
+Each relay keeps an exponentially weighted moving average of send latency
+and error rate, plus a circuit breaker: after EMAIL_RELAY_FAILURE_THRESHOLD
+consecutive failures the relay is ejected for EMAIL_RELAY_COOLDOWN seconds,
+then a single probe send is let through to decide whether to restore it.
+"""
+
+import random
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Smoothing factor for the moving averages: higher reacts faster.
+EWMA_ALPHA = 0.2
+# Latency assumed for a relay that has not been used yet, in seconds.
+INITIAL_LATENCY = 0.1
+
+
+class RelayUnavailable(smtplib.SMTPServerDisconnected):
+    """Raised instead of connecting while the circuit breaker has ejected every relay."""
+
+    def __init__(self, message='No SMTP relay is currently available', retry_after=None):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class RelayHealth:
+    def __init__(self, host, port, failure_threshold, cooldown):
+        self.host = host
+        self.port = port
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def weight(self):
+        """Relative share of traffic: fast, error-free relays weigh most."""
+        if self.state == OPEN:
+            return 0.0
+        latency = self.latency if self.latency is not None else INITIAL_LATENCY
+        return 1.0 / (max(latency, 0.001) * (1.0 + 10.0 * self.error_rate))
+
+    def is_available(self):
+        """Whether sends may be routed here (closed, or due a half-open probe)."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+            return self.state == CLOSED or (self.state == HALF_OPEN and not self._probing)
+
+    def retry_after(self):
+        """Seconds until an ejected relay is due its probe (0 unless open)."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def begin_attempt(self):
+        """Claim the single probe slot of a half-open relay; always True when closed."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def cancel_attempt(self):
+        """Give back an attempt that never reached the relay, recording nothing."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latency = latency if self.latency is None else (
+                EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+            )
+            self.error_rate *= 1 - EWMA_ALPHA
+            self.consecutive_failures = 0
+            self.state = CLOSED
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def snapshot(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'state': self.state,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'consecutive_failures': self.consecutive_failures,
+            'weight': round(self.weight, 3),
+        }
+
+
+_relays = None
+_relays_lock = threading.Lock()
+
+
+def parse_relay(value, default_port):
+    host, sep, port = value.strip().rpartition(':')
+    if not sep or not port.isdigit():
+        return value.strip(), default_port
+    return host, int(port)
+
+
+def get_relays():
+    """Return the RelayHealth objects for EMAIL_HOSTS (or EMAIL_HOST alone)."""
+    global _relays
+    with _relays_lock:
+        if _relays is None:
+            entries = settings.EMAIL_HOSTS or [f'{settings.EMAIL_HOST}:{settings.EMAIL_PORT}']
+            _relays = [
+                RelayHealth(
+                    *parse_relay(entry, settings.EMAIL_PORT),
+                    failure_threshold=settings.EMAIL_RELAY_FAILURE_THRESHOLD,
+                    cooldown=settings.EMAIL_RELAY_COOLDOWN,
+                )
+                for entry in entries
+            ]
+        return _relays
+
+
+def choose_relays():
+    """
+    Return the relays to try for one send, in order.
+
+    The first is drawn at random in proportion to weight, so faster relays
+    take more traffic without starving the others; the rest follow by
+    descending weight as failover candidates. Ejected relays are skipped
+    unless their cooldown has passed and they are due a probe; callers
+    must still call begin_attempt() before using each one.
+    """
+    candidates = [relay for relay in get_relays() if relay.is_available()]
+    if len(candidates) <= 1:
+        return candidates
+    weights = [relay.weight or 0.001 for relay in candidates]
+    first = random.choices(candidates, weights=weights)[0]
+    rest = sorted((r for r in candidates if r is not first), key=lambda r: r.weight, reverse=True)
+    return [first] + rest
+
+
+def find_relay(host, port):
+    """The RelayHealth for host:port, or None if it is not a configured relay."""
+    for relay in get_relays():
+        if (relay.host, relay.port) == (host, port):
+            return relay
+    return None
+
+
+def unavailable():
+    """RelayUnavailable with the time until the first relay is due a probe."""
+    return RelayUnavailable(retry_after=min((r.retry_after() for r in get_relays()), default=None))
+
+
+def snapshot():
+    return [relay.snapshot() for relay in get_relays()]
@@ -0,0 +1,194 @@
+"""
+Validation of the send endpoints' request bodies, before any SMTP work.
+
+limit_body() rejects an oversized body with 413 from its Content-Length,
+before it is read, and before Idempotency-Key hashing. parse() decodes a
+JSON send payload and clean() checks its fields: the types of the known
+fields, no line breaks in the subject, and a valid ``to_email``.
+
+Addresses are normalized by normalize_address(): the domain is converted
+to its ASCII (IDNA) form and lowercased, so "Ada@Bücher.DE" and
+"Ada@xn--bcher-kva.de" are the same recipient for the rate limits and the
+delivery log. The local part is kept as given, since it may be
+case-sensitive (RFC 5321 2.4), and may be UTF-8 for SMTPUTF8 relays.
+Results are memoized per process, so a repeat recipient costs one
+dictionary lookup, and a new recipient at a known domain skips the IDNA
+conversion.
+"""
+
+import functools
+import ipaddress
+import json
+import re
+from email.utils import parseaddr
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.http import JsonResponse
+
+ADDRESS_CACHE_SIZE = 4096
+
+# Optional fields of a send payload and the JSON types they may have;
+# null is accepted for all of them, as before.
+FIELDS = {
+    'subject': str,
+    'message': str,
+    'html_content': str,
+    'template': str,
+    'context': dict,
+    'profile': str,
+    'queue': bool,
+}
+_TYPE_NAMES = {str: 'a string', dict: 'a JSON object', bool: 'true or false'}
+
+# One dot-separated piece of an unquoted local part; UTF-8 is allowed.
+_ATOM = re.compile(r'[^\x00-\x20\x7f-\x9f()<>\[\]:;@\\,".]+\Z')
+_QUOTED = re.compile(r'"(?:[^"\\\x00-\x1f\x7f]|\\[^\x00-\x1f\x7f])*"\Z')
+_LABEL = re.compile(r'(?!-)[a-z0-9-]{1,63}(?<!-)\Z')
+
+
+def _content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _too_large(limit):
+    return JsonResponse({
+        'success': False,
+        'error': f'Request body is larger than {limit} bytes',
+        'code': 'request_too_large'
+    }, status=413)
+
+
+def _check_size(request, limit):
+    """A 413 response if the body is over ``limit`` bytes, else None."""
+    if _content_length(request) > limit:
+        return _too_large(limit)
+    try:
+        # Bodies without a Content-Length (chunked) are only known once read.
+        if len(request.body) > limit:
+            return _too_large(limit)
+    except RequestDataTooBig:
+        return _too_large(settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+    return None
+
+
+def limit_body(setting='EMAIL_MAX_REQUEST_BYTES'):
+    """Reject requests whose body is larger than the named setting (sync or async views)."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                response = _check_size(request, getattr(settings, setting))
+                if response is not None:
+                    return response
+                return await view(request, *args, **kwargs)
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                response = _check_size(request, getattr(settings, setting))
+                if response is not None:
+                    return response
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _domain(domain):
+    """(ASCII lowercase form of ``domain``, None) or (None, error)."""
+    if domain.startswith('[') and domain.endswith(']'):
+        literal = domain[1:-1]
+        try:
+            if literal[:5].lower() == 'ipv6:':
+                ipaddress.IPv6Address(literal[5:])
+            else:
+                ipaddress.IPv4Address(literal)
+        except ValueError:
+            return None, 'invalid address literal'
+        return domain, None
+    if not domain.isascii():
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError as e:
+            return None, f'invalid domain: {e}'
+    domain = domain.lower()
+    if len(domain) > 253 or not all(_LABEL.match(label) for label in domain.split('.')):
+        return None, 'invalid domain'
+    return domain, None
+
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _normalize(value):
+    """(normalized address, None) or (None, error); errors are cached too."""
+    if any(c in value for c in '\r\n\0'):
+        return None, 'line breaks are not allowed'
+    name = ''
+    address = value.strip()
+    if address.endswith('>'):
+        name, address = parseaddr(address)
+        if not address:
+            return None, 'cannot parse the address'
+    local, sep, domain = address.rpartition('@')
+    if not sep or not local or not domain:
+        return None, 'an address needs a local part and a domain'
+    if len(local.encode('utf-8')) > 64:
+        return None, 'the local part is longer than 64 bytes'
+    if not (_QUOTED.match(local) if local.startswith('"') else all(map(_ATOM.match, local.split('.')))):
+        return None, 'invalid local part'
+    domain, error = _domain(domain)
+    if error:
+        return None, error
+    address = f'{local}@{domain}'
+    if len(address) > 254:
+        return None, 'the address is longer than 254 characters'
+    return (f'{name} <{address}>' if name else address), None
+
+
+def normalize_address(value, field='to_email'):
+    """
+    ``value`` with its domain in lowercase ASCII (IDNA) form; a display
+    name ("Ada <ada@example.com>") is kept. Raises ValueError naming
+    ``field`` if it is not a valid address.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    address, error = _normalize(value)
+    if error:
+        raise ValueError(f'{field} is not a valid email address: {error}')
+    return address
+
+
+def cache_info():
+    """Hits, misses and size of this process's address and domain caches."""
+    return {
+        name: {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}
+        for name, info in (('addresses', _normalize.cache_info()), ('domains', _domain.cache_info()))
+    }
+
+
+def clean(data):
+    """
+    A copy of the send payload ``data`` with ``to_email`` normalized.
+    Raises ValueError for anything the send would fail on later.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('message must be a JSON object')
+    if not data.get('to_email'):
+        raise ValueError('to_email is required')
+    for field, kind in FIELDS.items():
+        value = data.get(field)
+        if value is not None and not isinstance(value, kind):
+            raise ValueError(f'{field} must be {_TYPE_NAMES[kind]}')
+    subject = data.get('subject')
+    if subject and ('\n' in subject or '\r' in subject):
+        raise ValueError('subject must not contain line breaks')
+    return {**data, 'to_email': normalize_address(data['to_email'])}
+
+
+def parse(body):
+    """clean() the JSON object in ``body``; json.JSONDecodeError for invalid JSON."""
+    return clean(json.loads(body))
@@ -0,0 +1,283 @@
+"""
+In-process asyncio SMTP sink for benchmarks.
+
+Accepts mail and throws it away, with optional round-trip latency,
+STARTTLS using a certificate from a throwaway CA, AUTH that accepts any
+credentials, and randomly injected 4xx/5xx replies to RCPT.
+"""
+
+import asyncio
+import datetime
+import ipaddress
+import os
+import random
+import ssl
+import tempfile
+import threading
+
+
+def make_test_certs(directory, hostname='localhost'):
+    """
+    Write a throwaway CA and a server certificate it signed for
+    ``hostname`` and 127.0.0.1; return the paths of the CA certificate,
+    the server certificate and the server key.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'SMTP sink test CA')])
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(ca_name)
+        .issuer_name(ca_name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .add_extension(x509.KeyUsage(
+            digital_signature=False, content_commitment=False, key_encipherment=False,
+            data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+            encipher_only=False, decipher_only=False,
+        ), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key()), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)]))
+        .issuer_name(ca_name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName(hostname),
+            x509.IPAddress(ipaddress.ip_address('127.0.0.1')),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        .add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False
+        )
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    ca_path = os.path.join(directory, 'sink-ca.pem')
+    cert_path = os.path.join(directory, 'sink-cert.pem')
+    key_path = os.path.join(directory, 'sink-key.pem')
+    with open(ca_path, 'wb') as f:
+        f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+    return ca_path, cert_path, key_path
+
+
+class SMTPSink:
+    """
+    Run a discarding SMTP server on a background event loop thread.
+
+    ``latency`` (seconds) is added before every reply the client is
+    waiting for; commands pipelined behind another get theirs straight
+    away, so a pipelined batch costs one delay like one network round
+    trip would. ``temp_fail_rate``
+    and ``perm_fail_rate`` are the probabilities of answering a RCPT with
+    451 or 550. With ``starttls`` a throwaway CA and a certificate it
+    signed are generated; point SSL_CERT_FILE at ``cert_path`` (the CA)
+    so clients trust it. Extensions
+    named in ``disable`` (e.g. ``{'PIPELINING', '8BITMIME'}``) are left
+    out of the EHLO reply. With ``record`` every command line goes to
+    ``commands`` and every message body to ``messages`` (for tests).
+    The next ``drop_after_data`` messages are taken, but the connection
+    drops before the reply to their final dot.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, starttls=False,
+                 temp_fail_rate=0.0, perm_fail_rate=0.0, seed=None, disable=(), record=False,
+                 drop_after_data=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.temp_fail_rate = temp_fail_rate
+        self.perm_fail_rate = perm_fail_rate
+        self.random = random.Random(seed)
+        self.disable = {name.upper() for name in disable}
+        self.record = record
+        self.drop_after_data = drop_after_data
+        self.commands = []
+        self.messages = []
+        self.stats = {
+            'connections': 0, 'messages': 0, 'bytes': 0,
+            'temp_failures': 0, 'perm_failures': 0,
+            # Messages with 8-bit data sent without BODY=8BITMIME.
+            'undeclared_8bit': 0,
+            # Commands that arrived before the reply to the previous one.
+            'pipelined': 0,
+            # Messages taken whose 250 reply was never sent.
+            'dropped_replies': 0,
+        }
+        self.cert_path = None
+        self.ssl_context = None
+        if starttls:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix='email-sink-')
+            self.cert_path, server_cert_path, key_path = make_test_certs(self._tmpdir.name)
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(server_cert_path, key_path)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._sessions = {}
+
+    def start(self):
+        """Start serving; return (host, port)."""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=1024, limit=2 ** 20),
+            self._loop,
+        ).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.host, self.port
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            # Drop sessions clients are still holding open (pooled connections).
+            for writer in self._sessions.values():
+                writer.transport.abort()
+            await asyncio.gather(*self._sessions, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+
+    def drop_connections(self):
+        """Abort every open session, as a relay that restarts would."""
+        async def drop():
+            for writer in self._sessions.values():
+                writer.transport.abort()
+
+        asyncio.run_coroutine_threadsafe(drop(), self._loop).result(timeout=5)
+
+    async def _reply(self, writer, text, reader=None):
+        # A complete command already buffered means the client pipelined
+        # it and is not waiting on this reply yet.
+        pipelined = reader is not None and b'\n' in reader._buffer
+        if pipelined:
+            self.stats['pipelined'] += 1
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write(text.encode('ascii') + b'\r\n')
+        await writer.drain()
+
+    def _ehlo_reply(self, tls_active):
+        extensions = [
+            extension
+            for extension in ['PIPELINING', '8BITMIME', 'SMTPUTF8', 'SIZE 157286400', 'AUTH PLAIN LOGIN']
+            if extension.split()[0] not in self.disable
+        ]
+        if self.ssl_context and not tls_active:
+            extensions.append('STARTTLS')
+        lines = ['sink.local'] + extensions
+        return '\r\n'.join(
+            f'250{"-" if i < len(lines) - 1 else " "}{line}' for i, line in enumerate(lines)
+        )
+
+    async def _handle(self, reader, writer):
+        self.stats['connections'] += 1
+        task = asyncio.current_task()
+        self._sessions[task] = writer
+        tls_active = False
+        accepted = 0
+        declared_8bit = False
+        try:
+            await self._reply(writer, '220 sink.local ESMTP ready')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if self.record:
+                    self.commands.append(line.rstrip(b'\r\n').decode('utf-8', 'replace'))
+                verb = line.split(b' ', 1)[0].strip().upper()
+                if verb in (b'EHLO', b'HELO'):
+                    await self._reply(writer, self._ehlo_reply(tls_active))
+                elif verb == b'STARTTLS' and self.ssl_context and not tls_active:
+                    await self._reply(writer, '220 Ready to start TLS')
+                    await writer.start_tls(self.ssl_context)
+                    tls_active = True
+                elif verb == b'AUTH':
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1].upper() == b'LOGIN':
+                        for _ in range(2):
+                            await self._reply(writer, '334 VXNlcm5hbWU6')
+                            await reader.readline()
+                    await self._reply(writer, '235 Authentication successful')
+                elif verb == b'MAIL':
+                    accepted = 0
+                    declared_8bit = b' BODY=8BITMIME' in line.upper()
+                    await self._reply(writer, '250 OK', reader)
+                elif verb == b'RCPT':
+                    roll = self.random.random()
+                    if roll < self.temp_fail_rate:
+                        self.stats['temp_failures'] += 1
+                        await self._reply(writer, '451 4.7.1 Try again later', reader)
+                    elif roll < self.temp_fail_rate + self.perm_fail_rate:
+                        self.stats['perm_failures'] += 1
+                        await self._reply(writer, '550 5.1.1 Mailbox unavailable', reader)
+                    else:
+                        accepted += 1
+                        await self._reply(writer, '250 OK', reader)
+                elif verb == b'DATA':
+                    if not accepted:
+                        await self._reply(writer, '554 No valid recipients', reader)
+                        continue
+                    await self._reply(writer, '354 End data with <CR><LF>.<CR><LF>')
+                    size = 0
+                    eightbit = False
+                    chunks = []
+                    while True:
+                        chunk = await reader.readline()
+                        if not chunk or chunk == b'.\r\n':
+                            break
+                        if self.record:
+                            chunks.append(chunk)
+                        size += len(chunk)
+                        eightbit = eightbit or not chunk.isascii()
+                    if eightbit and not declared_8bit:
+                        self.stats['undeclared_8bit'] += 1
+                    self.stats['messages'] += 1
+                    if self.record:
+                        self.messages.append(b''.join(chunks))
+                    self.stats['bytes'] += size
+                    if self.drop_after_data:
+                        self.drop_after_data -= 1
+                        self.stats['dropped_replies'] += 1
+                        writer.transport.abort()
+                        break
+                    await self._reply(writer, '250 OK queued')
+                elif verb == b'QUIT':
+                    await self._reply(writer, '221 Bye')
+                    break
+                else:
+                    # NOOP, RSET and anything else.
+                    await self._reply(writer, '250 OK')
+        except (ConnectionError, ssl.SSLError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._sessions.pop(task, None)
+            writer.close()
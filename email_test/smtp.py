@@ -0,0 +1,236 @@
+"""
+smtplib connection classes that record per-phase timings in metrics.py.
+
+Addresses, TLS contexts and TLS sessions come from transport.py, so
+repeat connections skip DNS and resume their TLS session. sendmail()
+declares 8-bit bodies with BODY=8BITMIME and pipelines MAIL/RCPT/DATA
+(RFC 2920) when the server's EHLO reply allows it.
+"""
+
+import smtplib
+import socket
+import ssl
+import time
+
+from . import metrics, transport, wire
+
+
+class InstrumentedSMTP(smtplib.SMTP):
+    """smtplib.SMTP that times DNS, connect, greeting and every command phase."""
+
+    _socket_seconds = 0.0
+    _port = 0
+    # (code, text) of the last reply to DATA, for the delivery log
+    last_reply = None
+
+    def _get_socket(self, host, port, timeout):
+        started = time.perf_counter()
+        addrinfo = transport.resolve(host, port)
+        resolved = time.perf_counter()
+        metrics.observe('dns', resolved - started)
+
+        error = None
+        for family, socktype, proto, _, address in addrinfo:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if self.source_address:
+                    sock.bind(self.source_address)
+                sock.connect(address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            connected = time.perf_counter()
+            metrics.observe('connect', connected - resolved)
+            self._socket_seconds = connected - started
+            self._port = port
+            return sock
+        transport.forget(host, port)
+        raise error or OSError(f'getaddrinfo returned no addresses for {host}')
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        started = time.perf_counter()
+        self._socket_seconds = 0.0
+        reply = super().connect(host, port, source_address)
+        metrics.observe('greeting', time.perf_counter() - started - self._socket_seconds)
+        return reply
+
+    def ehlo(self, name=''):
+        with metrics.timed('ehlo'):
+            reply = super().ehlo(name)
+        if isinstance(self.sock, ssl.SSLSocket):
+            # A TLS 1.3 session ticket has arrived by now.
+            transport.save_session(self.sock, self._host, self._port)
+        return reply
+
+    def starttls(self, context=None):
+        """smtplib's starttls(), wrapping through transport to resume sessions."""
+        with metrics.timed('starttls'):
+            self.ehlo_or_helo_if_needed()
+            if not self.has_extn('starttls'):
+                raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+            resp, reply = self.docmd('STARTTLS')
+            if resp != 220:
+                raise smtplib.SMTPResponseException(resp, reply)
+            self.sock = transport.wrap_socket(
+                context or transport.get_ssl_context(), self.sock, self._host, self._port
+            )
+            self.file = None
+            # RFC 3207: forget everything learned before TLS.
+            self.helo_resp = None
+            self.ehlo_resp = None
+            self.esmtp_features = {}
+            self.does_esmtp = False
+            return resp, reply
+
+    def login(self, user, password, *args, **kwargs):
+        with metrics.timed('auth'):
+            return super().login(user, password, *args, **kwargs)
+
+    def mail(self, sender, options=()):
+        with metrics.timed('mail'):
+            return super().mail(sender, options)
+
+    def rcpt(self, recip, options=()):
+        with metrics.timed('rcpt'):
+            return super().rcpt(recip, options)
+
+    def data(self, msg):
+        """smtplib's data(), with the final reply read through end_data()."""
+        with metrics.timed('data'):
+            self.putcmd('data')
+            code, reply = self.getreply()
+            if code != 354:
+                raise smtplib.SMTPDataError(code, reply)
+            if isinstance(msg, str):
+                msg = smtplib._fix_eols(msg).encode('ascii')
+            body = smtplib._quote_periods(msg)
+            if not body.endswith(smtplib.bCRLF):
+                body += smtplib.bCRLF
+            self.last_reply = end_data(self, body + b'.' + smtplib.bCRLF)
+        return self.last_reply
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        """
+        smtplib's sendmail(), plus: a body with 8-bit data goes out with
+        BODY=8BITMIME, or is re-encoded to 7-bit if the server lacks
+        8BITMIME; with PIPELINING the MAIL, RCPT and DATA commands go out
+        in one write and their replies are read back in order.
+        """
+        self.ehlo_or_helo_if_needed()
+        # smtplib.mail() switches to UTF-8 for SMTPUTF8 and never back.
+        self.command_encoding = 'ascii'
+        if isinstance(msg, str):
+            msg = smtplib._fix_eols(msg).encode('ascii')
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if not msg.isascii():
+            if self.has_extn('8bitmime'):
+                mail_options = [*mail_options, 'BODY=8BITMIME']
+            else:
+                with metrics.timed('encode'):
+                    msg = wire.to_7bit(msg)
+        if not self.has_extn('pipelining'):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        options = [f'SIZE={len(msg)}'] if self.has_extn('size') else []
+        options.extend(mail_options)
+        if any(option.lower() == 'smtputf8' for option in options):
+            if not self.has_extn('smtputf8'):
+                raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+            self.command_encoding = 'utf-8'
+        commands = [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{_optionlist(options)}']
+        commands += [f'RCPT TO:{smtplib.quoteaddr(addr)}{_optionlist(rcpt_options)}' for addr in to_addrs]
+        commands.append('DATA')
+
+        started = time.perf_counter()
+        self.send(''.join(f'{command}\r\n' for command in commands))
+        replies = []
+        for _ in commands:
+            replies.append(self.getreply())
+            if replies[-1][0] == 421:
+                # The server is closing the session; nothing more will come.
+                break
+        metrics.observe('mail', time.perf_counter() - started)
+
+        mail_reply, rcpt_replies = replies[0], replies[1:len(to_addrs) + 1]
+        data_reply = replies[-1] if len(replies) == len(commands) else None
+        if mail_reply[0] != 250:
+            self._abort(replies)
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        refused = {
+            addr: reply for addr, reply in zip(to_addrs, rcpt_replies)
+            if reply[0] not in (250, 251)
+        }
+        if len(refused) == len(to_addrs) or len(rcpt_replies) < len(to_addrs):
+            self._abort(replies)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply is None or data_reply[0] != 354:
+            self._abort(replies)
+            code, resp = data_reply or replies[-1]
+            raise smtplib.SMTPDataError(code, resp)
+
+        body = smtplib._quote_periods(msg)
+        if not body.endswith(smtplib.bCRLF):
+            body += smtplib.bCRLF
+        with metrics.timed('data'):
+            self.last_reply = code, resp = end_data(self, body + b'.' + smtplib.bCRLF)
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _abort(self, replies):
+        """Leave a failed pipelined transaction the way smtplib would."""
+        if replies[-1][0] == 421:
+            self.close()
+            return
+        if replies[-1][0] == 354:
+            # The pipelined DATA was accepted; end it with an empty body
+            # before resetting so the session stays usable.
+            self.send(b'.' + smtplib.bCRLF)
+            self.getreply()
+        self._rset()
+
+
+def end_data(connection, data):
+    """
+    Send ``data``, the rest of a message ending in the final dot, and
+    return the relay's reply. A network error or timeout while waiting
+    for that reply gets ``after_data = True``: the relay had the whole
+    message and may have accepted it (RFC 1047), so it must not simply
+    be sent again.
+    """
+    connection.send(data)
+    try:
+        return connection.getreply()
+    except OSError as e:
+        e.after_data = True
+        raise
+
+
+def after_data(exc):
+    """Whether ``exc`` broke off a send the relay may have accepted (see end_data())."""
+    return getattr(exc, 'after_data', False)
+
+
+def _optionlist(options):
+    return ''.join(f' {option}' for option in options)
+
+
+class InstrumentedSMTP_SSL(InstrumentedSMTP, smtplib.SMTP_SSL):
+    """Implicit-TLS variant; the TLS handshake is recorded as tls_handshake."""
+
+    def _get_socket(self, host, port, timeout):
+        sock = super()._get_socket(host, port, timeout)
+        started = time.perf_counter()
+        sock = transport.wrap_socket(self.context, sock, self._host, port)
+        elapsed = time.perf_counter() - started
+        metrics.observe('tls_handshake', elapsed)
+        self._socket_seconds += elapsed
+        return sock
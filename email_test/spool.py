@@ -0,0 +1,181 @@
+"""
+On-disk spool for messages the relay could not take.
+
+The layout follows maildir. A message is written to tmp/, fsync'd, then
+renamed into new/, and the directory is fsync'd as well, so a crash never
+leaves a half-written message where the replayer would pick it up.
+replay_spool claims files by renaming them into cur/, which means two
+replayers never send the same message. A delivered file is deleted, a
+permanently rejected one moves to failed/, and one that hit a transient
+failure goes back to new/.
+
+Each file holds one JSON envelope line (sender, recipients, spool time)
+followed by the message as it goes over the wire, with 8bit text parts.
+The addresses are kept as the message had them and only encoded for the
+relay at replay, so non-ASCII ones can still go out with SMTPUTF8.
+Replay sends those bytes unchanged and never rebuilds the MIME, unless
+the relay lacks 8BITMIME and the 8-bit parts have to be re-encoded.
+"""
+
+import itertools
+import json
+import os
+import shutil
+import socket
+import time
+
+from django.conf import settings
+
+from . import streaming, wire
+
+TMP = 'tmp'
+NEW = 'new'
+CUR = 'cur'
+FAILED = 'failed'
+
+_counter = itertools.count()
+
+
+def _dir(sub):
+    return os.path.join(settings.EMAIL_SPOOL_DIR, sub)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _ensure_dirs():
+    for sub in (TMP, NEW, CUR, FAILED):
+        os.makedirs(_dir(sub), exist_ok=True)
+
+
+def _unique_name():
+    # Starts with the time in ns, so sorting by name gives spool order.
+    return f'{time.time_ns()}.P{os.getpid()}Q{next(_counter)}.{socket.gethostname()}'
+
+
+def _spooled_at(name):
+    return int(name.split('.', 1)[0]) / 1e9
+
+
+def write(email_message):
+    """Spool ``email_message`` durably and return its name."""
+    envelope = {
+        'from': str(email_message.from_email),
+        'to': [str(addr) for addr in email_message.recipients()],
+        'encoding': email_message.encoding,
+        'spooled_at': time.time(),
+    }
+    if isinstance(email_message, streaming.StreamingMessage):
+        # Large attachments are copied into the file a block at a time.
+        chunks = email_message.iter_chunks()
+    else:
+        chunks = [wire.serialize(email_message, eightbit=True)]
+
+    _ensure_dirs()
+    name = _unique_name()
+    tmp_path = os.path.join(_dir(TMP), name)
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(envelope).encode() + b'\n')
+        f.writelines(chunks)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, os.path.join(_dir(NEW), name))
+    _fsync_dir(_dir(NEW))
+    return name
+
+
+def read(name, sub=CUR):
+    """
+    Return (from_email, recipients, encoding, message bytes) for a spooled
+    message; encode the addresses with wire.encode_envelope(). Raises
+    ValueError for a file that isn't a spooled message.
+    """
+    with open(os.path.join(_dir(sub), name), 'rb') as f:
+        try:
+            envelope = json.loads(f.readline())
+            return envelope['from'], list(envelope['to']), envelope.get('encoding'), f.read()
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f'Bad spool envelope: {e!r}') from e
+
+
+def readdress(name, recipients):
+    """Narrow a claimed message's envelope to ``recipients``, e.g. to retry only those."""
+    path = os.path.join(_dir(CUR), name)
+    tmp_path = os.path.join(_dir(TMP), name)
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as f:
+        envelope = json.loads(src.readline())
+        envelope['to'] = recipients
+        f.write(json.dumps(envelope).encode() + b'\n')
+        shutil.copyfileobj(src, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    _fsync_dir(_dir(CUR))
+
+
+def claim(limit):
+    """Move up to ``limit`` of the oldest messages into cur/; return their names."""
+    try:
+        names = sorted(os.listdir(_dir(NEW)))
+    except FileNotFoundError:
+        return []
+    claimed = []
+    for name in names:
+        try:
+            os.rename(os.path.join(_dir(NEW), name), os.path.join(_dir(CUR), name))
+        except FileNotFoundError:
+            continue  # Another replayer got there first.
+        claimed.append(name)
+        if len(claimed) >= limit:
+            break
+    return claimed
+
+
+def release(names):
+    """Put claimed messages back in new/ for a later replay."""
+    for name in names:
+        os.rename(os.path.join(_dir(CUR), name), os.path.join(_dir(NEW), name))
+
+
+def delivered(name):
+    os.unlink(os.path.join(_dir(CUR), name))
+
+
+def reject(name):
+    """Move a claimed message the relay refused for good into failed/."""
+    os.rename(os.path.join(_dir(CUR), name), os.path.join(_dir(FAILED), name))
+
+
+def recover():
+    """
+    Return messages left in cur/ by a replayer that died to new/. Only run
+    this when no other replayer is active. Returns how many were moved.
+    """
+    try:
+        names = os.listdir(_dir(CUR))
+    except FileNotFoundError:
+        return 0
+    release(names)
+    return len(names)
+
+
+def snapshot():
+    """Spool depth and oldest message age, for /api/email/config/."""
+    counts = {}
+    for sub in (NEW, CUR, FAILED):
+        try:
+            counts[sub] = os.listdir(_dir(sub))
+        except FileNotFoundError:
+            counts[sub] = []
+    pending = counts[NEW] + counts[CUR]
+    return {
+        'depth': len(pending),
+        'in_replay': len(counts[CUR]),
+        'failed': len(counts[FAILED]),
+        'oldest_age_seconds': round(time.time() - _spooled_at(min(pending)), 1) if pending else None,
+    }
@@ -0,0 +1,170 @@
+"""
+Send messages with large attachments without holding them in memory.
+
+The MIME message is generated as a stream of CRLF-terminated chunks:
+headers and body first, then each attachment read from its (spooled)
+upload file and base64-encoded a block at a time. The chunks are written
+straight into the SMTP DATA phase, so memory use stays bounded by the
+block size no matter how big the attachments are.
+"""
+
+import base64
+import mimetypes
+import smtplib
+import time
+import uuid
+from email.utils import encode_rfc2231, formatdate, make_msgid
+
+from django.conf import settings
+from django.core.mail.message import forbid_multi_line_headers
+from django.core.mail.utils import DNS_NAME
+
+from . import dkim, metrics
+from .smtp import end_data
+
+# Bytes of input per base64 block: a multiple of 57 so every block encodes
+# to whole 76-character lines.
+BLOCK_SIZE = 57 * 1024
+
+
+def _base64_lines(data):
+    encoded = base64.b64encode(data)
+    return b''.join(encoded[i:i + 76] + b'\r\n' for i in range(0, len(encoded), 76))
+
+
+class StreamingMessage:
+    """
+    A multipart/mixed message whose attachments are file objects.
+
+    ``attachments`` is a list of (filename, content_type or None, fileobj).
+    Like messages.PreparedMessage it provides what the backends, delivery
+    and the spool use from an EmailMessage, so it goes through
+    delivery.send(); the SMTP backends write it into DATA with
+    send_streaming() instead of serializing it whole. Raises BadHeaderError
+    (a ValueError) for line breaks in the subject or an address.
+    """
+
+    encoding = None
+
+    def __init__(self, subject, body, from_email, to, attachments=(), html=False):
+        self.subject = subject
+        self.body = body
+        self.from_email = from_email
+        self.to = list(to)
+        self.attachments = list(attachments)
+        self.html = html
+        # Fixed here so every pass over the message (DKIM, retries) yields
+        # the same bytes.
+        self._boundary = f'=_{uuid.uuid4().hex}'
+        headers = [
+            forbid_multi_line_headers('From', from_email, settings.DEFAULT_CHARSET),
+            forbid_multi_line_headers('To', ', '.join(self.to), settings.DEFAULT_CHARSET),
+            forbid_multi_line_headers('Subject', subject, settings.DEFAULT_CHARSET),
+            ('Date', formatdate(localtime=settings.EMAIL_USE_LOCALTIME)),
+            ('Message-ID', make_msgid(domain=DNS_NAME)),
+            ('MIME-Version', '1.0'),
+            ('Content-Type', f'multipart/mixed; boundary="{self._boundary}"'),
+        ]
+        self._head = ''.join(f'{name}: {value}\r\n' for name, value in headers).encode('ascii')
+
+    def recipients(self):
+        return self.to
+
+    def message(self):
+        # Stands in for the MIME object, for backends that take the whole
+        # message (console, locmem) and the spool.
+        return self
+
+    def as_bytes(self, linesep='\r\n'):
+        return b''.join(self.iter_chunks())
+
+    def iter_chunks(self, sign=True):
+        """
+        Yield the message as bytes chunks, each ending in CRLF, DKIM-signed
+        unless ``sign`` is false. Signing reads the attachments twice.
+        """
+        if sign:
+            yield dkim.signature(self._head, self._iter_body())
+        yield self._head + b'\r\n'
+        yield from self._iter_body()
+
+    def _iter_body(self):
+        boundary = self._boundary
+        subtype = 'html' if self.html else 'plain'
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: base64\r\n\r\n'
+        ).encode('ascii')
+        yield _base64_lines(self.body.encode('utf-8'))
+
+        for filename, content_type, fileobj in self.attachments:
+            content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            try:
+                filename.encode('ascii')
+                disposition = f'attachment; filename="{filename}"'
+            except UnicodeEncodeError:
+                disposition = f"attachment; filename*={encode_rfc2231(filename, 'utf-8')}"
+            yield (
+                f'--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Disposition: {disposition}\r\n'
+                'Content-Transfer-Encoding: base64\r\n\r\n'
+            ).encode('ascii')
+            fileobj.seek(0)
+            while True:
+                block = fileobj.read(BLOCK_SIZE)
+                if not block:
+                    break
+                yield _base64_lines(block)
+
+        yield f'--{boundary}--\r\n'.encode('ascii')
+
+
+def send_streaming(connection, message, from_addr, recipients, mail_options=()):
+    """
+    Send a StreamingMessage over an open smtplib connection to the
+    envelope from wire.envelope(), writing the DATA phase chunk by chunk.
+    Returns the refused recipients; raises the usual smtplib exceptions.
+    """
+    # smtplib.mail() switches to UTF-8 for SMTPUTF8 and never back.
+    connection.command_encoding = 'ascii'
+    code, reply = connection.mail(from_addr, mail_options)
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+    refused = {}
+    for addr in recipients:
+        code, reply = connection.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, reply)
+    if len(refused) == len(recipients):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    started = time.perf_counter()
+    connection.putcmd('data')
+    code, reply = connection.getreply()
+    if code != 354:
+        connection._rset()
+        raise smtplib.SMTPDataError(code, reply)
+    try:
+        for chunk in message.iter_chunks():
+            # Chunks always start at a line boundary, so dot-stuffing them
+            # one at a time is exact.
+            if chunk.startswith(b'.'):
+                chunk = b'.' + chunk
+            connection.send(chunk.replace(b'\r\n.', b'\r\n..'))
+    except BaseException:
+        # The session is mid-DATA; it can't be used for anything else.
+        connection.close()
+        raise
+    connection.last_reply = code, reply = end_data(connection, b'.\r\n')
+    metrics.observe('data', time.perf_counter() - started)
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            connection._rset()
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
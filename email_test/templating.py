@@ -0,0 +1,212 @@
+"""
+Named HTML email templates, compiled once and cached per process.
+
+A template is a Django-template HTML file in EMAIL_TEMPLATE_DIR (e.g.
+``welcome.html`` for the name ``welcome``). When a template is first used,
+or after its file changes, it is compiled together with everything derived
+from it: <style> rules are inlined into style attributes, a plain-text
+alternative template is generated, and the <title> becomes the subject
+template. Sending then only renders the compiled templates with the
+request's context. The cache is a bounded LRU (EMAIL_TEMPLATE_CACHE_SIZE).
+"""
+
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template import Context, Engine
+from django.utils._os import safe_join
+
+_NAME_RE = re.compile(r'^[A-Za-z0-9_\-/]+$')
+
+_engine = Engine()
+
+
+class TemplateNotFound(ValueError):
+    pass
+
+
+class CompiledEmailTemplate:
+    def __init__(self, source, version):
+        self.version = version
+        inlined = inline_css(source)
+        title = re.search(r'<title[^>]*>(.*?)</title>', source, re.I | re.S)
+        self.html = _engine.from_string(inlined)
+        self.text = _engine.from_string(html_to_text(inlined))
+        self.subject = _engine.from_string(' '.join(title.group(1).split())) if title else None
+
+    def render(self, context):
+        """Return (subject or None, html, text) for ``context``."""
+        context = context or {}
+        if not isinstance(context, dict):
+            raise ValueError('context must be a JSON object')
+        plain = Context(context, autoescape=False)
+        subject = self.subject.render(plain).strip() if self.subject else None
+        return subject, self.html.render(Context(context)), self.text.render(plain)
+
+
+class TemplateCache:
+    def __init__(self, directory, max_size=64):
+        self.directory = str(directory)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        if not _NAME_RE.match(name) or '..' in name:
+            raise TemplateNotFound(f'Invalid template name: {name}')
+        path = safe_join(self.directory, f'{name}.html')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise TemplateNotFound(f'Unknown template: {name}') from None
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            compiled = self._entries.get(name)
+            if compiled is not None and compiled.version == version:
+                self._entries.move_to_end(name)
+                return compiled
+
+        # Compile outside the lock; a concurrent miss just compiles twice.
+        with open(path, encoding='utf-8') as f:
+            compiled = CompiledEmailTemplate(f.read(), version)
+        with self._lock:
+            self._entries[name] = compiled
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return compiled
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TemplateCache(settings.EMAIL_TEMPLATE_DIR, settings.EMAIL_TEMPLATE_CACHE_SIZE)
+        return _cache
+
+
+def render(name, context):
+    """Render template ``name``; return (subject or None, html, text)."""
+    return get_cache().get(name).render(context)
+
+
+# CSS inlining ---------------------------------------------------------------
+
+_STYLE_BLOCK_RE = re.compile(r'<style[^>]*>(.*?)</style>', re.I | re.S)
+_RULE_RE = re.compile(r'([^{}]+)\{([^{}]*)\}')
+_SIMPLE_SELECTOR_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9]*)?((?:[.#][A-Za-z0-9_-]+)*)$')
+_START_TAG_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)(\s[^<>]*?)?(/?)>')
+_ATTR_RE = r'\s{}\s*=\s*(["\'])(.*?)\1'
+
+
+def _parse_selector(selector):
+    """Return (tag, classes, id, specificity) for a simple selector, else None."""
+    match = _SIMPLE_SELECTOR_RE.match(selector)
+    if not match or not selector:
+        return None
+    tag = (match.group(1) or '').lower() or None
+    parts = re.findall(r'([.#])([A-Za-z0-9_-]+)', match.group(2))
+    classes = {value for kind, value in parts if kind == '.'}
+    ids = [value for kind, value in parts if kind == '#']
+    if len(ids) > 1:
+        return None
+    return tag, classes, ids[0] if ids else None, (len(ids), len(classes), 1 if tag else 0)
+
+
+def inline_css(source):
+    """
+    Move simple <style> rules (tag, .class, #id and combinations of them)
+    into matching elements' style attributes. Rules that can't be inlined
+    (@media, descendant or pseudo selectors) stay in a <style> block.
+    Existing inline styles win over inlined rules.
+    """
+    rules = []
+    leftover = []
+    css = ''.join(_STYLE_BLOCK_RE.findall(source))
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    # Keep @-blocks (which nest braces) verbatim.
+    for at_block in re.findall(r'@[^{]+\{(?:[^{}]*\{[^{}]*\})*[^{}]*\}', css):
+        leftover.append(at_block.strip())
+        css = css.replace(at_block, '')
+    for order, (selectors, declarations) in enumerate(_RULE_RE.findall(css)):
+        declarations = ';'.join(d.strip() for d in declarations.split(';') if d.strip())
+        for selector in selectors.split(','):
+            selector = selector.strip()
+            parsed = _parse_selector(selector)
+            if parsed is None:
+                leftover.append(f'{selector} {{ {declarations} }}')
+            else:
+                rules.append((parsed[3], order, parsed[:3], declarations))
+    if not rules:
+        return source
+    rules.sort(key=lambda rule: (rule[0], rule[1]))
+
+    def apply(match):
+        tag, attrs, closing = match.group(1).lower(), match.group(2) or '', match.group(3)
+        if tag in ('style', 'script', 'head', 'title', 'meta', 'link', 'html'):
+            return match.group(0)
+        class_match = re.search(_ATTR_RE.format('class'), attrs, re.I | re.S)
+        id_match = re.search(_ATTR_RE.format('id'), attrs, re.I | re.S)
+        classes = set(class_match.group(2).split()) if class_match else set()
+        element_id = id_match.group(2) if id_match else None
+        styles = [
+            declarations for _, _, (rule_tag, rule_classes, rule_id), declarations in rules
+            if (rule_tag is None or rule_tag == tag)
+            and rule_classes <= classes
+            and (rule_id is None or rule_id == element_id)
+        ]
+        if not styles:
+            return match.group(0)
+        style_match = re.search(_ATTR_RE.format('style'), attrs, re.I | re.S)
+        if style_match:
+            styles.append(style_match.group(2).strip().rstrip(';'))
+            attrs = attrs[:style_match.start()] + attrs[style_match.end():]
+        style = html.escape('; '.join(styles), quote=True)
+        return f'<{match.group(1)}{attrs.rstrip()} style="{style}"{closing}>'
+
+    inlined = _STYLE_BLOCK_RE.sub('', source)
+    inlined = _START_TAG_RE.sub(apply, inlined)
+    if leftover:
+        block = '<style>\n' + '\n'.join(leftover) + '\n</style>'
+        if re.search(r'</head>', inlined, re.I):
+            inlined = re.sub(r'</head>', lambda m: block + '\n' + m.group(0), inlined, count=1, flags=re.I)
+        else:
+            inlined = block + '\n' + inlined
+    return inlined
+
+
+# Plain-text alternative -----------------------------------------------------
+
+_BLOCK_END_RE = re.compile(r'</(p|div|h[1-6]|tr|table|ul|ol|blockquote|pre)\s*>', re.I)
+
+
+def html_to_text(source):
+    """
+    Derive a plain-text template from an HTML template. Django template
+    tags and variables pass through untouched so the result can be
+    compiled and rendered with the same context.
+    """
+    text = re.sub(r'<(head|style|script)[^>]*>.*?</\1\s*>', '', source, flags=re.I | re.S)
+    text = re.sub(
+        r'<a\s[^>]*?href\s*=\s*(["\'])(.*?)\1[^>]*>(.*?)</a\s*>',
+        lambda m: m.group(3) if m.group(3).strip() == m.group(2) else f'{m.group(3)} ({m.group(2)})',
+        text, flags=re.I | re.S,
+    )
+    text = re.sub(r'<br\s*/?>', '\n', text, flags=re.I)
+    text = re.sub(r'<li[^>]*>', '\n- ', text, flags=re.I)
+    text = _BLOCK_END_RE.sub('\n\n', text)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = html.unescape(text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip() + '\n'
@@ -1,3 +1,1854 @@
-from django.test import TestCase
+import asyncio
+import base64
+import email
+import email.header
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import signal
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.mail import EmailMessage, get_connection
+from django.core.management import CommandError, call_command
+from django.test import AsyncClient, TestCase, override_settings
+from django.utils import timezone
+
+from . import (
+    aiosmtp, backends, delivery, deliverylog, dkim, health, merge, metrics, outbox, probe, profiles, ratelimit,
+    relays, schema, spool, templating, transport, views,
+)
+from .backends import is_relay_failure
+from .management.commands.bench_email import percentile
+from .management.commands.check_smtp_cert import next_state, read_targets, watch_events
+from .management.commands.drain_email_queue import Command as DrainCommand
+from .management.commands import startup_report
+from .management.commands.send_test_email import Checkpoint
+from .models import DeliveryLog, EmailJob
+from . import pool
+from .pool import PoolExhausted, close_all_pools
+from .sink import SMTPSink
+
+
+def closed_port():
+    """A local port nothing listens on, so connecting is refused."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SinkTestCase(TestCase):
+    """Runs a recording SMTP sink and points the EMAIL_* settings at it."""
+
+    backend = 'email_test.backends.InstrumentedEmailBackend'
+    sink_options = {}
+
+    def setUp(self):
+        self.sink = SMTPSink(record=True, **self.sink_options)
+        self.host, self.port = self.sink.start()
+        self.addCleanup(self.sink.stop)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        settings = override_settings(
+            EMAIL_RATELIMIT_FILE=os.path.join(tmpdir.name, 'ratelimit.bin'),
+            EMAIL_BACKEND=self.backend,
+            EMAIL_HOST=self.host,
+            EMAIL_PORT=self.port,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_HOSTS=[],
+            EMAIL_PROFILES={},
+            EMAIL_SEND_MODE='direct',
+            EMAIL_RATE_LIMIT=0,
+            EMAIL_DOMAIN_RATE_LIMIT=0,
+            EMAIL_DELIVERY_LOG=False,
+            EMAIL_DKIM_PRIVATE_KEY_FILE='',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def envelope(self):
+        """The MAIL and RCPT commands the sink received, without ESMTP parameters."""
+        return [
+            ' '.join(c.split(' ')[:2]) for c in self.sink.commands
+            if c.upper().startswith(('MAIL ', 'RCPT '))
+        ]
+
+
+@override_settings(DEFAULT_FROM_EMAIL='Test Sender <sender@example.com>')
+class EnvelopeTests(SinkTestCase):
+    body = {'to_email': 'Ada Lovelace <ada@example.com>', 'subject': 'Hi', 'message': 'Hello'}
+
+    def test_sync_view_sends_bare_addresses(self):
+        response = self.client.post('/api/email/send/', json.dumps(self.body), content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.envelope(), ['MAIL FROM:<sender@example.com>', 'RCPT TO:<ada@example.com>'])
+
+    async def test_async_view_sends_the_same_envelope(self):
+        try:
+            response = await AsyncClient().post(
+                '/api/email/async/send/', json.dumps(self.body), content_type='application/json'
+            )
+        finally:
+            await aiosmtp.close_async_pool()
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.envelope(), ['MAIL FROM:<sender@example.com>', 'RCPT TO:<ada@example.com>'])
+
+
+class AsyncViewTests(SinkTestCase):
+    async def post(self, path, body):
+        try:
+            return await AsyncClient().post(path, json.dumps(body), content_type='application/json')
+        finally:
+            await aiosmtp.close_async_pool()
+
+    async def test_plain_text_view_ignores_templates_like_the_sync_one(self):
+        body = {'to_email': 'ada@example.com', 'message': 'Hello', 'template': 'missing'}
+        response = await self.post('/api/email/async/send/', body)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn(b'\r\n\r\nHello', self.sink.messages[0])
+
+    async def test_message_is_built_off_the_event_loop(self):
+        threads = []
+        build = views.build_message
+
+        def spy(data):
+            threads.append(threading.get_ident())
+            return build(data)
+
+        with mock.patch.object(views, 'build_message', spy):
+            response = await self.post('/api/email/async/send-html/', {'to_email': 'ada@example.com'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertNotEqual(threads, [threading.get_ident()])
+        self.assertEqual(len(threads), 1)
+
+    async def test_lost_reply_to_the_final_dot_is_not_resent(self):
+        self.sink.drop_after_data = 1
+        response = await self.post('/api/email/async/send/', {'to_email': 'ada@example.com', 'message': 'Hello'})
+        self.assertEqual((response.status_code, json.loads(response.content)['code']), (502, 'outcome_unknown'))
+        self.assertEqual(self.sink.stats['messages'], 1)
+
+    async def test_lifespan_shutdown_closes_the_async_pool(self):
+        from config.asgi import application
+
+        await aiosmtp.send_message_async(EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com']))
+        events = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(events)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await application({'type': 'lifespan'}, receive, send)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertNotIn(asyncio.get_running_loop(), aiosmtp._pools)
+        self.assertEqual(self.sink.commands[-1], 'QUIT')
+
+
+@override_settings(DEFAULT_FROM_EMAIL='Test Sender <sender@example.com>')
+class ProfileTests(SinkTestCase):
+    def post(self, profile=None):
+        body = {'to_email': 'Ada Lovelace <ada@example.com>', 'subject': 'Hi', 'message': 'Hello'}
+        if profile:
+            body['profile'] = profile
+        return self.client.post('/api/email/send/', json.dumps(body), content_type='application/json')
+
+    def test_each_profile_has_its_own_relay_bucket(self):
+        with self.settings(EMAIL_PROFILES={
+            'acme': {'host': 'smtp.acme.example', 'port': 587},
+            'same': {'host': self.host, 'port': self.port},
+        }):
+            self.assertEqual(ratelimit.relay_key(), f'relay:{self.host}:{self.port}')
+            self.assertEqual(ratelimit.relay_key('acme'), 'relay:smtp.acme.example:587')
+            self.assertEqual(ratelimit.relay_key('same'), ratelimit.relay_key())
+            with self.assertRaises(ValueError):
+                ratelimit.relay_key('missing')
+
+    def test_rate_limit_is_drawn_from_the_profiles_relay(self):
+        with self.settings(
+            EMAIL_RATE_LIMIT=0.01, EMAIL_RATE_LIMIT_BURST=1, EMAIL_RATE_LIMIT_MAX_WAIT=0,
+            EMAIL_PROFILES={'acme': {'host': 'localhost', 'port': self.port}},
+        ):
+            self.assertEqual(self.post().status_code, 200)
+            self.assertEqual(self.post().status_code, 429)
+            response = self.post('acme')
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_delivery_log_stores_bare_addresses(self):
+        with self.settings(EMAIL_DELIVERY_LOG=True), mock.patch.object(deliverylog, '_ensure_flusher'):
+            self.assertEqual(self.post().status_code, 200)
+            deliverylog.flush()
+        row = DeliveryLog.objects.get()
+        self.assertEqual((row.to_email, row.from_email), ('ada@example.com', 'sender@example.com'))
+
+
+@override_settings(EMAIL_POOL_MAX_MESSAGES=100, EMAIL_POOL_IDLE_TIMEOUT=30)
+class PooledBackendTests(SinkTestCase):
+    backend = 'email_test.backends.PooledEmailBackend'
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(close_all_pools)
+
+    def send(self, count=1):
+        for _ in range(count):
+            self.assertEqual(get_connection().send_messages([
+                EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])
+            ]), 1)
+
+    def verbs(self, verb):
+        return sum(1 for c in self.sink.commands if c.upper() == verb)
+
+    def test_sends_reuse_one_connection_checked_with_noop(self):
+        self.send(3)
+        self.assertEqual(self.sink.stats['connections'], 1)
+        self.assertEqual(self.verbs('NOOP'), 2)
+        self.assertEqual(self.verbs('QUIT'), 0)
+
+    @override_settings(EMAIL_POOL_MAX_MESSAGES=2)
+    def test_connection_is_retired_after_max_messages(self):
+        self.send(3)
+        self.assertEqual(self.sink.stats['connections'], 2)
+
+    @override_settings(EMAIL_POOL_IDLE_TIMEOUT=0)
+    def test_idle_connection_is_not_reused_after_the_timeout(self):
+        self.send(2)
+        self.assertEqual(self.sink.stats['connections'], 2)
+        self.assertEqual(self.verbs('NOOP'), 0)
+
+    def test_connection_dropped_by_the_relay_is_replaced(self):
+        self.send()
+        self.sink.drop_connections()
+        self.send()
+        self.assertEqual(self.sink.stats['connections'], 2)
+        self.assertEqual(self.sink.stats['messages'], 2)
+
+    def test_lost_reply_to_the_final_dot_is_not_resent(self):
+        self.sink.drop_after_data = 1
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send()
+        self.assertEqual(self.sink.stats['messages'], 1)
+        self.send()
+        self.assertEqual(self.sink.stats['messages'], 2)
+
+
+class SpoolTests(SinkTestCase):
+    backend = 'email_test.backends.SpoolingEmailBackend'
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(close_all_pools)
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        settings = override_settings(EMAIL_SPOOL_DIR=self.spool_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def message(self):
+        return EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])
+
+    def test_lost_reply_to_the_final_dot_is_not_spooled(self):
+        self.sink.drop_after_data = 1
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            get_connection().send_messages([self.message()])
+        self.assertEqual(self.sink.stats['messages'], 1)
+        self.assertEqual(spool.snapshot()['depth'], 0)
+
+    def replay(self):
+        stderr = io.StringIO()
+        call_command('replay_spool', stdout=io.StringIO(), stderr=stderr)
+        return stderr.getvalue()
+
+    def spooled(self, sub=spool.NEW):
+        return sorted(os.listdir(os.path.join(self.spool_dir, sub)))
+
+    def test_replay_keeps_utf8_addresses_for_smtputf8_relays(self):
+        spool.write(EmailMessage('Hi', 'Hello', 'sender@example.com', ['Jörg <jörg@example.com>']))
+        self.assertEqual(self.replay(), '')
+        self.assertEqual(self.envelope(), ['MAIL FROM:<sender@example.com>', 'RCPT TO:<jörg@example.com>'])
+        [mail] = [c for c in self.sink.commands if c.startswith('MAIL ')]
+        self.assertIn(' SMTPUTF8', mail)
+        self.assertEqual(spool.snapshot()['depth'], 0)
+
+    def test_unreadable_file_is_set_aside(self):
+        spool.write(self.message())
+        bad = f'{time.time_ns()}.bad'
+        with open(os.path.join(self.spool_dir, spool.NEW, bad), 'wb') as f:
+            f.write(b'not json\n')
+        self.assertIn(f'{bad}: unreadable spool file', self.replay())
+        self.assertEqual(self.sink.stats['messages'], 1)
+        self.assertEqual((self.spooled(), self.spooled(spool.CUR), self.spooled(spool.FAILED)), ([], [], [bad]))
+
+    def test_unexpected_error_puts_the_batch_back(self):
+        names = sorted([spool.write(self.message()), spool.write(self.message())])
+        with mock.patch('email_test.smtp.InstrumentedSMTP.sendmail', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.replay()
+        self.assertEqual((self.spooled(), self.spooled(spool.CUR)), (names, []))
+
+    def test_only_recipients_refused_for_now_stay_spooled(self):
+        name = spool.write(EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com', 'bob@example.com']))
+        # Accept ada, greylist bob, then accept bob on the next replay.
+        self.sink.temp_fail_rate = 0.5
+        self.sink.random = mock.Mock(**{'random.side_effect': [0.9, 0.1, 0.9]})
+        self.assertIn('bob@example.com refused: 451', self.replay())
+        self.assertEqual(self.sink.stats['messages'], 1)
+        self.assertEqual(spool.read(name, spool.NEW)[1], ['bob@example.com'])
+        self.assertEqual(self.replay(), '')
+        self.assertEqual(self.envelope()[-2:], ['MAIL FROM:<sender@example.com>', 'RCPT TO:<bob@example.com>'])
+        self.assertEqual(spool.snapshot()['depth'], 0)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='sender@example.com', EMAIL_RETRY_DEADLINE=0)
+class IdempotencyTests(SinkTestCase):
+    body = {'to_email': 'ada@example.com', 'subject': 'Hi', 'message': 'Hello'}
+
+    def post(self, key, body=None):
+        return self.client.post(
+            '/api/email/send/', json.dumps(body or self.body), content_type='application/json',
+            headers={'Idempotency-Key': key},
+        )
+
+    def test_retry_with_the_same_key_is_not_sent_again(self):
+        first, second = self.post('k1'), self.post('k1')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((second.status_code, second.content), (200, first.content))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.sink.stats['messages'], 1)
+        self.assertEqual(self.post('k2').status_code, 200)
+        self.assertEqual(self.sink.stats['messages'], 2)
+
+    def test_key_reused_with_another_body_is_rejected(self):
+        self.post('k1')
+        response = self.post('k1', {**self.body, 'subject': 'Other'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.sink.stats['messages'], 1)
+
+    def test_failed_send_can_be_retried_with_the_same_key(self):
+        with self.settings(EMAIL_PORT=closed_port()):
+            self.assertEqual(self.post('k1').status_code, 503)
+        response = self.post('k1')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+        self.assertEqual(self.sink.stats['messages'], 1)
+
+    def test_key_length_is_checked(self):
+        self.assertEqual(self.post('x' * 256).status_code, 400)
+        self.assertEqual(self.sink.stats['messages'], 0)
+
+    def test_send_the_relay_may_have_taken_is_stored(self):
+        self.sink.drop_after_data = 1
+        first = self.post('k1')
+        self.assertEqual((first.status_code, first.json()['code']), (502, 'outcome_unknown'))
+        second = self.post('k1')
+        self.assertEqual((second.status_code, second.content), (502, first.content))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.sink.stats['messages'], 1)
+
+
+@override_settings(EMAIL_POOL_MAX_TOTAL=2, EMAIL_POOL_ACQUIRE_TIMEOUT=0)
+class ConnectionBudgetTests(SinkTestCase):
+    backend = 'email_test.backends.PooledEmailBackend'
+
+    def setUp(self):
+        super().setUp()
+        # A budget of our own, sized from the settings above.
+        for patcher in (mock.patch.object(pool, '_budget', None), mock.patch.dict(pool._pools, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(close_all_pools)
+        settings = override_settings(EMAIL_PROFILES={
+            name: {'host': self.host, 'port': self.port} for name in ('a', 'b', 'c')
+        })
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def send(self, profile):
+        delivery.send([EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])], profile=profile)
+
+    def idle(self, profile):
+        return len(profiles.get_connection(profile).pool._idle)
+
+    def test_least_recently_used_idle_connection_is_evicted(self):
+        self.send('a')
+        self.send('b')
+        self.send('a')
+        self.send('c')
+        # b was idle longest, so it made room for c.
+        self.assertEqual([self.idle(name) for name in 'abc'], [1, 0, 1])
+        self.assertEqual(pool.snapshot(), {'open': 2, 'idle': 2, 'max_total': 2, 'evictions': 1, 'pools': 3})
+        self.assertEqual(self.sink.stats['connections'], 3)
+
+    def test_budget_spent_on_busy_connections_raises_pool_exhausted(self):
+        holders = [profiles.get_connection(name) for name in 'ab']
+        for holder in holders:
+            holder.open()
+            self.addCleanup(holder.close)
+        with self.assertRaises(PoolExhausted):
+            profiles.get_connection('c').open()
+        self.assertEqual(pool.snapshot()['open'], 2)
+
+
+class FakeRelay:
+    """A connection whose NOOP and QUIT block while ``gate`` is clear."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+
+    def noop(self):
+        self.entered.set()
+        self.gate.wait(5)
+        return 250, b'OK'
+
+    def quit(self):
+        self.entered.set()
+        self.gate.wait(5)
+
+    def close(self):
+        pass
+
+
+class PoolLockTests(TestCase):
+    def setUp(self):
+        self.pool = pool.SMTPConnectionPool(FakeRelay, max_size=2, acquire_timeout=0)
+        self.slow, self.held = self.pool.acquire(), self.pool.acquire()
+        self.slow.connection.gate.clear()
+        self.addCleanup(self.slow.connection.gate.set)
+
+    def in_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread
+
+    def swap(self):
+        self.pool.release(self.held)
+        self.assertIs(self.pool.acquire(), self.held)
+
+    def assert_not_blocked(self):
+        # Another thread can return and take a connection while the slow
+        # relay is still stuck mid-command.
+        self.assertTrue(self.slow.connection.entered.wait(5))
+        thread = self.in_thread(self.swap)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.slow.connection.gate.set()
+
+    def test_health_check_runs_outside_the_lock(self):
+        self.pool.release(self.slow)
+        self.in_thread(self.pool.acquire)
+        self.assert_not_blocked()
+
+    def test_discard_on_release_runs_outside_the_lock(self):
+        self.slow.broken = True
+        self.in_thread(self.pool.release, self.slow)
+        self.assert_not_blocked()
+
+
+class BreakerTestCase(SinkTestCase):
+    """SinkTestCase with fresh relay health for EMAIL_HOSTS."""
+
+    def setUp(self):
+        super().setUp()
+        relays._relays = None
+        self.addCleanup(setattr, relays, '_relays', None)
+
+    def message(self):
+        return EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])
+
+
+@override_settings(EMAIL_RELAY_FAILURE_THRESHOLD=2, EMAIL_POOL_MAX_SIZE=1, EMAIL_POOL_ACQUIRE_TIMEOUT=0)
+class FailoverBreakerTests(BreakerTestCase):
+    backend = 'email_test.backends.FailoverEmailBackend'
+
+    def test_unreachable_relay_is_ejected(self):
+        with self.settings(EMAIL_HOSTS=[f'127.0.0.1:{closed_port()}']):
+            [relay] = relays.get_relays()
+            for _ in range(2):
+                with self.assertRaises(ConnectionRefusedError):
+                    get_connection().send_messages([self.message()])
+            self.assertEqual(relay.state, relays.OPEN)
+            with self.assertRaises(relays.RelayUnavailable):
+                get_connection().send_messages([self.message()])
+
+    def test_lost_reply_to_the_final_dot_is_not_sent_to_another_relay(self):
+        self.sink.drop_after_data = 1
+        with self.settings(EMAIL_HOSTS=[f'127.0.0.1:{self.port}', f'localhost:{self.port}']):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                get_connection().send_messages([self.message()])
+            self.assertEqual(sorted(relay.consecutive_failures for relay in relays.get_relays()), [0, 1])
+        self.assertEqual(self.sink.stats['messages'], 1)
+
+    def test_pool_exhaustion_is_not_a_relay_failure(self):
+        self.assertFalse(is_relay_failure(PoolExhausted('busy')))
+        with self.settings(EMAIL_HOSTS=[f'{self.host}:{self.port}']):
+            [relay] = relays.get_relays()
+            holder = get_connection()
+            holder.open()
+            self.addCleanup(holder.close)
+            relay.state = relays.HALF_OPEN
+            with self.assertRaises(PoolExhausted):
+                get_connection().send_messages([self.message()])
+            self.assertEqual((relay.state, relay.consecutive_failures), (relays.HALF_OPEN, 0))
+            # The probe slot is free again for a send that can get a connection.
+            self.assertTrue(relay.is_available())
+            holder.close()
+            self.assertEqual(get_connection().send_messages([self.message()]), 1)
+            self.assertEqual(relay.state, relays.CLOSED)
+
+
+@override_settings(EMAIL_RETRY_DEADLINE=0, EMAIL_POOL_MAX_SIZE=1, EMAIL_POOL_ACQUIRE_TIMEOUT=0)
+class DeliveryBreakerTests(BreakerTestCase):
+    backend = 'email_test.backends.PooledEmailBackend'
+
+    def test_unreachable_relay_counts_as_a_failure(self):
+        with self.settings(EMAIL_PORT=closed_port()):
+            [relay] = relays.get_relays()
+            with self.assertRaises(delivery.DeliveryError) as cm:
+                delivery.send([self.message()])
+        self.assertEqual(cm.exception.code, 'connection_failed')
+        self.assertEqual(relay.consecutive_failures, 1)
+
+    def test_pool_exhaustion_is_not_counted(self):
+        [relay] = relays.get_relays()
+        holder = get_connection()
+        holder.open()
+        self.addCleanup(holder.close)
+        relay.state = relays.HALF_OPEN
+        with self.assertRaises(delivery.DeliveryError) as cm:
+            delivery.send([self.message()])
+        self.assertEqual(cm.exception.code, 'pool_exhausted')
+        self.assertEqual((relay.state, relay.consecutive_failures, relay.latency), (relays.HALF_OPEN, 0, None))
+        self.assertTrue(relay.is_available())
+
+    def test_other_errors_give_back_the_probe(self):
+        [relay] = relays.get_relays()
+        relay.state = relays.HALF_OPEN
+        message = EmailMessage('Hi\nBcc: eve@example.com', 'Hello', 'sender@example.com', ['ada@example.com'])
+        with self.assertRaises(ValueError):
+            delivery.send([message])
+        with self.assertRaises(ValueError):
+            async_to_sync(delivery.send_async)(message)
+        self.assertEqual((relay.state, relay.consecutive_failures), (relays.HALF_OPEN, 0))
+        self.assertTrue(relay.is_available())
+        self.assertEqual(self.sink.stats['messages'], 0)
+
+
+@override_settings(EMAIL_RETRY_DEADLINE=5, EMAIL_RETRY_BASE_DELAY=0.01, EMAIL_RETRY_MAX_DELAY=0.02)
+class RetryTests(SinkTestCase):
+    def message(self):
+        return EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])
+
+    def rcpts(self):
+        return sum(1 for c in self.sink.commands if c.upper().startswith('RCPT '))
+
+    def test_temporary_rejection_is_retried_on_the_same_session(self):
+        self.sink.temp_fail_rate = 1.0
+
+        def backoff(attempts):
+            if attempts == 2:
+                self.sink.temp_fail_rate = 0.0
+            return 0
+
+        with mock.patch.object(delivery, '_backoff', side_effect=backoff):
+            self.assertEqual(delivery.send([self.message()]), 1)
+        self.assertEqual(self.rcpts(), 3)
+        self.assertEqual((self.sink.stats['connections'], self.sink.stats['messages']), (1, 1))
+
+    @override_settings(EMAIL_RETRY_DEADLINE=0.2)
+    def test_gives_up_at_the_deadline(self):
+        self.sink.temp_fail_rate = 1.0
+        with self.assertRaises(delivery.DeliveryError) as cm:
+            delivery.send([self.message()])
+        error = cm.exception
+        self.assertEqual((error.code, error.transient, error.status, error.smtp_code),
+                         ('recipient_rejected', True, 503, 451))
+        self.assertGreater(error.attempts, 1)
+        self.assertEqual(self.rcpts(), error.attempts)
+
+    def test_lost_reply_to_the_final_dot_is_not_retried(self):
+        for disable in (set(), {'PIPELINING'}):
+            with self.subTest(disable=disable):
+                self.sink.disable, self.sink.drop_after_data = disable, 1
+                with self.assertRaises(delivery.DeliveryError) as cm:
+                    delivery.send([self.message()])
+                error = cm.exception
+                self.assertEqual((error.code, error.transient, error.maybe_sent, error.attempts),
+                                 ('outcome_unknown', False, True, 1))
+        self.assertEqual((self.sink.stats['messages'], self.sink.stats['dropped_replies']), (2, 2))
+
+    def test_retry_resumes_at_the_message_that_failed(self):
+        first, second, third = self.message(), self.message(), self.message()
+        deliver = backends.InstrumentedEmailBackend._deliver
+        failures = [smtplib.SMTPServerDisconnected('Connection unexpectedly closed')]
+
+        def flaky(backend, message):
+            if message is second and failures:
+                backend.connection.close()
+                raise failures.pop()
+            return deliver(backend, message)
+
+        with mock.patch.object(backends.InstrumentedEmailBackend, '_deliver', autospec=True, side_effect=flaky), \
+                mock.patch.object(delivery, '_backoff', return_value=0):
+            self.assertEqual(delivery.send([first, second, third]), 3)
+        self.assertEqual((self.sink.stats['connections'], self.sink.stats['messages']), (2, 3))
+
+    def test_permanent_rejection_is_not_retried(self):
+        self.sink.perm_fail_rate = 1.0
+        with self.assertRaises(delivery.DeliveryError) as cm:
+            delivery.send([self.message()])
+        self.assertEqual((cm.exception.code, cm.exception.status, cm.exception.attempts),
+                         ('recipient_rejected', 422, 1))
+        self.assertEqual(self.rcpts(), 1)
+
+    @override_settings(EMAIL_RETRY_BASE_DELAY=1, EMAIL_RETRY_MAX_DELAY=4)
+    def test_backoff_is_jittered_and_capped(self):
+        with mock.patch('random.uniform', side_effect=lambda low, high: (low, high)):
+            self.assertEqual([delivery._backoff(n) for n in range(1, 6)], [(0, 1), (0, 2), (0, 4), (0, 4), (0, 4)])
+
+
+@override_settings(EMAIL_RETRY_DEADLINE=5, EMAIL_RETRY_BASE_DELAY=0.01, EMAIL_RETRY_MAX_DELAY=0.02)
+class AttachmentTests(SinkTestCase):
+    def post(self, **fields):
+        data = {'to_email': 'ada@example.com', 'subject': 'Report', 'message': 'See attached',
+                'attachment': io.BytesIO(b'.leading dot\r\n' * 5000), **fields}
+        data['attachment'].name = 'report.txt'
+        return self.client.post('/api/email/send-attachments/', data)
+
+    def test_line_breaks_in_headers_are_rejected(self):
+        for fields in ({'subject': 'Hi\r\nBcc: eve@example.com'},
+                       {'to_email': 'ada@example.com\nBcc: eve@example.com'}):
+            with self.subTest(fields=fields):
+                response = self.post(**fields)
+                self.assertEqual((response.status_code, response.json()['code']), (400, 'invalid_request'))
+        self.assertEqual(self.sink.messages, [])
+
+    @override_settings(DEFAULT_FROM_EMAIL='Jörg Müller <joerg@example.com>')
+    def test_non_ascii_display_name_is_encoded_apart_from_the_address(self):
+        self.assertEqual(self.post().status_code, 200)
+        message = email.message_from_bytes(self.sink.messages[0])
+        self.assertTrue(message['From'].endswith(' <joerg@example.com>'), message['From'])
+        self.assertEqual(str(email.header.make_header(email.header.decode_header(message['From']))),
+                         'Jörg Müller <joerg@example.com>')
+        # smtplib sends the verbs in lower case.
+        self.assertEqual(self.envelope(), ['mail FROM:<joerg@example.com>', 'rcpt TO:<ada@example.com>'])
+        [attachment] = [part for part in message.walk() if part.get_filename()]
+        self.assertEqual(attachment.get_payload(decode=True), b'.leading dot\r\n' * 5000)
+
+    def test_sent_through_delivery_with_retries_and_log(self):
+        self.sink.temp_fail_rate = 1.0
+
+        def backoff(attempts):
+            self.sink.temp_fail_rate = 0.0
+            return 0
+
+        with self.settings(EMAIL_DELIVERY_LOG=True), mock.patch.object(deliverylog, '_ensure_flusher'), \
+                mock.patch.object(delivery, '_backoff', side_effect=backoff):
+            response = self.post()
+            deliverylog.flush()
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.sink.stats['messages'], 1)
+        row = DeliveryLog.objects.get()
+        self.assertEqual((row.status, row.attempts, row.subject), (DeliveryLog.STATUS_SENT, 2, 'Report'))
+
+
+@override_settings(EMAIL_RATE_LIMIT=10, EMAIL_RATE_LIMIT_BURST=2, EMAIL_RATE_LIMIT_MAX_WAIT=1,
+                   EMAIL_DOMAIN_RATE_LIMIT=0, EMAIL_DOMAIN_RATE_LIMITS={}, EMAIL_HOSTS=[])
+class RateLimitTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        settings = override_settings(EMAIL_RATELIMIT_FILE=os.path.join(tmpdir.name, 'ratelimit.bin'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.now = 1_000_000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reserve(self, recipients=('ada@example.com',), **kwargs):
+        return ratelimit.reserve(list(recipients), **kwargs)
+
+    def test_burst_then_paced_waits(self):
+        self.assertEqual([self.reserve(), self.reserve()], [0.0, 0.0])
+        self.assertAlmostEqual(self.reserve(), 0.1)
+        # Tokens went negative, so the next caller queues behind it.
+        self.assertAlmostEqual(self.reserve(), 0.2)
+        self.now += 0.3
+        self.assertEqual(self.reserve(), 0.0)
+
+    def test_refused_wait_takes_nothing(self):
+        self.reserve()
+        self.reserve()
+        for _ in range(2):
+            with self.assertRaises(ratelimit.RateLimited) as cm:
+                self.reserve(max_wait=0)
+            self.assertAlmostEqual(cm.exception.retry_after, 0.1)
+        self.assertEqual(ratelimit.retry_after_header(cm.exception), '1')
+
+    def test_refill_survives_a_restart(self):
+        self.reserve()
+        self.reserve()
+        # A new process (or a reboot) maps the same file; the time it
+        # stored is still comparable with the clock.
+        with mock.patch.object(ratelimit, '_state', None):
+            self.now += 60
+            self.assertEqual([self.reserve(), self.reserve()], [0.0, 0.0])
+
+    def test_clock_set_back_does_not_add_tokens(self):
+        self.reserve()
+        self.reserve()
+        self.now -= 3600
+        self.assertAlmostEqual(self.reserve(), 0.1)
+
+    @override_settings(EMAIL_RATE_LIMIT=0, EMAIL_DOMAIN_RATE_LIMIT=1, EMAIL_DOMAIN_RATE_LIMITS={'slow.example': 0.5})
+    def test_domain_buckets_take_a_token_per_recipient(self):
+        self.assertEqual(ratelimit.buckets_for(['a@example.com', 'B <b@Example.com>', 'c@slow.example']), [
+            ('domain:example.com', 1, 2, 2), ('domain:slow.example', 0.5, 1.0, 1),
+        ])
+        self.assertEqual(self.reserve(['a@example.com', 'b@example.com']), 0.0)
+        self.assertAlmostEqual(self.reserve(['a@example.com']), 1.0)
+        self.assertEqual(self.reserve(['c@slow.example']), 0.0)
+        self.assertAlmostEqual(self.reserve(['c@slow.example'], max_wait=5), 2.0)
+
+    def test_full_probe_window_evicts_the_least_recently_used_bucket(self):
+        hashes = {'a': 1, 'b': 1 + ratelimit.NUM_SLOTS, 'c': 1 + 2 * ratelimit.NUM_SLOTS}
+        with mock.patch.object(ratelimit, 'MAX_PROBES', 2), \
+                mock.patch.object(ratelimit, '_key_hash', side_effect=lambda key: hashes[key]):
+            for key in ('a', 'a', 'b', 'b'):
+                self.reserve(relay=key)
+                self.now += 0.01
+            self.assertGreater(self.reserve(relay='a'), 0)
+            self.now += 0.01
+            self.reserve(relay='b')
+            self.now += 0.01
+            # No room for c: a (used longest ago) makes way, and comes back full.
+            self.assertEqual(self.reserve(relay='c'), 0.0)
+            self.assertEqual(self.reserve(relay='a'), 0.0)
+
+
+class AddressTests(TestCase):
+    def test_domain_is_idna_and_lowercase_local_part_kept(self):
+        self.assertEqual(schema.normalize_address('Ada@Bücher.DE'), 'Ada@xn--bcher-kva.de')
+        self.assertEqual(schema.normalize_address(' ada@example.com '), 'ada@example.com')
+        self.assertEqual(schema.normalize_address('Ada L <Ada@Example.COM>'), 'Ada L <Ada@example.com>')
+        self.assertEqual(schema.normalize_address('jörg@[192.0.2.1]'), 'jörg@[192.0.2.1]')
+
+    def test_invalid_addresses(self):
+        for value in ['ada', '@example.com', 'ada@', 'a b@example.com', 'ada@-example.com',
+                      'ada@[300.1.1.1]', 'ada@example.com\r\nBcc: x@example.com', 'x' * 65 + '@example.com']:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                schema.normalize_address(value)
+
+    @override_settings(EMAIL_MAX_REQUEST_BYTES=100)
+    def test_oversized_body_is_rejected_before_parsing(self):
+        body = json.dumps({'to_email': 'ada@example.com', 'message': 'x' * 100})
+        response = self.client.post('/api/email/send/', body, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['code']), (413, 'request_too_large'))
+
+    def test_invalid_to_email_is_a_400(self):
+        body = json.dumps({'to_email': 'not an address'})
+        response = self.client.post('/api/email/send/', body, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['code']), (400, 'invalid_request'))
+
+
+class LeaseTests(TestCase):
+    def setUp(self):
+        self.job = outbox.enqueue({'to_email': 'ada@example.com', 'subject': 'Hi', 'message': 'Hello'})
+
+    def expire(self):
+        EmailJob.objects.filter(id=self.job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_leased_job_is_not_claimed_twice(self):
+        self.assertEqual(len(outbox.claim_batch('a', lease_seconds=60)), 1)
+        self.assertEqual(outbox.claim_batch('b', lease_seconds=60), [])
+
+    def test_expired_lease_is_retaken(self):
+        outbox.claim_batch('a', lease_seconds=60)
+        self.expire()
+        [job] = outbox.claim_batch('b', lease_seconds=60)
+        self.assertEqual((job.lease_owner, job.attempts), ('b', 2))
+
+    def test_stale_owner_cannot_renew_or_mark(self):
+        [stale] = outbox.claim_batch('a', lease_seconds=60)
+        self.expire()
+        [job] = outbox.claim_batch('b', lease_seconds=60)
+        self.assertFalse(outbox.renew(stale, 'a', 60))
+        self.assertEqual(outbox.mark_sent([stale], 'a'), 0)
+        self.assertFalse(outbox.mark_failed(stale, 'a', 'boom', max_attempts=5, permanent=True))
+        self.assertEqual(EmailJob.objects.get(id=job.id).status, EmailJob.STATUS_SENDING)
+        self.assertEqual(outbox.mark_sent([job], 'b'), 1)
+        self.assertEqual(EmailJob.objects.get(id=job.id).status, EmailJob.STATUS_SENT)
+
+    def due(self):
+        EmailJob.objects.filter(id=self.job.id).update(not_before=timezone.now() - timedelta(seconds=1))
+
+    def test_deferred_job_keeps_its_attempts_and_waits(self):
+        [job] = outbox.claim_batch('a', lease_seconds=60)
+        self.assertTrue(outbox.defer(job, 'a', 30, 'rate limited'))
+        job = EmailJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.attempts, job.lease_owner), (EmailJob.STATUS_QUEUED, 0, ''))
+        self.assertEqual(outbox.claim_batch('b', lease_seconds=60), [])
+        self.due()
+        self.assertEqual(len(outbox.claim_batch('b', lease_seconds=60)), 1)
+
+    @override_settings(EMAIL_QUEUE_RETRY_BASE_DELAY=30, EMAIL_QUEUE_RETRY_MAX_DELAY=3600)
+    def test_transient_failure_backs_off(self):
+        [job] = outbox.claim_batch('a', lease_seconds=60)
+        self.assertTrue(outbox.mark_failed(job, 'a', 'timeout', max_attempts=5))
+        job = EmailJob.objects.get(id=job.id)
+        self.assertEqual(job.status, EmailJob.STATUS_QUEUED)
+        self.assertGreater(job.not_before, timezone.now() + timedelta(seconds=14))
+        self.assertEqual(outbox.claim_batch('a', lease_seconds=60), [])
+        self.due()
+        [job] = outbox.claim_batch('a', lease_seconds=60)
+        self.assertEqual(job.attempts, 2)
+
+    @override_settings(EMAIL_QUEUE_RETRY_BASE_DELAY=10, EMAIL_QUEUE_RETRY_MAX_DELAY=25)
+    def test_retry_delay_doubles_up_to_the_cap(self):
+        for attempts, low, high in [(1, 5, 10), (2, 10, 20), (3, 12.5, 25), (10, 12.5, 25)]:
+            for _ in range(20):
+                self.assertTrue(low <= outbox.retry_delay(attempts) <= high)
+
+
+class DrainTests(SinkTestCase):
+    def enqueue(self, to_email, profile=None):
+        payload = {'to_email': to_email, 'subject': 'Hi', 'message': 'Hello'}
+        if profile:
+            payload['profile'] = profile
+        return outbox.enqueue(payload)
+
+    def send_batch(self, lease_seconds=60):
+        jobs = outbox.claim_batch('drain', lease_seconds=lease_seconds)
+        return DrainCommand(stdout=io.StringIO()).send_batch(jobs, 'drain', lease_seconds, max_attempts=5)
+
+    def status(self, job):
+        job = EmailJob.objects.get(id=job.id)
+        return job.status, job.attempts
+
+    def test_drains_the_queue_to_the_relay(self):
+        jobs = [self.enqueue(f'user{i}@example.com') for i in range(3)]
+        call_command('drain_email_queue', '--once', stdout=io.StringIO())
+        self.assertEqual([self.status(job) for job in jobs], [(EmailJob.STATUS_SENT, 1)] * 3)
+        self.assertEqual(len(self.sink.messages), 3)
+
+    def test_unreachable_default_relay_does_not_hold_up_other_profiles(self):
+        first, second = self.enqueue('a@example.com'), self.enqueue('b@example.com')
+        other = self.enqueue('c@example.com', profile='acme')
+        with self.settings(
+            EMAIL_PORT=closed_port(), EMAIL_RETRY_DEADLINE=0,
+            EMAIL_PROFILES={'acme': {'host': self.host, 'port': self.port}},
+        ):
+            self.assertEqual(self.send_batch(), (1, 1, 1))
+        self.assertEqual(self.status(first), (EmailJob.STATUS_QUEUED, 1))
+        # Not tried, so the attempt isn't counted.
+        self.assertEqual(self.status(second), (EmailJob.STATUS_QUEUED, 0))
+        self.assertEqual(self.status(other), (EmailJob.STATUS_SENT, 1))
+
+    def test_rate_limit_wait_is_capped_below_the_lease(self):
+        jobs = [self.enqueue('a@example.com'), self.enqueue('b@example.com')]
+        with self.settings(EMAIL_RATE_LIMIT=0.01, EMAIL_RATE_LIMIT_BURST=1):
+            self.assertEqual(self.send_batch(lease_seconds=60), (1, 0, 1))
+        self.assertEqual(self.status(jobs[0]), (EmailJob.STATUS_SENT, 1))
+        self.assertEqual(self.status(jobs[1]), (EmailJob.STATUS_QUEUED, 0))
+        self.assertGreater(EmailJob.objects.get(id=jobs[1].id).not_before, timezone.now())
+
+    def test_invalid_payload_fails_without_retries(self):
+        job = outbox.enqueue({'subject': 'Hi', 'message': 'Hello'})
+        self.assertEqual(self.send_batch(), (0, 1, 0))
+        self.assertEqual(self.status(job), (EmailJob.STATUS_FAILED, 1))
+
+    def test_job_status_shows_when_a_requeued_job_is_next_tried(self):
+        job = self.enqueue('a@example.com')
+        with self.settings(EMAIL_PORT=closed_port(), EMAIL_RETRY_DEADLINE=0):
+            self.send_batch()
+        data = self.client.get(f'/api/email/jobs/{job.id}/').json()['job']
+        self.assertEqual((data['status'], data['attempts']), (EmailJob.STATUS_QUEUED, 1))
+        self.assertEqual(data['not_before'], EmailJob.objects.get(id=job.id).not_before.isoformat())
+
+
+@override_settings(DEFAULT_FROM_EMAIL='sender@example.com')
+class BulkSendTests(SinkTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'addresses.txt')
+        self.output = os.path.join(tmpdir.name, 'results.ndjson')
+
+    def send(self, lines, **options):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        options.setdefault('recipients_file', self.path)
+        call_command('send_test_email', output=self.output, quiet=True, concurrency=2, stderr=io.StringIO(), **options)
+        with open(self.output, encoding='utf-8') as f:
+            return sorted((json.loads(line) for line in f), key=lambda result: result['line'])
+
+    def rcpts(self):
+        return sorted(c for c in self.envelope() if c.startswith('RCPT'))
+
+    def test_invalid_addresses_are_reported_not_sent(self):
+        results = self.send(['a@example.com', '', '# comment', 'not an address', 'B@Example.COM'])
+        self.assertEqual([(r['line'], r['success']) for r in results], [(1, True), (4, False), (5, True)])
+        self.assertEqual(results[1]['code'], 'invalid_request')
+        self.assertEqual(self.rcpts(), ['RCPT TO:<B@example.com>', 'RCPT TO:<a@example.com>'])
+        with open(f'{self.path}.checkpoint') as f:
+            self.assertEqual(json.load(f), {'next_line': 6, 'done': []})
+
+    def test_resume_skips_done_lines(self):
+        with open(f'{self.path}.checkpoint', 'w') as f:
+            json.dump({'next_line': 2, 'done': [3]}, f)
+        results = self.send(['a@example.com', 'b@example.com', 'c@example.com'], resume=True)
+        self.assertEqual([r['line'] for r in results], [2])
+        self.assertEqual(self.rcpts(), ['RCPT TO:<b@example.com>'])
+
+    def test_stdin_without_checkpoint_saves_nothing(self):
+        stdin = io.StringIO('a@example.com\nb@example.com\n')
+        with mock.patch('sys.stdin', stdin), mock.patch('os.replace') as replace:
+            results = self.send([], recipients_file='-')
+        self.assertEqual(len(results), 2)
+        replace.assert_not_called()
+        self.assertFalse(Checkpoint().load())
+
+
+@override_settings(DEFAULT_FROM_EMAIL='sender@example.com', EMAIL_MERGE_PROCESSES=1)
+class MergeTests(SinkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(self.discard_pool)
+        self.discard_pool()
+
+    def discard_pool(self):
+        if merge._pool is not None:
+            merge._pool[1].shutdown(cancel_futures=True)
+            merge._pool = None
+
+    def test_render_pool_is_sized_by_the_setting_and_shared(self):
+        pool = merge.get_render_pool()
+        self.assertEqual(pool._max_workers, 1)
+        self.assertIs(merge.get_render_pool(), pool)
+        self.discard_pool()
+        with self.settings(EMAIL_MERGE_PROCESSES=0):
+            self.assertEqual(merge.get_render_pool()._max_workers, os.cpu_count())
+
+    def test_forked_worker_starts_its_own_pool(self):
+        inherited = merge.get_render_pool()
+        self.addCleanup(inherited.shutdown)
+        merge._pool = (os.getpid() + 1, inherited)  # As if created before a fork.
+        self.assertIsNot(merge.get_render_pool(), inherited)
+
+    def test_every_recipient_is_sent_and_failures_are_reported(self):
+        rows = merge.read_rows(['{"to_email": "ada@example.com", "name": "Ada"}', '[]', '{"email": "bob@example.com"}'],
+                               'ndjson')
+        events = list(merge.run('welcome', rows, subject='Hi'))
+        self.assertEqual(events[0], {'index': 1, 'success': False, 'error': 'Each line must be a JSON object',
+                                     'code': 'invalid_request'})
+        summary = events[-1]['summary']
+        self.assertEqual((summary['read'], summary['rendered'], summary['sent'], summary['failed']), (3, 2, 2, 1))
+        self.assertEqual(sorted(c for c in self.envelope() if c.startswith('RCPT')),
+                         ['RCPT TO:<ada@example.com>', 'RCPT TO:<bob@example.com>'])
+
+
+@override_settings(DEFAULT_FROM_EMAIL='sender@example.com')
+class SendBatchTests(SinkTestCase):
+    def post(self, body, content_type='application/x-ndjson'):
+        response = self.client.post('/api/email/send-batch/', body, content_type=content_type)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def message(self, to_email):
+        return {'to_email': to_email, 'subject': 'Hi', 'message': 'Hello'}
+
+    def test_results_per_line_then_summary(self):
+        body = '\n'.join([
+            json.dumps(self.message('a@example.com')),
+            '{not json',
+            '',
+            json.dumps({'subject': 'Hi'}),
+            json.dumps(self.message('b@example.com')),
+        ])
+        *results, summary = self.post(body)
+        self.assertEqual([(r['index'], r['success']) for r in results], [(0, True), (1, False), (2, False), (3, True)])
+        self.assertEqual({r.get('code') for r in results[1:3]}, {'invalid_request'})
+        self.assertEqual(summary, {'summary': {'sent': 2, 'failed': 2}})
+        self.assertEqual(self.sink.stats['connections'], 1)
+        self.assertEqual(len(self.sink.messages), 2)
+
+    def test_json_array_body(self):
+        *results, summary = self.post(json.dumps([self.message('a@example.com')]), 'application/json')
+        self.assertEqual(results, [{'index': 0, 'success': True, 'to_email': 'a@example.com'}])
+        self.assertEqual(summary, {'summary': {'sent': 1, 'failed': 0}})
+
+    def test_invalid_json_array_is_rejected(self):
+        response = self.client.post('/api/email/send-batch/', '[{', content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['code']), (400, 'invalid_json'))
+
+    def test_rate_limit_paces_the_batch(self):
+        body = '\n'.join(json.dumps(self.message(f'user{i}@example.com')) for i in range(3))
+        with self.settings(EMAIL_RATE_LIMIT=50, EMAIL_RATE_LIMIT_BURST=1, EMAIL_RATE_LIMIT_MAX_WAIT=0):
+            *results, summary = self.post(body)
+        self.assertTrue(all(r['success'] for r in results))
+        self.assertEqual(summary, {'summary': {'sent': 3, 'failed': 0}})
+
+
+class WireTestCase(SinkTestCase):
+    def send_both(self, email):
+        """Send ``email`` over the sync backend, then the async pool."""
+        get_connection().send_messages([email])
+
+        async def send_async():
+            try:
+                await aiosmtp.send_message_async(email)
+            finally:
+                await aiosmtp.close_async_pool()
+
+        async_to_sync(send_async)()
+        self.assertEqual(len(self.sink.messages), 2)
+        return [c for c in self.sink.commands if c.upper().startswith(('MAIL ', 'RCPT '))]
+
+    def message(self, to='ada@example.com', body='Grüße aus Köln'):
+        return EmailMessage('Hi', body, 'sender@example.com', [to])
+
+
+class EightBitTests(WireTestCase):
+    def test_text_goes_out_as_8bit(self):
+        sync, async_ = self.send_both(self.message())[::2]
+        self.assertRegex(sync, r'^MAIL FROM:<sender@example.com> SIZE=\d+ BODY=8BITMIME$')
+        self.assertRegex(async_, r'^MAIL FROM:<sender@example.com> SIZE=\d+ BODY=8BITMIME$')
+        for message in self.sink.messages:
+            self.assertIn(b'Content-Transfer-Encoding: 8bit', message)
+            self.assertIn('Grüße'.encode(), message)
+
+
+class SevenBitTests(WireTestCase):
+    sink_options = {'disable': {'8BITMIME', 'PIPELINING'}}
+
+    def test_text_is_encoded_without_8bitmime(self):
+        commands = self.send_both(self.message())
+        self.assertNotIn('BODY=8BITMIME', ' '.join(commands))
+        self.assertTrue(all(message.isascii() for message in self.sink.messages))
+        self.assertEqual(self.sink.stats['undeclared_8bit'], 0)
+        self.assertEqual(self.sink.stats['pipelined'], 0)
+
+
+class SMTPUTF8Tests(WireTestCase):
+    def test_utf8_local_part_is_sent_as_utf8(self):
+        sync_mail, sync_rcpt, async_mail, async_rcpt = self.send_both(self.message(to='Jörg <jörg@bücher.de>'))
+        self.assertRegex(sync_mail, r'^MAIL FROM:<sender@example.com> SIZE=\d+ SMTPUTF8 BODY=8BITMIME$')
+        self.assertRegex(async_mail, r'^MAIL FROM:<sender@example.com> SIZE=\d+ SMTPUTF8 BODY=8BITMIME$')
+        self.assertEqual(sync_rcpt, 'RCPT TO:<jörg@bücher.de>')
+        self.assertEqual(async_rcpt, sync_rcpt)
+
+    def test_ascii_addresses_dont_ask_for_smtputf8(self):
+        commands = self.send_both(self.message(body='Hello'))
+        self.assertEqual([c.split(' ')[:2] for c in commands], [['MAIL', 'FROM:<sender@example.com>'],
+                                                                ['RCPT', 'TO:<ada@example.com>']] * 2)
+        self.assertNotIn('SMTPUTF8', ' '.join(commands))
+
+
+class PipeliningTests(WireTestCase):
+    def test_rejected_pipelined_transaction_leaves_the_session_usable(self):
+        def sync():
+            connection = get_connection()
+            connection.open()
+            try:
+                self.sink.perm_fail_rate = 1.0
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    connection.send_messages([self.message()])
+                self.sink.perm_fail_rate = 0.0
+                self.assertEqual(connection.send_messages([self.message()]), 1)
+            finally:
+                connection.close()
+
+        async def async_():
+            client = aiosmtp.AsyncSMTP(self.host, self.port)
+            await client.connect()
+            try:
+                self.sink.perm_fail_rate = 1.0
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    await client.send_message(self.message())
+                self.sink.perm_fail_rate = 0.0
+                await client.send_message(self.message())
+            finally:
+                await client.quit()
+
+        sync()
+        async_to_sync(async_)()
+        self.assertEqual((self.sink.stats['connections'], self.sink.stats['messages']), (2, 2))
+        # The DATA pipelined behind the refused RCPT was turned down, then the session reset.
+        verbs = [c.split(' ')[0].upper() for c in self.sink.commands]
+        self.assertEqual(verbs.count('RSET'), 2)
+        # MAIL and RCPT of each transaction were answered with DATA already sent.
+        self.assertEqual(self.sink.stats['pipelined'], 8)
+
+
+def verify_dkim(message, public_key):
+    """Check the DKIM-Signature heading ``message`` (bytes as received); return its tags."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    head, _, body = message.partition(b'\r\n\r\n')
+    (name, value), *headers = dkim._split_headers(head)
+    assert name == dkim.HEADER_NAME, name
+    tags = dict(tag.split(b'=', 1) for tag in re.sub(rb'\s+', b'', value).split(b';') if tag)
+    assert tags[b'bh'] == base64.b64encode(hashlib.sha256(dkim._canonical_body(body)).digest()), 'body hash'
+    # RFC 6376 5.4.2: each name in h= takes the next instance from the bottom.
+    remaining = list(reversed(headers))
+    signed = b''
+    for wanted in tags[b'h'].split(b':'):
+        header = next(h for h in remaining if h[0].strip().lower() == wanted)
+        remaining.remove(header)
+        signed += dkim._canonical_header(*header) + b'\r\n'
+    signed += dkim._canonical_header(name, re.sub(rb'(?<![a-z])b=[^;]*', b'b=', value))
+    signature = base64.b64decode(tags[b'b'])
+    if tags[b'a'] == b'rsa-sha256':
+        public_key.verify(signature, signed, padding.PKCS1v15(), hashes.SHA256())
+    else:
+        public_key.verify(signature, hashlib.sha256(signed).digest())
+    return tags
+
+
+class DKIMTestCase(WireTestCase):
+    def setUp(self):
+        super().setUp()
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+        key = self.make_key(rsa, ed25519)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'dkim.pem')
+        with open(path, 'wb') as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            ))
+        self.public_key = key.public_key()
+        settings = override_settings(
+            EMAIL_DKIM_DOMAIN='example.com', EMAIL_DKIM_SELECTOR='test', EMAIL_DKIM_PRIVATE_KEY_FILE=path,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def make_key(self, rsa, ed25519):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def verify_all(self):
+        return [verify_dkim(message, self.public_key) for message in self.sink.messages]
+
+
+class DKIMTests(DKIMTestCase):
+    def test_relaxed_canonicalization(self):
+        # RFC 6376 3.4.5.
+        headers = dkim._split_headers(b'A: X\r\nB : Y\t\r\n\tZ  ')
+        self.assertEqual([dkim._canonical_header(*h) for h in headers], [b'a:X', b'b:Y Z'])
+        self.assertEqual(dkim._canonical_body(b' C \r\nD \t E\r\n\r\n\r\n'), b' C\r\nD E\r\n')
+        self.assertEqual(dkim._canonical_body(b'\r\n\r\n'), b'')
+
+    def test_sent_messages_verify_on_both_paths(self):
+        self.send_both(self.message())
+        for tags in self.verify_all():
+            self.assertEqual((tags[b'a'], tags[b'd'], tags[b's'], tags[b'c']),
+                             (b'rsa-sha256', b'example.com', b'test', b'relaxed/relaxed'))
+            self.assertIn(b'from', tags[b'h'].split(b':'))
+
+    def test_tampered_message_fails(self):
+        from cryptography.exceptions import InvalidSignature
+
+        self.send_both(self.message())
+        message = self.sink.messages[0]
+        with self.assertRaisesRegex(AssertionError, 'body hash'):
+            verify_dkim(message.replace('Grüße'.encode(), b'Hello'), self.public_key)
+        with self.assertRaises(InvalidSignature):
+            verify_dkim(message.replace(b'Subject: Hi', b'Subject: Ho'), self.public_key)
+
+    def test_async_path_signs_off_the_event_loop(self):
+        threads = []
+        sign = dkim.sign
+
+        def spy(data):
+            threads.append(threading.get_ident())
+            return sign(data)
+
+        async def send():
+            try:
+                await aiosmtp.send_message_async(self.message())
+            finally:
+                await aiosmtp.close_async_pool()
+            return threading.get_ident()
+
+        with mock.patch.object(dkim, 'sign', spy):
+            loop_thread = async_to_sync(send)()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+        self.verify_all()
+
+
+class DKIMSevenBitTests(DKIMTestCase):
+    sink_options = {'disable': {'8BITMIME'}}
+
+    def test_message_reencoded_for_a_7bit_relay_is_signed_again(self):
+        self.send_both(self.message())
+        self.assertTrue(all(message.isascii() for message in self.sink.messages))
+        self.assertEqual([message.count(dkim.HEADER_NAME) for message in self.sink.messages], [1, 1])
+        self.verify_all()
+
+
+class Ed25519Tests(DKIMTestCase):
+    def make_key(self, rsa, ed25519):
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def test_ed25519_signature_verifies(self):
+        self.send_both(self.message())
+        self.assertEqual({tags[b'a'] for tags in self.verify_all()}, {b'ed25519-sha256'})
+
+
+class StreamingDKIMTests(DKIMTestCase):
+    def test_streamed_body_hash_matches_the_whole_body(self):
+        for chunks in ([b'A  b\r\n', b'\r\n', b'\r\n'], [b'a\r\n\r\n', b'\r\n', b'b \t\r\n', b''],
+                       [b'\r\n', b''], []):
+            with self.subTest(chunks=chunks):
+                self.assertEqual(dkim._body_hash(chunks),
+                                 hashlib.sha256(dkim._canonical_body(b''.join(chunks))).digest())
+
+    def test_message_with_attachments_is_signed(self):
+        attachment = io.BytesIO(b'\x00\xff' * 100000)
+        attachment.name = 'data.bin'
+        response = self.client.post('/api/email/send-attachments/', {
+            'to_email': 'ada@example.com', 'subject': 'Data', 'attachment': attachment,
+        })
+        self.assertEqual(response.status_code, 200, response.content)
+        [tags] = self.verify_all()
+        self.assertIn(b'subject', tags[b'h'].split(b':'))
+
+    def test_spooled_attachment_is_signed(self):
+        self.addCleanup(close_all_pools)
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        attachment = io.BytesIO(b'\x00\xff' * 100000)
+        attachment.name = 'data.bin'
+        with self.settings(EMAIL_BACKEND='email_test.backends.SpoolingEmailBackend', EMAIL_SPOOL_DIR=spool_dir.name,
+                           EMAIL_PORT=closed_port()):
+            response = self.client.post('/api/email/send-attachments/', {
+                'to_email': 'ada@example.com', 'subject': 'Data', 'attachment': attachment,
+            })
+            self.assertEqual(response.status_code, 202, response.content)
+            *_, data = spool.read(response.json()['spool_id'], spool.NEW)
+        verify_dkim(data, self.public_key)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='sender@example.com')
+class SendBatchDKIMTests(DKIMTestCase):
+    def post(self, count=3):
+        body = '\n'.join(json.dumps({'to_email': f'user{i}@example.com', 'message': 'Grüße'}) for i in range(count))
+        response = self.client.post('/api/email/send-batch/', body, content_type='application/x-ndjson')
+        summary = b''.join(response.streaming_content).splitlines()[-1]
+        self.assertEqual(json.loads(summary), {'summary': {'sent': count, 'failed': 0}})
+
+    @override_settings(EMAIL_DKIM_BATCH_SIZE=0)
+    def test_each_message_is_signed_as_it_is_sent(self):
+        with mock.patch.object(merge, 'get_render_pool', side_effect=AssertionError('render pool started')):
+            self.post()
+        self.assertEqual(len(self.verify_all()), 3)
+
+    @override_settings(EMAIL_DKIM_BATCH_SIZE=2)
+    def test_batches_are_signed_in_the_render_pool_when_enabled(self):
+        # No executor: sign_batch() signs in this process, where the test key is.
+        with mock.patch.object(merge, 'get_render_pool', return_value=None) as get_render_pool:
+            self.post()
+        self.assertEqual(get_render_pool.call_count, 2)
+        self.assertEqual(len(self.verify_all()), 3)
+
+
+class ReplyParserTests(TestCase):
+    def test_multi_line_reply(self):
+        parser = probe.ReplyParser()
+        self.assertEqual(parser.feed(b'250-sink.local\r\n250-PIPELINING\r\n250 SIZE 10\r\n'),
+                         [(250, ['sink.local', 'PIPELINING', 'SIZE 10'])])
+        self.assertTrue(parser.idle)
+
+    def test_replies_split_across_reads(self):
+        parser = probe.ReplyParser()
+        self.assertEqual(parser.feed(b'250-sink.local\r\n250 PIPE'), [])
+        self.assertFalse(parser.idle)
+        self.assertEqual(parser.feed(b'LINING\r'), [])
+        self.assertEqual(parser.feed(b'\n220 Go ahead\n354\r\n'),
+                         [(250, ['sink.local', 'PIPELINING']), (220, ['Go ahead']), (354, [''])])
+        self.assertTrue(parser.idle)
+
+    def test_malformed_lines_are_rejected(self):
+        for line in (b'hello\r\n', b'25 OK\r\n', b'250:OK\r\n', b'\r\n'):
+            with self.subTest(line=line), self.assertRaisesRegex(probe.ProbeError, 'Malformed'):
+                probe.ReplyParser().feed(line)
+
+    def test_unterminated_line_is_capped(self):
+        parser = probe.ReplyParser()
+        parser.feed(b'250 ' + b'x' * (probe.MAX_LINE_LENGTH - 4))
+        with self.assertRaisesRegex(probe.ProbeError, 'too long'):
+            parser.feed(b'x')
+
+
+class ProbeTests(SinkTestCase):
+    sink_options = {'starttls': True}
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, SSL_CERT_FILE=self.sink.cert_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def peer(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=5)
+        self.addCleanup(connection.close)
+        connection.starttls(context=transport.get_ssl_context(verify=False))
+        return connection.sock
+
+    def test_peer_chain_starts_with_the_leaf(self):
+        sock = self.peer()
+        chain = probe._peer_chain(sock)
+        self.assertEqual(chain[0], sock.getpeercert(binary_form=True))
+        self.assertTrue(all(isinstance(der, bytes) for der in chain))
+
+    def test_peer_chain_falls_back_to_the_leaf(self):
+        sock = mock.Mock(spec=['getpeercert', '_sslobj'], _sslobj=None)
+        sock.getpeercert.return_value = b'leaf'
+        self.assertEqual(probe._peer_chain(sock), [b'leaf'])
+
+    def test_verify_chain(self):
+        chain = probe._peer_chain(self.peer())
+        self.assertIsNone(probe.verify_chain(chain, self.host))
+        self.assertIsNone(probe.verify_chain(chain, 'localhost'))
+        self.assertIsNotNone(probe.verify_chain(chain, 'mail.example.com'))
+        with mock.patch.dict(os.environ, SSL_CERT_FILE=os.devnull):
+            self.assertIsNotNone(probe.verify_chain(chain, self.host))
+
+    def test_probe(self):
+        result = probe.probe(self.host, self.port, timeout=5)
+        self.assertTrue(result['ok'], result.get('error'))
+        self.assertEqual((result['tls'], result['verified'], result['hostname_match'], result['days_until_expiry']),
+                         ('starttls', True, True, 0))
+        self.assertIn('PIPELINING', result['extensions'])
+        self.assertNotIn('STARTTLS', result['extensions'])
+        self.assertEqual(list(result['timings_ms']),
+                         ['dns', 'connect', 'greeting', 'ehlo', 'tls_handshake', 'ehlo_tls', 'parse', 'verify', 'total'])
+        self.assertEqual(self.sink.commands[-1], 'QUIT')
+
+    def test_probe_reports_an_untrusted_certificate(self):
+        with mock.patch.dict(os.environ, SSL_CERT_FILE=os.devnull):
+            result = probe.probe(self.host, self.port, timeout=5)
+        self.assertFalse(result['ok'])
+        self.assertEqual((result['verified'], result['hostname_match'], result['days_until_expiry']), (False, True, 0))
+        self.assertTrue(result['verify_error'])
+        self.assertNotIn('error', result)
+
+    def test_probe_never_raises(self):
+        result = probe.probe(self.host, closed_port(), timeout=5)
+        self.assertFalse(result['ok'])
+        self.assertRegex(result['error'], '^ConnectionRefusedError')
+
+
+@override_settings(EMAIL_HEALTH_CHECK_INTERVAL=30, EMAIL_HEALTH_CHECK_TIMEOUT=5, EMAIL_HEALTH_CHECK_AUTH=True)
+class HealthTests(SinkTestCase):
+    sink_options = {'starttls': True}
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'health.json')
+        # After SinkTestCase's overrides, which turn TLS and AUTH off.
+        settings = override_settings(
+            EMAIL_HEALTH_FILE=self.path, EMAIL_USE_TLS=True, EMAIL_HOST_USER='user', EMAIL_HOST_PASSWORD='secret',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        for patcher in (mock.patch.object(health, '_cached', None), mock.patch.object(health, 'ensure_prober'),
+                        mock.patch.dict(os.environ, SSL_CERT_FILE=self.sink.cert_path)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_healthy_relay(self):
+        result = health.probe_relay(self.host, self.port)
+        self.assertTrue(result['ok'], result.get('error'))
+        self.assertEqual(list(result['latency_ms']), ['connect', 'ehlo', 'starttls', 'auth', 'total'])
+        self.assertEqual(result['tls_version'], 'TLSv1.3')
+        # The sink's certificate is good for a day.
+        self.assertEqual(result['cert_days_remaining'], 0)
+        self.assertIn('PIPELINING', result['capabilities'])
+        self.assertIn('AUTH PLAIN LOGIN', result['capabilities'])
+
+    def test_untrusted_certificate_still_reports_its_expiry(self):
+        del os.environ['SSL_CERT_FILE']
+        with mock.patch.dict(os.environ, SSL_CERT_FILE=os.devnull):
+            result = health.probe_relay(self.host, self.port)
+        self.assertFalse(result['ok'])
+        self.assertRegex(result['error'], '^ProbeError: Certificate verification failed')
+        self.assertEqual(result['cert_days_remaining'], 0)
+        self.assertIn('cert_not_after', result)
+        # Credentials never go to a server that failed verification.
+        self.assertFalse(any(c.upper().startswith('AUTH') for c in self.sink.commands))
+
+    def test_status_reflects_every_relay(self):
+        with self.settings(EMAIL_HOSTS=[f'{self.host}:{self.port}', f'127.0.0.1:{closed_port()}']):
+            snapshot = health.run_checks()
+        self.assertEqual(snapshot['status'], health.DEGRADED)
+        self.assertEqual([r['ok'] for r in snapshot['relays']], [True, False])
+        self.assertIn('ConnectionRefusedError', snapshot['relays'][1]['error'])
+
+    def test_refresh_probes_once_per_interval(self):
+        with mock.patch.object(health, 'probe_relay', wraps=health.probe_relay) as probe_relay:
+            self.assertEqual(health.refresh(), 30)
+            self.assertLessEqual(health.refresh(), 30)
+        self.assertEqual(probe_relay.call_count, 1)
+        first = health.get_snapshot()
+        self.assertEqual(first.status, health.OK)
+        self.assertIs(health.get_snapshot(), first)
+        self.assertTrue(0 < first.max_age() <= 30)
+        # An old file is due again, and a new snapshot replaces the cached one.
+        os.utime(self.path, (0, 0))
+        self.assertEqual(health.refresh(), 30)
+        self.assertIsNot(health.get_snapshot(), first)
+
+    def test_refresh_skips_while_another_worker_holds_the_lock(self):
+        with open(self.path + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.assertEqual(health.refresh(), 30)
+        self.assertIsNone(health.get_snapshot())
+
+    def test_status_endpoint_etag(self):
+        response = self.client.get('/api/email/status/')
+        self.assertEqual((response.json()['status'], response['Cache-Control']), (health.UNKNOWN, 'no-cache'))
+
+        health.refresh()
+        response = self.client.get('/api/email/status/')
+        self.assertEqual((response.status_code, response.json()['status']), (200, health.OK))
+        self.assertRegex(response['Cache-Control'], r'^max-age=\d+$')
+        etag = response['ETag']
+        response = self.client.get('/api/email/status/', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.content, response['ETag']), (304, b'', etag))
+
+        os.utime(self.path, (0, 0))
+        with self.settings(EMAIL_PORT=closed_port()):
+            health.refresh()
+        response = self.client.get('/api/email/status/', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.json()['status']), (503, health.DOWN))
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class TransportTests(SinkTestCase):
+    sink_options = {'starttls': True}
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.multiple(
+            transport, _addresses={}, _sessions=OrderedDict(), _stats=dict.fromkeys(transport._stats, 0),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(EMAIL_DNS_CACHE_TTL=30)
+    def test_addresses_are_cached_until_the_ttl_runs_out(self):
+        with mock.patch('socket.getaddrinfo', wraps=socket.getaddrinfo) as getaddrinfo:
+            first = transport.resolve('localhost', 25)
+            self.assertEqual(transport.resolve('localhost', 25), first)
+            self.assertEqual(getaddrinfo.call_count, 1)
+            expires, addrinfo = transport._addresses[('localhost', 25)]
+            with mock.patch('time.monotonic', return_value=expires):
+                transport.resolve('localhost', 25)
+            self.assertEqual(getaddrinfo.call_count, 2)
+        self.assertEqual((transport.snapshot()['dns_hits'], transport.snapshot()['dns_misses']), (1, 2))
+
+    @override_settings(EMAIL_DNS_CACHE_TTL=0)
+    def test_zero_ttl_disables_the_cache(self):
+        with mock.patch('socket.getaddrinfo', wraps=socket.getaddrinfo) as getaddrinfo:
+            transport.resolve('localhost', 25)
+            transport.resolve('localhost', 25)
+        self.assertEqual(getaddrinfo.call_count, 2)
+        self.assertEqual(transport.snapshot()['cached_hosts'], 0)
+
+    @override_settings(EMAIL_DNS_CACHE_TTL=30, EMAIL_USE_TLS=True)
+    def test_reconnect_resumes_the_tls_session(self):
+        with mock.patch.dict(os.environ, SSL_CERT_FILE=self.sink.cert_path):
+            for _ in range(2):
+                get_connection().send_messages([EmailMessage('Hi', 'Hello', 'sender@example.com', ['ada@example.com'])])
+        stats = transport.snapshot()
+        self.assertEqual((stats['tls_handshakes'], stats['tls_resumed']), (2, 1))
+        self.assertEqual((stats['dns_hits'], stats['dns_misses'], stats['cached_sessions']), (1, 1, 1))
+        transport.forget(self.host, self.port)
+        self.assertEqual((transport.snapshot()['cached_hosts'], transport.snapshot()['cached_sessions']), (0, 0))
+
+    @override_settings(EMAIL_DNS_CACHE_TTL=30)
+    def test_forked_child_starts_with_fresh_sessions_and_an_unheld_lock(self):
+        transport.resolve('localhost', 25)
+        transport._sessions['key'] = (None, None)
+        read_fd, write_fd = os.pipe()
+        # Forking while another thread holds the lock must not deadlock the child.
+        with transport._lock:
+            pid = os.fork()
+            if pid == 0:
+                signal.alarm(5)
+                os.write(write_fd, json.dumps(transport.snapshot()).encode())
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            child = json.loads(f.read() or b'null')
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(child, {**dict.fromkeys(transport._stats, 0), 'cached_hosts': 1, 'cached_sessions': 0})
+        self.assertEqual(transport.snapshot()['cached_sessions'], 1)
+
+
+class TargetsTests(TestCase):
+    def test_read_targets(self):
+        lines = [
+            'mx1.example.com\n',
+            'mx2.example.com:2525  # submission\n',
+            '\n',
+            '# a comment\n',
+            '192.0.2.1:25\n',
+            '::1\n',
+            '[2001:db8::1]:465\n',
+        ]
+        self.assertEqual(list(read_targets(lines, [25, 587])), [
+            ('mx1.example.com', 25), ('mx1.example.com', 587),
+            ('mx2.example.com', 2525),
+            ('192.0.2.1', 25),
+            ('::1', 25), ('::1', 587),
+            ('2001:db8::1', 465),
+        ])
+
+    def test_scan_reports_every_target(self):
+        ports = sorted({closed_port(), closed_port()})
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write('127.0.0.1\n')
+            f.flush()
+            stdout = io.StringIO()
+            call_command(
+                'check_smtp_cert', targets_file=f.name, ports=','.join(map(str, ports)),
+                format='json', timeout=2, stdout=stdout,
+            )
+        results = json.loads(stdout.getvalue())
+        self.assertEqual([(r['host'], r['port']) for r in results], [('127.0.0.1', port) for port in ports])
+        self.assertTrue(all('error' in r for r in results))
+
+
+class WatchTests(TestCase):
+    thresholds = [7, 30]
+
+    def result(self, fingerprint='aa', days=90, hostname_match=True, error=None):
+        result = {
+            'host': 'mx.example.com', 'port': 25, 'fingerprint_sha256': fingerprint, 'common_name': 'mx.example.com',
+            'days_until_expiry': days, 'hostname_match': hostname_match, 'verified': error is None,
+        }
+        if error:
+            result['error'] = error
+        return result
+
+    def failed(self):
+        return {'host': 'mx.example.com', 'port': 25, 'error': 'ConnectionRefusedError: refused'}
+
+    def watch(self, *results):
+        """The event names of each round, as --watch would print them."""
+        state, rounds = None, []
+        for result in results:
+            rounds.append([event['event'] for event in watch_events(state, result, self.thresholds)])
+            state = next_state(state, result, self.thresholds)
+        return rounds
+
+    def test_healthy_endpoint_is_quiet(self):
+        self.assertEqual(self.watch(self.result(), self.result()), [[], []])
+
+    def test_rotated(self):
+        self.assertEqual(self.watch(self.result(), self.result('bb'), self.result('bb')), [[], ['rotated'], []])
+        [event] = watch_events(next_state(None, self.result(), self.thresholds), self.result('bb'), self.thresholds)
+        self.assertEqual((event['previous_fingerprint_sha256'], event['fingerprint_sha256']), ('aa', 'bb'))
+
+    def test_expiring_once_per_threshold_then_expired(self):
+        days = [40, 25, 20, 5, 6, -1, -2]
+        self.assertEqual(self.watch(*[self.result(days=d) for d in days]),
+                         [[], ['expiring'], [], ['expiring'], [], ['expired'], []])
+
+    def test_rotation_starts_the_expiry_warnings_over(self):
+        self.assertEqual(self.watch(self.result(days=5), self.result('bb', days=5), self.result('cc', days=90)),
+                         [['expiring'], ['rotated', 'expiring'], ['rotated']])
+
+    def test_hostname_mismatch(self):
+        self.assertEqual(self.watch(
+            self.result(hostname_match=False), self.result(hostname_match=False),
+            self.result('bb', hostname_match=False), self.result('cc'), self.result('cc', hostname_match=False),
+        ), [['hostname_mismatch'], [], ['rotated', 'hostname_mismatch'], ['rotated'], ['hostname_mismatch']])
+
+    def test_failed_and_recovered(self):
+        self.assertEqual(self.watch(self.result(), self.failed(), self.failed(), self.result()),
+                         [[], ['probe_failed'], [], ['probe_recovered']])
+        # The certificate is remembered while the endpoint is down.
+        state = next_state(next_state(None, self.result(), self.thresholds), self.failed(), self.thresholds)
+        self.assertEqual((state['failing'], state['fingerprint']), (True, 'aa'))
+
+    def test_failure_that_still_saw_a_certificate(self):
+        self.assertEqual(self.watch(
+            self.failed(), self.result('bb', error='ProbeError: untrusted'), self.result('bb'),
+        ), [['probe_failed'], [], ['probe_recovered']])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        settings = override_settings(EMAIL_METRICS_DIR=self.dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # This process's metrics start out empty and unshared.
+        patcher = mock.patch.multiple(metrics, _values=None, _values_pid=None, _shared=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sends(self):
+        return metrics.collect()[metrics._PHASE_INDEX['send'] + len(metrics.BUCKETS) + 2]
+
+    def test_process_outside_gunicorn_keeps_metrics_in_memory(self):
+        metrics.observe('send', 0.01)
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(self.sends(), 1)
+        response = self.client.get('/api/email/metrics/')
+        self.assertIn(b'email_smtp_phase_seconds_count{phase="send"} 1\n', response.content)
+
+    def test_exited_worker_file_is_folded_into_the_retired_totals(self):
+        metrics.share()
+        metrics.observe('send', 0.01)
+        metrics.observe('send', 0.02)
+        self.assertEqual(os.listdir(self.dir), [f'metrics-{os.getpid()}.bin'])
+        metrics.retire(self.dir, os.getpid())
+        metrics.retire(self.dir, os.getpid())
+        self.assertEqual(os.listdir(self.dir), ['metrics-retired.bin'])
+        self.assertEqual(self.sends(), 2)
+
+
+@override_settings(
+    EMAIL_BACKEND='email_test.backends.InstrumentedEmailBackend', EMAIL_PROFILES={},
+    EMAIL_RATE_LIMIT=0, EMAIL_DOMAIN_RATE_LIMIT=0, EMAIL_DELIVERY_LOG=False, EMAIL_DKIM_PRIVATE_KEY_FILE='',
+)
+class BenchTests(TestCase):
+    def bench(self, **options):
+        stdout = io.StringIO()
+        call_command('bench_email', concurrency=2, stdout=stdout, stderr=io.StringIO(), **options)
+        return json.loads(stdout.getvalue())
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, pct) for pct in (0, 50, 95, 100)], [1, 50, 95, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_modes_send_through_the_sink(self):
+        for mode in ('send_mail', 'message', 'view', 'html-view', 'async-view'):
+            with self.subTest(mode=mode):
+                result = self.bench(mode=mode, messages=3)
+                self.assertEqual((result['sent'], result['failed']), (3, 0))
+                self.assertEqual(result['sink']['messages'], 3)
+
+    def test_multiple_recipients(self):
+        result = self.bench(mode='message', messages=2, recipients=3)
+        self.assertEqual((result['sent'], result['recipients']), (2, 3))
+        self.assertEqual(result['sink']['messages'], 2)
+
+    def test_injected_failures(self):
+        for rate, counter in (('perm_fail_rate', 'perm_failures'), ('temp_fail_rate', 'temp_failures')):
+            with self.subTest(rate=rate):
+                result = self.bench(messages=4, seed=1, **{rate: 1})
+                self.assertEqual((result['sent'], result['failed']), (0, 4))
+                self.assertEqual(result['errors'], {'SMTPRecipientsRefused': 4})
+                self.assertEqual(result['sink'][counter], 4)
+
+    def test_starttls_and_disabled_extensions(self):
+        with mock.patch.dict(os.environ):
+            result = self.bench(messages=2, starttls=True, sink_disable='PIPELINING')
+        self.assertEqual(result['sent'], 2)
+        self.assertEqual(result['sink']['disabled_extensions'], ['PIPELINING'])
+        self.assertEqual(result['sink']['pipelined'], 0)
+
+    def test_url_mode_needs_a_url(self):
+        with self.assertRaisesMessage(CommandError, '--url'):
+            self.bench(mode='url', messages=1)
+
+
+class TemplateCacheTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.cache = templating.TemplateCache(self.dir, max_size=2)
+
+    def write(self, name, source):
+        with open(os.path.join(self.dir, f'{name}.html'), 'w', encoding='utf-8') as f:
+            f.write(source)
+
+    def test_render(self):
+        self.write('welcome', (
+            '<html><head><title>Hi {{ name }}</title></head>'
+            '<body><p>Hello {{ name }}, <a href="{{ url }}">sign in</a>.</p></body></html>'
+        ))
+        subject, html, text = self.cache.get('welcome').render({'name': 'Ada & co', 'url': 'https://x.example'})
+        self.assertEqual(subject, 'Hi Ada & co')
+        self.assertIn('<p>Hello Ada &amp; co, <a href="https://x.example">sign in</a>.</p>', html)
+        self.assertEqual(text, 'Hello Ada & co, sign in (https://x.example).\n')
+        with self.assertRaises(ValueError):
+            self.cache.get('welcome').render(['not', 'a', 'dict'])
+
+    def test_compiled_once_until_the_file_changes(self):
+        self.write('a', '<p>one</p>')
+        compiled = self.cache.get('a')
+        self.assertIs(self.cache.get('a'), compiled)
+        self.write('a', '<p>three</p>')
+        self.assertIsNot(self.cache.get('a'), compiled)
+        self.assertIn('three', self.cache.get('a').render({})[1])
+
+    def test_least_recently_used_template_is_evicted(self):
+        for name in 'abc':
+            self.write(name, f'<p>{name}</p>')
+        a, b = self.cache.get('a'), self.cache.get('b')
+        self.cache.get('a')
+        self.cache.get('c')
+        self.assertEqual(list(self.cache._entries), ['a', 'c'])
+        self.assertIs(self.cache.get('a'), a)
+        self.assertIsNot(self.cache.get('b'), b)
+
+    def test_unknown_and_invalid_names(self):
+        for name in ('missing', '../settings', 'a b', 'sub/../../x'):
+            with self.subTest(name=name), self.assertRaises(templating.TemplateNotFound):
+                self.cache.get(name)
+
+
+class InlineCSSTests(TestCase):
+    def inline(self, css, body):
+        return templating.inline_css(f'<html><head><style>{css}</style></head><body>{body}</body></html>')
+
+    def test_simple_selectors_are_inlined(self):
+        result = self.inline(
+            'p { color: red } .note { font-weight: bold } #top { margin: 0 } p.note.big { font-size: 2em }',
+            '<p id="top" class="note big">x</p><P>y</P><div class="note">z</div>',
+        )
+        self.assertIn(
+            '<p id="top" class="note big" style="color: red; font-weight: bold; font-size: 2em; margin: 0">',
+            result,
+        )
+        self.assertIn('<P style="color: red">', result)
+        self.assertIn('<div class="note" style="font-weight: bold">', result)
+        self.assertNotIn('<style>', result)
+
+    def test_specificity_then_source_order(self):
+        result = self.inline('#a { color: blue } .b { color: green } p { color: red } .c { color: black }',
+                             '<p id="a" class="b c">x</p>')
+        self.assertIn('style="color: red; color: green; color: black; color: blue"', result)
+
+    def test_existing_style_attribute_wins(self):
+        result = self.inline('p { color: red; margin: 0 }', "<p style='color: blue;'>x</p>")
+        self.assertIn('<p style="color: red;margin: 0; color: blue">', result)
+
+    def test_important_is_kept(self):
+        # Still outranks the element's own color, as it did in the <style> block.
+        result = self.inline('p { color: red !important }', '<p style="color: blue">x</p>')
+        self.assertIn('<p style="color: red !important; color: blue">', result)
+
+    def test_selectors_that_cannot_be_inlined_stay_in_a_style_block(self):
+        result = self.inline(
+            '/* a comment */ div p, a:hover, p { color: red } @media (max-width: 600px) { p { color: blue } }',
+            '<div><p>x</p></div>',
+        )
+        self.assertIn('<p style="color: red">', result)
+        head = result[:result.index('</head>')]
+        self.assertIn('div p { color: red }', head)
+        self.assertIn('a:hover { color: red }', head)
+        self.assertIn('@media (max-width: 600px) { p { color: blue } }', head)
+        self.assertNotIn('comment', result)
+
+    def test_quotes_in_declarations_are_escaped(self):
+        result = self.inline('p { font-family: "Helvetica Neue", Arial }', '<p>x</p>')
+        self.assertIn('<p style="font-family: &quot;Helvetica Neue&quot;, Arial">', result)
+
+    def test_source_without_style_is_unchanged(self):
+        source = '<p class="x">x</p>'
+        self.assertEqual(templating.inline_css(source), source)
+
+
+LEAN_PROBE = '''
+import json, sys
+import django
+django.setup()
+from django.test import Client
+import email_test.management.commands.check_smtp_cert
+client = Client(HTTP_HOST='localhost')
+print(json.dumps({
+    'config': client.get('/api/email/config/').status_code,
+    'admin': client.get('/admin/').status_code,
+    'loaded': sorted({name.split('.')[0] for name in sys.modules} & {'cryptography'})
+              + sorted(name for name in sys.modules if name.startswith('django.contrib.')),
+}))
+'''
+
+
+@skipUnless(os.path.exists('/proc/self/smaps_rollup'), 'startup_report needs Linux')
+class StartupTests(TestCase):
+    def run_lean(self, code):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'config.settings_api', 'ALLOWED_HOSTS': 'localhost'}
+        proc = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return proc.stdout
+
+    def test_lean_profile_serves_only_the_api(self):
+        result = json.loads(self.run_lean(LEAN_PROBE))
+        self.assertEqual((result['config'], result['admin']), (200, 404))
+        # No admin, auth or sessions, and cryptography stays unloaded until a certificate is parsed.
+        self.assertEqual(result['loaded'], [])
+
+    def test_startup_report(self):
+        stdout = io.StringIO()
+        with mock.patch.dict(os.environ, ALLOWED_HOSTS='localhost'):
+            call_command('startup_report', settings_modules=['config.settings_api'], requests=2, top=3,
+                         stdout=stdout, stderr=io.StringIO())
+        [profile] = json.loads(stdout.getvalue())['profiles']
+        self.assertEqual(profile['settings'], 'config.settings_api')
+        self.assertEqual((profile['first_request_status'], profile['installed_apps'], profile['middleware']),
+                         (200, 1, 2))
+        phases = profile['phases']
+        self.assertEqual(list(phases), ['import_django', 'setup', 'wsgi_app', 'urlconf', 'first_request'])
+        self.assertEqual(profile['cold_start_ms'], phases['first_request']['ms'])
+        self.assertEqual(sorted(profile['forked_worker']), ['private_mb', 'pss_mb', 'rss_mb', 'shared_mb'])
+        self.assertGreater(profile['forked_worker']['shared_mb'], 0)
+        self.assertTrue(0 < len(profile['slowest_imports']) <= 3)
+
+    def test_failing_settings_module_is_reported(self):
+        with self.assertRaisesMessage(CommandError, 'config.missing failed to start'):
+            call_command('startup_report', settings_modules=['config.missing'], stderr=io.StringIO())
+
+    def test_parse_importtime(self):
+        stderr = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       100 |        100 |   _io',
+            'import time:      1500 |       2000 | json',
+            'import time:       400 |        400 |   json.decoder',
+            'import time:       300 |        300 | email_test',
+            'unrelated line',
+        ])
+        total_ms, slowest = startup_report.parse_importtime(stderr, top=1)
+        self.assertEqual(total_ms, 2.3)
+        self.assertEqual(slowest, [{'module': 'json', 'depth': 0, 'self_ms': 1.5, 'cumulative_ms': 2.0}])
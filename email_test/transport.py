@@ -0,0 +1,168 @@
+"""
+Per-process connection setup shared by the SMTP backends, the async client
+and check_smtp_cert.
+
+- resolve() caches getaddrinfo results for EMAIL_DNS_CACHE_TTL seconds.
+- get_ssl_context() builds one SSLContext per verification mode (and
+  client certificate) and reuses it, so the CA bundle is loaded once.
+- wrap_socket()/save_session() keep the last TLS session per host:port,
+  so reconnects resume instead of doing a full handshake.
+
+A forked child (e.g. a gunicorn worker) starts with fresh TLS sessions and
+counters.
+"""
+
+import asyncio
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+SESSION_CACHE_SIZE = 256
+
+_lock = threading.Lock()
+_addresses = {}
+_contexts = {}
+_sessions = OrderedDict()
+_stats = {'dns_hits': 0, 'dns_misses': 0, 'tls_handshakes': 0, 'tls_resumed': 0}
+
+
+def _cached_addresses(host, port):
+    with _lock:
+        entry = _addresses.get((host, port))
+        if entry is not None and entry[0] > time.monotonic():
+            _stats['dns_hits'] += 1
+            return entry[1]
+    return None
+
+
+def _store_addresses(host, port, addrinfo):
+    ttl = settings.EMAIL_DNS_CACHE_TTL
+    with _lock:
+        _stats['dns_misses'] += 1
+        if ttl > 0:
+            _addresses[(host, port)] = (time.monotonic() + ttl, addrinfo)
+
+
+def resolve(host, port):
+    """getaddrinfo(host, port) for TCP, cached for EMAIL_DNS_CACHE_TTL seconds."""
+    addrinfo = _cached_addresses(host, port)
+    if addrinfo is None:
+        addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        _store_addresses(host, port, addrinfo)
+    return addrinfo
+
+
+async def resolve_async(host, port):
+    """resolve() for asyncio code; a cache miss doesn't block the event loop."""
+    addrinfo = _cached_addresses(host, port)
+    if addrinfo is None:
+        addrinfo = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        _store_addresses(host, port, addrinfo)
+    return addrinfo
+
+
+def forget(host, port):
+    """Drop cached addresses and TLS sessions for host:port, e.g. after it stops answering."""
+    with _lock:
+        _addresses.pop((host, port), None)
+        for key in [key for key in _sessions if key[1:] == (host, port)]:
+            del _sessions[key]
+
+
+def create_connection(host, port, timeout=None):
+    """socket.create_connection() over the cached addresses."""
+    error = None
+    for family, socktype, proto, _, address in resolve(host, port):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    forget(host, port)
+    raise error or OSError(f'getaddrinfo returned no addresses for {host}')
+
+
+def get_ssl_context(verify=True, certfile=None, keyfile=None):
+    """
+    Return the shared client SSLContext for this verification mode.
+
+    ``verify=False`` disables hostname and chain checks (for inspecting
+    certificates). Contexts are also keyed on SSL_CERT_FILE so changing the
+    trust store at runtime takes effect. Treat the result as read-only.
+    """
+    key = (verify, certfile, keyfile, os.environ.get('SSL_CERT_FILE'))
+    with _lock:
+        context = _contexts.get(key)
+        if context is None:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if certfile or keyfile:
+                context.load_cert_chain(certfile, keyfile)
+            _contexts[key] = context
+        return context
+
+
+def wrap_socket(context, sock, host, port, resume=True):
+    """TLS-wrap ``sock``, resuming the last session for host:port if there is one."""
+    session = None
+    if resume:
+        with _lock:
+            entry = _sessions.get((id(context), host, port))
+        # Guard against a reused id() from a context that has been freed.
+        if entry is not None and entry[0] is context:
+            session = entry[1]
+    tls_sock = context.wrap_socket(sock, server_hostname=host, session=session)
+    with _lock:
+        _stats['tls_handshakes'] += 1
+        if tls_sock.session_reused:
+            _stats['tls_resumed'] += 1
+    if resume:
+        save_session(tls_sock, host, port)
+    return tls_sock
+
+
+def save_session(tls_sock, host, port):
+    """
+    Remember ``tls_sock``'s session for resumption. With TLS 1.3 the ticket
+    arrives after the handshake, so call this again once the server has
+    sent something (e.g. after EHLO).
+    """
+    session = tls_sock.session
+    if session is None or not (session.has_ticket or session.id):
+        return
+    key = (id(tls_sock.context), host, port)
+    with _lock:
+        _sessions[key] = (tls_sock.context, session)
+        _sessions.move_to_end(key)
+        while len(_sessions) > SESSION_CACHE_SIZE:
+            _sessions.popitem(last=False)
+
+
+def snapshot():
+    """Cache counters for this process, for /api/email/config/."""
+    with _lock:
+        return {**_stats, 'cached_hosts': len(_addresses), 'cached_sessions': len(_sessions)}
+
+
+def _reset_after_fork():
+    # A forked worker must not inherit a lock held mid-update or resume the
+    # parent's TLS sessions; addresses and contexts stay valid and are kept.
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+    for name in _stats:
+        _stats[name] = 0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -6,5 +6,15 @@ app_name = 'email_test'
 urlpatterns = [
     path('send/', views.send_test_email, name='send_test_email'),
     path('send-html/', views.send_html_email, name='send_html_email'),
+    path('async/send/', views.send_test_email_async, name='send_test_email_async'),
+    path('async/send-html/', views.send_html_email_async, name='send_html_email_async'),
+    path('send-attachments/', views.send_with_attachments, name='send_with_attachments'),
+    path('send-batch/', views.send_batch, name='send_batch'),
+    path('merge/', views.send_merge, name='send_merge'),
+    path('jobs/<uuid:job_id>/', views.email_job_status, name='email_job_status'),
+    path('deliveries/', views.email_deliveries, name='email_deliveries'),
     path('config/', views.email_config_status, name='email_config_status'),
+    path('status/', views.email_status, name='email_status'),
+    path('probe/', views.email_probe, name='email_probe'),
+    path('metrics/', views.email_metrics, name='email_metrics'),
 ]
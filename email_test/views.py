@@ -1,61 +1,96 @@
-from django.http import JsonResponse
-from django.core.mail import send_mail, EmailMessage
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.mail import EmailMessage
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+import asyncio
+import itertools
 import json
+import logging
+import math
+
+from . import (
+    delivery, dkim, health, merge, metrics, outbox, pool, probe, profiles, ratelimit, relays, schema,
+    spool, templating, transport,
+)
+from .idempotency import idempotent
+from .messages import build_message, prepare_batch
+from .models import DeliveryLog, EmailJob
+from .streaming import StreamingMessage
+
+logger = logging.getLogger(__name__)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@schema.limit_body()
+@idempotent
 def send_test_email(request):
     """
     Send a test email.
     POST body: {
         "to_email": "recipient@example.com",
         "subject": "Test Subject",
-        "message": "Test message body"
+        "message": "Test message body",
+        "profile": "acme"  (optional: a named SMTP profile from EMAIL_PROFILES)
     }
     """
     try:
-        data = json.loads(request.body)
-        to_email = data.get('to_email')
+        data = schema.parse(request.body)
+        to_email = data['to_email']
         subject = data.get('subject', 'Test Email')
         message = data.get('message', 'This is a test email from Django.')
+        profile = data.get('profile')
 
-        if not to_email:
-            return JsonResponse({
-                'success': False,
-                'error': 'to_email is required'
-            }, status=400)
+        from_email = profiles.from_email(profile)
+        if _queue_requested(data):
+            return _enqueue(_with_profile({'to_email': to_email, 'subject': subject, 'message': message}, profile))
 
-        send_mail(
+        email = EmailMessage(
             subject=subject,
-            message=message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[to_email],
-            fail_silently=False,
+            body=message,
+            from_email=from_email,
+            to=[to_email],
         )
+        ratelimit.acquire([to_email], relay=ratelimit.relay_key(profile))
+        with metrics.capture() as timings:
+            delivery.send([email], profile=profile)
+        if hasattr(email, 'spool_id'):
+            return _spooled(email)
 
         return JsonResponse({
             'success': True,
-            'message': f'Email sent successfully to {to_email}'
+            'message': f'Email sent successfully to {to_email}',
+            'timings_ms': timings
         })
 
     except json.JSONDecodeError:
         return JsonResponse({
             'success': False,
-            'error': 'Invalid JSON in request body'
+            'error': 'Invalid JSON in request body',
+            'code': 'invalid_json'
         }, status=400)
-    except Exception as e:
+    except ValueError as e:
+        # Invalid fields, an unknown profile or a header injection attempt.
         return JsonResponse({
             'success': False,
-            'error': str(e)
-        }, status=500)
+            'error': str(e),
+            'code': 'invalid_request'
+        }, status=400)
+    except ratelimit.RateLimited as e:
+        return _rate_limited(e)
+    except Exception as e:
+        return _send_failed(e)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@schema.limit_body()
+@idempotent
 def send_html_email(request):
     """
     Send an HTML email.
@@ -64,43 +99,499 @@ def send_html_email(request):
         "subject": "Test Subject",
         "html_content": "<h1>Test HTML Email</h1>"
     }
+    or, to render a named template from EMAIL_TEMPLATE_DIR (sent with a
+    generated plain-text alternative; subject defaults to its <title>): {
+        "to_email": "recipient@example.com",
+        "template": "welcome",
+        "context": {"name": "Ada"}
+    }
+    Either form takes an optional "profile" naming an SMTP profile.
     """
     try:
-        data = json.loads(request.body)
-        to_email = data.get('to_email')
+        data = schema.parse(request.body)
+        to_email = data['to_email']
         subject = data.get('subject', 'Test HTML Email')
         html_content = data.get('html_content', '<h1>This is a test HTML email</h1>')
+        template = data.get('template')
+        profile = data.get('profile')
+
+        from_email = profiles.from_email(profile)
+        if template:
+            payload = {'to_email': to_email, 'template': template, 'context': data.get('context') or {}}
+            if 'subject' in data:
+                payload['subject'] = subject
+            payload = _with_profile(payload, profile)
+            if _queue_requested(data):
+                # Compile now so an unknown template fails the request, not the job.
+                templating.get_cache().get(template)
+                return _enqueue(payload)
+            email = build_message(payload)
+        elif _queue_requested(data):
+            payload = {'to_email': to_email, 'subject': subject, 'html_content': html_content}
+            return _enqueue(_with_profile(payload, profile))
+        else:
+            email = EmailMessage(
+                subject=subject,
+                body=html_content,
+                from_email=from_email,
+                to=[to_email],
+            )
+            email.content_subtype = 'html'
+        ratelimit.acquire(email.recipients(), relay=ratelimit.relay_key(profile))
+        with metrics.capture() as timings:
+            delivery.send([email], profile=profile)
+        if hasattr(email, 'spool_id'):
+            return _spooled(email)
+
+        return JsonResponse({
+            'success': True,
+            'message': f'HTML email sent successfully to {to_email}',
+            'timings_ms': timings
+        })
+
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid JSON in request body',
+            'code': 'invalid_json'
+        }, status=400)
+    except ValueError as e:
+        # Invalid fields, unknown template or profile, bad context or a header injection attempt.
+        return JsonResponse({
+            'success': False,
+            'error': str(e),
+            'code': 'invalid_request'
+        }, status=400)
+    except ratelimit.RateLimited as e:
+        return _rate_limited(e)
+    except Exception as e:
+        return _send_failed(e)
+
+
+def _queue_requested(data):
+    return data.get('queue', settings.EMAIL_SEND_MODE == 'queue')
+
+
+def _with_profile(payload, profile):
+    if profile:
+        payload['profile'] = profile
+    return payload
+
+
+def _rate_limited(exc):
+    response = JsonResponse({
+        'success': False,
+        'error': str(exc),
+        'code': 'rate_limited',
+        'retry_after': round(exc.retry_after, 3)
+    }, status=429)
+    response['Retry-After'] = ratelimit.retry_after_header(exc)
+    return response
+
+
+def _send_failed(exc):
+    """
+    Error response for a failed send: a stable ``code`` and the relay's
+    reply instead of the exception text; 503 for transient failures.
+    """
+    error = delivery.classify(exc)
+    if error.code == 'internal_error':
+        logger.exception('Unexpected error while sending email')
+    response = JsonResponse(error.as_dict(), status=error.status)
+    # Stored under an Idempotency-Key, so a retry can't send it twice.
+    response.maybe_sent = error.maybe_sent
+    if error.retry_after is not None:
+        response['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
+
+def _spooled(email):
+    return JsonResponse({
+        'success': True,
+        'spooled': True,
+        'spool_id': email.spool_id,
+        'message': f'Relay unavailable; email to {email.to[0]} spooled for later delivery'
+    }, status=202)
+
+
+def _enqueue(payload):
+    job = outbox.enqueue(payload)
+    return JsonResponse({
+        'success': True,
+        'job_id': str(job.id),
+        'status': job.status,
+        'message': f'Email to {payload["to_email"]} queued for delivery'
+    }, status=202)
+
+
+@require_http_methods(["GET"])
+def email_job_status(request, job_id):
+    """
+    Get the delivery status of a queued email.
+    """
+    try:
+        job = EmailJob.objects.get(id=job_id)
+    except EmailJob.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'error': 'Job not found'
+        }, status=404)
+
+    return JsonResponse({
+        'success': True,
+        'job': {
+            'id': str(job.id),
+            'status': job.status,
+            'to_email': job.payload.get('to_email'),
+            'attempts': job.attempts,
+            'last_error': job.last_error,
+            # When a queued job that failed or was deferred is tried next.
+            'not_before': job.not_before.isoformat() if job.not_before else None,
+            'created_at': job.created_at.isoformat(),
+            'sent_at': job.sent_at.isoformat() if job.sent_at else None,
+        }
+    })
+
+
+@require_http_methods(["GET"])
+def email_deliveries(request):
+    """
+    Page through the delivery log, newest first.
+    Query string: to_email, status (sent, spooled or failed), profile,
+    since/until (ISO 8601 times), limit (default 50, at most 500) and
+    cursor, the next_cursor of the previous page. Pages are fetched by id
+    (keyset pagination), so deep pages cost the same as the first.
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 500)
+        cursor = int(request.GET['cursor']) if request.GET.get('cursor') else None
+    except ValueError:
+        return JsonResponse({
+            'success': False,
+            'error': 'limit and cursor must be integers',
+            'code': 'invalid_request'
+        }, status=400)
+
+    deliveries = DeliveryLog.objects.order_by('-id')
+    for param in ('to_email', 'status', 'profile'):
+        if request.GET.get(param):
+            deliveries = deliveries.filter(**{param: request.GET[param]})
+    for param, lookup in (('since', 'created_at__gte'), ('until', 'created_at__lt')):
+        if request.GET.get(param):
+            value = parse_datetime(request.GET[param])
+            if value is None:
+                return JsonResponse({
+                    'success': False,
+                    'error': f'{param} must be an ISO 8601 date and time',
+                    'code': 'invalid_request'
+                }, status=400)
+            if timezone.is_naive(value):
+                value = timezone.make_aware(value)
+            deliveries = deliveries.filter(**{lookup: value})
+    if cursor is not None:
+        deliveries = deliveries.filter(id__lt=cursor)
+
+    rows = list(deliveries.values(
+        'id', 'created_at', 'to_email', 'from_email', 'subject', 'status', 'code',
+        'smtp_code', 'reply', 'duration_ms', 'attempts', 'relay', 'profile',
+    )[:limit + 1])
+    # The extra row only says whether there is another page.
+    next_cursor = str(rows[limit - 1]['id']) if len(rows) > limit else None
+    for row in rows[:limit]:
+        row['created_at'] = row['created_at'].isoformat()
+
+    return JsonResponse({
+        'success': True,
+        'deliveries': rows[:limit],
+        'next_cursor': next_cursor
+    })
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@schema.limit_body()
+@idempotent
+async def send_test_email_async(request):
+    """
+    Async variant of send_test_email for ASGI deployments.
+    Same POST body and responses; the SMTP conversation runs on the event
+    loop over a pooled asyncio connection instead of blocking a worker.
+    """
+    return await _send_async(request, html=False)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@schema.limit_body()
+@idempotent
+async def send_html_email_async(request):
+    """
+    Async variant of send_html_email for ASGI deployments.
+    Same POST body and responses as send_html_email.
+    """
+    return await _send_async(request, html=True)
+
+
+async def _send_async(request, html):
+    try:
+        data = schema.parse(request.body)
+        if html:
+            data.setdefault('html_content', '<h1>This is a test HTML email</h1>')
+            data.setdefault('subject', 'Test HTML Email')
+        else:
+            # Plain text only, like send_test_email.
+            for field in ('html_content', 'template', 'context'):
+                data.pop(field, None)
+        # Template rendering is CPU work; keep it off the event loop.
+        email = await sync_to_async(build_message, thread_sensitive=False)(data)
+        wait = ratelimit.reserve(email.recipients(), relay=ratelimit.relay_key(data.get('profile')))
+        if wait:
+            await asyncio.sleep(wait)
+        with metrics.capture() as timings:
+            await delivery.send_async(email, profile=data.get('profile'))
+
+        kind = 'HTML email' if html else 'Email'
+        return JsonResponse({
+            'success': True,
+            'message': f'{kind} sent successfully to {email.to[0]}',
+            'timings_ms': timings
+        })
+
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid JSON in request body',
+            'code': 'invalid_json'
+        }, status=400)
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e),
+            'code': 'invalid_request'
+        }, status=400)
+    except ratelimit.RateLimited as e:
+        return _rate_limited(e)
+    except Exception as e:
+        return _send_failed(e)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@schema.limit_body('EMAIL_MAX_BATCH_REQUEST_BYTES')
+def send_batch(request):
+    """
+    Send many emails over a single SMTP session.
+    POST body: a JSON array, or NDJSON (one object per line), of messages in
+    the send/ or send-html/ shape, e.g.
+        [{"to_email": "a@example.com", "subject": "Hi", "message": "..."},
+         {"to_email": "b@example.com", "html_content": "<h1>Hi</h1>"}]
+    Response: NDJSON, one {"index", "success", ...} line per message as it is
+    accepted or rejected, then a final {"summary": {...}} line. Sends wait
+    for the rate limits rather than failing with rate_limited.
+    """
+    try:
+        body = request.body.decode('utf-8')
+        if body.lstrip().startswith('['):
+            payloads = enumerate(json.loads(body))
+        else:
+            payloads = _iter_ndjson(body)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid JSON in request body',
+            'code': 'invalid_json'
+        }, status=400)
+
+    return StreamingHttpResponse(
+        _stream_batch(payloads),
+        content_type='application/x-ndjson',
+    )
+
+
+def _iter_ndjson(body):
+    """Yield (index, payload) per non-blank line; bad lines yield the ValueError."""
+    index = 0
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield index, ValueError(f'Invalid JSON: {e}')
+        index += 1
+
+
+def _built(payloads):
+    """
+    Yield (index, payload, message or the exception building it). With
+    DKIM signing on and EMAIL_DKIM_BATCH_SIZE set, that many messages are
+    built at a time and signed together in the mail merge render
+    processes; otherwise delivery.send() signs each one as it goes out.
+    """
+    size = settings.EMAIL_DKIM_BATCH_SIZE if dkim.get_signer() else 0
+    for chunk in iter(lambda: list(itertools.islice(payloads, max(size, 1))), []):
+        built = []
+        for index, data in chunk:
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                built.append((index, data, build_message(data)))
+            except Exception as e:
+                built.append((index, data, e))
+        if size:
+            emails = [email for _, _, email in built if not isinstance(email, Exception)]
+            prepared = iter(prepare_batch(emails, merge.get_render_pool()))
+            built = [
+                (index, data, email if isinstance(email, Exception) else next(prepared))
+                for index, data, email in built
+            ]
+        yield from built
+
+
+def _stream_batch(payloads):
+    # One connection per SMTP profile for the whole batch; delivery.send()
+    # opens it on first use and replaces it if the relay drops it, so the
+    # rest of the batch keeps sharing a single session.
+    connections = profiles.Connections()
+    sent = failed = 0
+    try:
+        for index, data, email in _built(iter(payloads)):
+            try:
+                if isinstance(email, Exception):
+                    raise email
+                # Pace the batch to the rate limits like a mail merge does;
+                # the caller is already waiting on the stream.
+                ratelimit.acquire(
+                    email.recipients(), max_wait=float('inf'), relay=ratelimit.relay_key(data.get('profile'))
+                )
+                delivery.send([email], connection=connections.get(data.get('profile')))
+                result = {'index': index, 'success': True, 'to_email': email.to[0]}
+                if hasattr(email, 'spool_id'):
+                    result['spooled'] = True
+                sent += 1
+            except ValueError as e:
+                result = {'index': index, 'success': False, 'error': str(e), 'code': 'invalid_request'}
+                failed += 1
+            except Exception as e:
+                result = {'index': index, **delivery.classify(e).as_dict()}
+                failed += 1
+            yield json.dumps(result) + '\n'
+    finally:
+        connections.close()
+
+    yield json.dumps({'summary': {'sent': sent, 'failed': failed}}) + '\n'
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def send_merge(request):
+    """
+    Mail merge: send a named template to every recipient in the body.
+    Query string: template (required), subject (optional), and format=csv
+    or ndjson (default: csv if the Content-Type says so, else ndjson).
+    POST body: CSV with a header row and a to_email (or email) column, the
+    other columns being template context; or NDJSON, one
+    {"to_email": ..., "context": {...}} per line. The body is read as it
+    arrives, so lists of any size work.
+    Response: NDJSON with a line per failed recipient, a {"progress": {...}}
+    line about every second, then a final {"summary": {...}} line.
+    """
+    template = request.GET.get('template')
+    fmt = request.GET.get('format') or ('csv' if 'csv' in request.content_type else 'ndjson')
+    if not template:
+        return JsonResponse({
+            'success': False,
+            'error': 'template is required',
+            'code': 'invalid_request'
+        }, status=400)
+    if fmt not in ('csv', 'ndjson'):
+        return JsonResponse({
+            'success': False,
+            'error': 'format must be csv or ndjson',
+            'code': 'invalid_request'
+        }, status=400)
+    try:
+        templating.get_cache().get(template)
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e),
+            'code': 'invalid_request'
+        }, status=400)
+
+    lines = (line.decode('utf-8', errors='replace') for line in request)
+    events = merge.run(template, merge.read_rows(lines, fmt), subject=request.GET.get('subject'))
+    return StreamingHttpResponse(
+        (json.dumps(event) + '\n' for event in events),
+        content_type='application/x-ndjson',
+    )
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def send_with_attachments(request):
+    """
+    Send an email with file attachments.
+    POST body: multipart/form-data with fields
+        to_email, subject, and message (plain text) or html_content,
+        profile (optional: a named SMTP profile from EMAIL_PROFILES),
+    plus one or more file fields (any name) to attach.
+    Uploads are spooled to temporary files and base64-encoded into the
+    SMTP DATA stream a block at a time, so memory stays flat regardless of
+    attachment size. Retries, the circuit breaker, DKIM and the delivery
+    log work as for send_test_email.
+    """
+    try:
+        to_email = request.POST.get('to_email')
+        subject = request.POST.get('subject', 'Test Email with Attachments')
+        html_content = request.POST.get('html_content')
+        body = html_content if html_content is not None else request.POST.get(
+            'message', 'This is a test email from Django.'
+        )
+        profile = request.POST.get('profile')
 
         if not to_email:
             return JsonResponse({
                 'success': False,
-                'error': 'to_email is required'
+                'error': 'to_email is required',
+                'code': 'invalid_request'
             }, status=400)
+        to_email = schema.normalize_address(to_email)
 
-        email = EmailMessage(
+        uploads = [f for field in request.FILES for f in request.FILES.getlist(field)]
+        message = StreamingMessage(
             subject=subject,
-            body=html_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
+            body=body,
+            from_email=profiles.from_email(profile),
             to=[to_email],
+            attachments=[(f.name, f.content_type, f) for f in uploads],
+            html=html_content is not None,
         )
-        email.content_subtype = 'html'
-        email.send()
+
+        ratelimit.acquire(message.recipients(), relay=ratelimit.relay_key(profile))
+        with metrics.capture() as timings:
+            delivery.send([message], profile=profile)
+        if hasattr(message, 'spool_id'):
+            return _spooled(message)
 
         return JsonResponse({
             'success': True,
-            'message': f'HTML email sent successfully to {to_email}'
+            'message': f'Email with {len(uploads)} attachment(s) sent successfully to {to_email}',
+            'attachments': [{'name': f.name, 'size': f.size} for f in uploads],
+            'timings_ms': timings
         })
 
-    except json.JSONDecodeError:
+    except ValueError as e:
+        # Invalid fields, an unknown profile or a header injection attempt.
         return JsonResponse({
             'success': False,
-            'error': 'Invalid JSON in request body'
+            'error': str(e),
+            'code': 'invalid_request'
         }, status=400)
+    except ratelimit.RateLimited as e:
+        return _rate_limited(e)
     except Exception as e:
-        return JsonResponse({
-            'success': False,
-            'error': str(e)
-        }, status=500)
+        return _send_failed(e)
 
 
 @require_http_methods(["GET"])
@@ -117,8 +608,106 @@ def email_config_status(request):
         'default_from_email': settings.DEFAULT_FROM_EMAIL,
         'has_credentials': bool(settings.EMAIL_HOST_USER and settings.EMAIL_HOST_PASSWORD),
     }
+    # Circuit breaker state per relay (EMAIL_HOSTS, or EMAIL_HOST alone)
+    config['relays'] = relays.snapshot()
+    # DNS and TLS session cache counters for the worker serving this request
+    config['transport'] = transport.snapshot()
+    snapshot = health.get_snapshot()
+    config['health'] = snapshot.status if snapshot else health.UNKNOWN
+    # Messages waiting in EMAIL_SPOOL_DIR (see SpoolingEmailBackend)
+    config['spool'] = spool.snapshot()
+    # Named SMTP profiles (without passwords) and this worker's pooled connections
+    config['profiles'] = profiles.snapshot()
+    config['pools'] = pool.snapshot()
 
     return JsonResponse({
         'success': True,
         'config': config
     })
+
+
+@require_http_methods(["GET", "HEAD"])
+def email_status(request):
+    """
+    Relay health from the background prober: reachability, per-phase
+    latency, advertised extensions and certificate expiry. Serves the last
+    snapshot with an ETag and a max-age lasting until the next check, so
+    pollers mostly get 304s. Returns 503 when every relay is down.
+    """
+    health.ensure_prober()
+    snapshot = health.get_snapshot()
+    if snapshot is None:
+        response = JsonResponse({
+            'success': True,
+            'status': health.UNKNOWN,
+            'relays': [],
+        })
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    if snapshot.etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(
+            snapshot.body,
+            status=503 if snapshot.status == health.DOWN else 200,
+            content_type='application/json',
+        )
+    response['ETag'] = snapshot.etag
+    response['Cache-Control'] = f'max-age={snapshot.max_age()}'
+    return response
+
+
+@require_http_methods(["GET"])
+def email_probe(request):
+    """
+    Probe a relay over one connection: greeting, EHLO, STARTTLS (or
+    implicit TLS), the extensions offered, and the certificate with its
+    chain verification. Query string: host and port (defaulting to
+    EMAIL_HOST/EMAIL_PORT) or profile, naming a configured relay, and
+    refresh=1 to skip the cached result. Each worker reuses a result for
+    EMAIL_PROBE_CACHE_TTL seconds.
+    """
+    endpoints = probe.relay_endpoints()
+    try:
+        if request.GET.get('profile'):
+            profile = profiles.get_profile(request.GET['profile'])
+            host = profile.get('host', settings.EMAIL_HOST)
+            port = int(profile.get('port', settings.EMAIL_PORT))
+        else:
+            host = request.GET.get('host') or settings.EMAIL_HOST
+            port = int(request.GET.get('port') or settings.EMAIL_PORT)
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e) if request.GET.get('profile') else 'port must be an integer',
+            'code': 'invalid_request'
+        }, status=400)
+    if (host, port) not in endpoints:
+        # Only configured relays, so the endpoint can't be used to scan arbitrary hosts.
+        return JsonResponse({
+            'success': False,
+            'error': f'{host}:{port} is not a configured relay',
+            'code': 'invalid_request'
+        }, status=400)
+
+    result, cached = probe.cached_probe(
+        host, port, implicit_tls=endpoints[(host, port)],
+        refresh=request.GET.get('refresh') in ('1', 'true'),
+    )
+    age = probe.cache_age(result)
+    response = JsonResponse({'success': True, 'cached': cached, 'age_seconds': age, **result})
+    response['Cache-Control'] = f'max-age={max(0, settings.EMAIL_PROBE_CACHE_TTL - age)}'
+    return response
+
+
+@require_http_methods(["GET"])
+def email_metrics(request):
+    """
+    Per-phase SMTP latency histograms and send counts, aggregated across
+    all worker processes, in the Prometheus text exposition format.
+    """
+    return HttpResponse(
+        metrics.render_prometheus(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
@@ -0,0 +1,123 @@
+"""
+Serialize messages for the SMTP session they are about to go out on.
+
+Django encodes non-ASCII text parts as quoted-printable or base64 so they
+survive 7-bit relays, which costs up to a third more bytes on the wire.
+When the relay advertises 8BITMIME (RFC 6152), serialize() undoes that
+for every text part whose lines fit the 998-octet limit and marks it
+``8bit``; to_7bit() goes the other way for bytes produced elsewhere (the
+spool, render workers) that meet a relay without 8BITMIME. envelope()
+keeps non-ASCII addresses as UTF-8 for relays with SMTPUTF8 (RFC 6531)
+instead of IDNA/RFC 2047-encoding them.
+
+serialize() also DKIM-signs the bytes when signing is configured (see
+dkim.py), and to_7bit() signs the re-encoded message again, since the
+original signature would no longer verify.
+"""
+
+import email
+from email import encoders
+from email.generator import BytesGenerator
+from email.message import Message
+from email.utils import parseaddr
+from io import BytesIO
+
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+
+from . import dkim
+
+# RFC 5322 2.1.1: lines are at most 998 octets, excluding the CRLF.
+MAX_LINE_LENGTH = 998
+
+# Above this share of 8-bit octets base64 is shorter than quoted-printable.
+_BASE64_RATIO = 0.25
+
+
+def serialize(email_message, eightbit=False, sign=True):
+    """
+    Return ``email_message`` as CRLF bytes, with 8bit text parts if
+    ``eightbit``, DKIM-signed unless ``sign`` is false.
+    """
+    message = email_message.message()
+    if not hasattr(message, 'walk'):
+        # Already bytes underneath (and signed), e.g. a PreparedMessage.
+        return message.as_bytes(linesep='\r\n')
+    if eightbit:
+        for part in message.walk():
+            _unencode(part)
+    # Django's MIME classes and the stdlib's modern EmailMessage disagree
+    # on as_bytes() arguments; the generator takes the same ones for both.
+    fp = BytesIO()
+    BytesGenerator(fp, mangle_from_=False).flatten(message, linesep='\r\n')
+    return dkim.sign(fp.getvalue()) if sign else fp.getvalue()
+
+
+def _unencode(part):
+    if part.is_multipart() or part.get_content_maintype() != 'text':
+        return
+    if part.get_content_disposition() == 'attachment':
+        # Line endings of text attachments must survive byte for byte.
+        return
+    cte = part.get('Content-Transfer-Encoding', '').lower()
+    if cte not in ('quoted-printable', 'base64'):
+        return
+    data = part.get_payload(decode=True)
+    if b'\0' in data or any(len(line) > MAX_LINE_LENGTH for line in data.splitlines()):
+        return
+    part.replace_header('Content-Transfer-Encoding', '7bit' if data.isascii() else '8bit')
+    # Message.set_payload() stores the text as is; the modern API's
+    # override would pick an encoding again. The generator writes
+    # surrogate-escaped text back out as the original bytes.
+    Message.set_payload(part, data.decode('ascii', 'surrogateescape'))
+
+
+def to_7bit(data):
+    """Re-encode the 8-bit parts of serialized message ``data`` for a 7-bit relay."""
+    signer = dkim.get_signer()
+    signed = signer is not None and signer.signed(data)
+    if signed:
+        data = signer.unsign(data)
+    message = email.message_from_bytes(data)
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload()
+        if not isinstance(payload, str) or payload.isascii():
+            continue
+        raw = part.get_payload(decode=True)
+        del part['Content-Transfer-Encoding']
+        eightbit = sum(byte > 127 for byte in raw)
+        if eightbit > len(raw) * _BASE64_RATIO:
+            encoders.encode_base64(part)
+        else:
+            encoders.encode_quopri(part)
+    data = message.as_bytes(policy=message.policy.clone(linesep='\r\n'))
+    return dkim.sign(data) if signed else data
+
+
+def envelope(email_message, smtputf8=False):
+    """
+    Return (from_addr, recipients, mail_options) for ``email_message``.
+
+    With ``smtputf8`` and a non-ASCII address (display names don't
+    count), the addresses are sent as UTF-8 and mail_options asks for
+    SMTPUTF8; otherwise they are encoded the way Django's SMTP backend does.
+    """
+    encoding = email_message.encoding or settings.DEFAULT_CHARSET
+    return encode_envelope(email_message.from_email, email_message.recipients(), encoding, smtputf8)
+
+
+def encode_envelope(from_email, recipients, encoding=None, smtputf8=False):
+    """envelope() for addresses kept apart from their message, e.g. in the spool."""
+    encoding = encoding or settings.DEFAULT_CHARSET
+    if smtputf8 and all(isinstance(addr, str) for addr in [from_email, *recipients]):
+        from_addr = parseaddr(from_email)[1]
+        to_addrs = [parseaddr(addr)[1] for addr in recipients]
+        if not all(addr.isascii() for addr in [from_addr, *to_addrs]):
+            return from_addr, to_addrs, ['SMTPUTF8']
+    return (
+        sanitize_address(from_email, encoding),
+        [sanitize_address(addr, encoding) for addr in recipients],
+        [],
+    )
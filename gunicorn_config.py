@@ -1,16 +1,35 @@
 """Gunicorn configuration file for production deployment."""
 
+import gc
+import glob
 import multiprocessing
 import os
+import tempfile
 
 # Server socket
 bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
+# gthread serves requests on GUNICORN_THREADS threads per worker while the
+# main thread keeps heartbeating, so a long streamed response (send-batch,
+# merge) is not killed after `timeout` as it would be under `sync`.
+# Set GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker (and serve
+# config.asgi:application) to run the async views on an event loop; one
+# process per core is then enough. See deploy/DEPLOYMENT.md.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if 'Uvicorn' in worker_class:
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+else:
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
 worker_connections = 1000
+
+# Load Django once in the master and fork workers from it, so imported code
+# and settings are shared copy-on-write instead of loaded per worker. Code
+# changes then need a restart rather than a HUP. GUNICORN_PRELOAD=false
+# turns this off.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
 timeout = 30
 keepalive = 2
 
@@ -35,3 +54,39 @@ tmp_upload_dir = None
 limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+
+# Server hooks
+def _metrics_dir():
+    return os.getenv('EMAIL_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'email-test-metrics'))
+
+
+def on_starting(server):
+    """Reset the per-worker metrics files (see email_test/metrics.py)."""
+    for path in glob.glob(os.path.join(_metrics_dir(), 'metrics-*.bin')):
+        os.remove(path)
+
+
+def post_fork(server, worker):
+    """Only workers write metrics files; other processes keep theirs in memory."""
+    from email_test import metrics
+    metrics.share()
+
+
+def child_exit(server, worker):
+    """Fold the exited worker's metrics file into the retired totals."""
+    from email_test import metrics
+    metrics.retire(_metrics_dir(), worker.pid)
+
+
+def when_ready(server):
+    """
+    With preload_app, import the URLconf (and so every view module) in the
+    master before workers fork, then move everything allocated so far out
+    of the garbage collector's reach so collections in the workers don't
+    write to, and un-share, those pages.
+    """
+    if server.cfg.preload_app:
+        from django.urls import get_resolver
+        get_resolver().url_patterns
+        gc.freeze()